@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Benchmark the listing XML serializer against the ElementTree reference.
+
+    Run from the repository root:
+        python -m tests.bench_list_xml
+"""
+
+import argparse
+import timeit
+
+from x2s3.utils import get_list_xml, ListEntry
+from tests.test_list_xml import get_list_xml_etree
+
+
+def get_listing(num_keys):
+    contents = [ListEntry(f"data/s0/{i}/{i % 7}/{i % 13}", f'"{i:032x}"', str(i * 1024),
+            '2024-06-01T12:00:00.000Z', 'STANDARD') for i in range(num_keys)]
+    kwargs = {
+        'Name': 'bucket',
+        'Prefix': 'data/',
+        'MaxKeys': num_keys,
+        'KeyCount': num_keys,
+        'IsTruncated': 'true',
+        'NextContinuationToken': 'ZGF0YS9zMC85OTk='
+    }
+    return contents, kwargs
+
+
+if __name__ == "__main__":
+
+    argparser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        "-k",
+        "--keys",
+        type=int,
+        default=1000,
+        help="number of keys in each listing",
+    )
+    argparser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=200,
+        help="number of listings to serialize",
+    )
+    args = argparser.parse_args()
+
+    contents, kwargs = get_listing(args.keys)
+    dicts = [entry._asdict() for entry in contents]
+    assert get_list_xml(contents, [], **kwargs) == get_list_xml_etree(dicts, [], **kwargs)
+
+    results = {
+        'ElementTree (dicts)': timeit.timeit(lambda: get_list_xml_etree(dicts, [], **kwargs), number=args.number),
+        'Streaming (dicts)': timeit.timeit(lambda: get_list_xml(dicts, [], **kwargs), number=args.number),
+        'Streaming (records)': timeit.timeit(lambda: get_list_xml(contents, [], **kwargs), number=args.number),
+    }
+    baseline = results['ElementTree (dicts)']
+    for name, elapsed in results.items():
+        print(f"{name:<22} {elapsed / args.number * 1000:8.3f} ms per listing  ({baseline / elapsed:.1f}x)")
@@ -26,6 +26,23 @@ def get_settings():
                 'prefix':'jrc_mus_lung_covid.n5/'
             }
         ),
+        Target(
+            name='with-redirect',
+            options={
+                'bucket':'janelia-data-examples',
+                'redirect_min_size':'1GiB',
+                'redirect_patterns':'*/render/attributes.json'
+            }
+        ),
+        Target(
+            name='with-parallel',
+            options={
+                'bucket':'janelia-data-examples',
+                'parallel_min_size':'32',
+                'parallel_part_size':'16',
+                'parallel_requests':'2'
+            }
+        ),
         Target(
             name='hidden-with-endpoint',
             browseable=False,
@@ -246,3 +263,70 @@ def test_get_object_precedence(app):
         assert response.status_code == 200
         json_obj = response.json()
         assert 'n5' in json_obj
+
+
+def test_client_pooled(app):
+    with TestClient(app) as client:
+        proxy_client = app.clients['janelia-data-examples']
+        s3_client = proxy_client.client
+        assert s3_client is not None
+        response = client.head("/janelia-data-examples/jrc_mus_lung_covid.n5/attributes.json")
+        assert response.status_code == 200
+        response = client.get("/janelia-data-examples/jrc_mus_lung_covid.n5/attributes.json")
+        assert response.status_code == 200
+        assert proxy_client.client is s3_client
+    # The client is closed when the service shuts down
+    assert proxy_client.client is None
+
+
+def test_get_object_range(app):
+    with TestClient(app) as client:
+        url = "/janelia-data-examples/jrc_mus_lung_covid.n5/attributes.json"
+        data = client.get(url).content
+        response = client.get(url, headers={'Range':'bytes=0-9'})
+        assert response.status_code == 206
+        assert response.headers['content-range'] == f"bytes 0-9/{len(data)}"
+        assert response.content == data[:10]
+
+        response = client.get(url, headers={'Range':'bytes=0-4,10-14'})
+        assert response.status_code == 206
+        assert response.headers['content-type'].startswith("multipart/byteranges")
+        assert data[10:15] in response.content
+
+        response = client.get(url, headers={'Range':f'bytes={len(data)+10}-'})
+        assert response.status_code == 416
+
+
+def test_get_object_redirect(app):
+    with TestClient(app) as client:
+        # Small objects are still proxied
+        response = client.get("/with-redirect/jrc_mus_lung_covid.n5/attributes.json", 
+            follow_redirects=False)
+        assert response.status_code == 200
+        assert 'n5' in response.json()
+
+        response = client.get("/with-redirect/jrc_mus_lung_covid.n5/render/attributes.json", 
+            follow_redirects=False)
+        assert response.status_code == 307
+        location = response.headers['location']
+        assert location.startswith("https://")
+        assert "jrc_mus_lung_covid.n5/render/attributes.json" in location
+        assert app.clients['with-redirect'].get_stats()['aioboto']['redirects'] == 1
+
+
+def test_get_object_parallel(app):
+    with TestClient(app) as client:
+        path = "jrc_mus_lung_covid.n5/attributes.json"
+        data = client.get(f"/janelia-data-examples/{path}").content
+        # The size isn't known yet, so the first GET is a single request
+        response = client.get(f"/with-parallel/{path}")
+        assert response.status_code == 200
+        assert response.content == data
+        assert app.clients['with-parallel'].get_stats()['aioboto']['parallel_gets'] == 0
+
+        response = client.get(f"/with-parallel/{path}")
+        assert response.status_code == 200
+        assert response.headers['content-length'] == str(len(data))
+        assert response.content == data
+        if len(data) >= 32:
+            assert app.clients['with-parallel'].get_stats()['aioboto']['parallel_gets'] == 1
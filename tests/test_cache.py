@@ -0,0 +1,96 @@
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.settings import Target, Settings
+
+
+@pytest.fixture
+def get_settings(tmp_path):
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(
+            name='memory-cache',
+            client='file',
+            options={
+                'path':'.',
+                'cache_memory_size':'1MiB'
+            }
+        ),
+        Target(
+            name='disk-cache',
+            client='file',
+            options={
+                'path':'.',
+                'cache_memory_max_object_size':'16',
+                'cache_dir':str(tmp_path),
+                'cache_ttl':'0'
+            }
+        )
+    ]
+    return settings
+
+
+@pytest.fixture
+def app(get_settings):
+    return create_app(get_settings)
+
+
+@pytest.fixture
+def data():
+    with open("requirements.txt", "rb") as f:
+        return f.read()
+
+
+def test_memory_cache(app, data):
+    with TestClient(app) as client:
+        cache = app.clients['memory-cache']
+        response = client.get("/memory-cache/requirements.txt")
+        assert response.status_code == 200
+        assert response.content == data
+        assert cache.stats['misses'] == 1
+        assert cache.stats['fills'] == 1
+
+        response = client.get("/memory-cache/requirements.txt")
+        assert response.status_code == 200
+        assert response.content == data
+        assert cache.stats['memory_hits'] == 1
+
+        response = client.get("/memory-cache/requirements.txt", headers={'Range':'bytes=5-14'})
+        assert response.status_code == 206
+        assert response.content == data[5:15]
+        assert response.headers['content-range'] == f"bytes 5-14/{len(data)}"
+        assert cache.stats['memory_hits'] == 2
+
+        response = client.head("/memory-cache/requirements.txt")
+        assert response.status_code == 200
+        assert response.headers['content-length'] == str(len(data))
+        assert cache.stats['memory_hits'] == 3
+
+
+def test_disk_cache(app, data, tmp_path):
+    with TestClient(app) as client:
+        cache = app.clients['disk-cache']
+        response = client.get("/disk-cache/requirements.txt")
+        assert response.status_code == 200
+        assert response.content == data
+        assert cache.stats['fills'] == 1
+        assert len(list((tmp_path / 'disk-cache').glob('*.data'))) == 1
+
+        # Entries expire immediately, so this is revalidated before being served
+        response = client.get("/disk-cache/requirements.txt", headers={'Range':'bytes=0-4,10-14'})
+        assert response.status_code == 206
+        assert response.headers['content-type'].startswith("multipart/byteranges")
+        assert data[10:15] in response.content
+        assert cache.stats['revalidations'] == 1
+        assert cache.stats['disk_hits'] == 1
+
+
+def test_cache_missing(app):
+    with TestClient(app) as client:
+        cache = app.clients['memory-cache']
+        response = client.get("/memory-cache/missing")
+        assert response.status_code == 404
+        assert cache.stats['fills'] == 0
@@ -0,0 +1,90 @@
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.settings import Target, Settings
+
+
+@pytest.fixture
+def get_settings():
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(
+            name='local-files',
+            client='file',
+            options={
+                'path':'.',
+                'cache_control': {
+                    'objects': {'max_age':'60', 'stale_while_revalidate':'30'},
+                    'listings': {'max_age':'10'},
+                    'errors': {'max_age':'5'},
+                    'rules': [
+                        {'pattern':'*.txt', 'max_age':'31536000', 'immutable':'true'}
+                    ]
+                }
+            }
+        ),
+        Target(
+            name='uncached',
+            client='file',
+            options={
+                'path':'.'
+            }
+        )
+    ]
+    return settings
+
+
+@pytest.fixture
+def app(get_settings):
+    return create_app(get_settings)
+
+
+def test_object_policy(app):
+    with TestClient(app) as client:
+        response = client.get("/local-files/README.md")
+        assert response.status_code == 200
+        assert response.headers['cache-control'] == "public, max-age=60, stale-while-revalidate=30"
+        assert 'expires' in response.headers
+
+        response = client.head("/local-files/README.md")
+        assert response.headers['cache-control'] == "public, max-age=60, stale-while-revalidate=30"
+
+        # Not Modified responses carry the same policy
+        response = client.get("/local-files/README.md",
+            headers={'If-None-Match':response.headers['etag']})
+        assert response.status_code == 304
+        assert response.headers['cache-control'] == "public, max-age=60, stale-while-revalidate=30"
+
+
+def test_rule_policy(app):
+    with TestClient(app) as client:
+        response = client.get("/local-files/requirements.txt")
+        assert response.status_code == 200
+        assert response.headers['cache-control'] == \
+            "public, max-age=31536000, stale-while-revalidate=30, immutable"
+
+
+def test_listing_and_error_policy(app):
+    with TestClient(app) as client:
+        response = client.get("/local-files/?list-type=2")
+        assert response.status_code == 200
+        assert response.headers['cache-control'] == "public, max-age=10"
+
+        response = client.get("/local-files/")
+        assert response.status_code == 200
+        assert response.headers['cache-control'] == "public, max-age=10"
+
+        response = client.get("/local-files/missing.txt")
+        assert response.status_code == 404
+        assert response.headers['cache-control'] == "public, max-age=5"
+
+
+def test_no_policy(app):
+    with TestClient(app) as client:
+        response = client.get("/uncached/README.md")
+        assert response.status_code == 200
+        assert 'cache-control' not in response.headers
+        assert 'expires' not in response.headers
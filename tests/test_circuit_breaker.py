@@ -0,0 +1,169 @@
+import asyncio
+import time
+
+from fastapi.responses import Response, JSONResponse
+
+from x2s3.client import ProxyClient
+from x2s3.cache import CachingProxyClient
+from x2s3.circuit_breaker import CircuitBreakerProxyClient, CLOSED, OPEN, HALF_OPEN
+
+
+class FlakyProxyClient(ProxyClient):
+    """ Client whose upstream can be made to fail or hang.
+    """
+
+    def __init__(self):
+        self.failing = False
+        self.delay = 0
+        self.calls = 0
+
+    async def respond(self, response):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.failing:
+            return JSONResponse({"error":"Error communicating with AWS S3"}, status_code=500)
+        return response
+
+    async def head_object(self, key, conditions=None):
+        return await self.respond(Response(headers={'ETag':'"1"', 'Content-Length':'5'}))
+
+    async def get_object(self, key, range_header=None, if_range=None, conditions=None):
+        return await self.respond(Response(content=b'hello', headers={'ETag':'"1"'}))
+
+    async def iter_objects(self, prefix):
+        for i in range(2):
+            batch = await self.respond([f'{prefix}{i}'])
+            yield batch
+            if not isinstance(batch, list):
+                return
+
+
+def get_breaker(upstream, **kwargs):
+    options = {
+        'circuit_breaker': 'true',
+        'breaker_window': 4,
+        'breaker_min_requests': 4,
+        'breaker_open_seconds': 0.1
+    }
+    options.update(kwargs)
+    return CircuitBreakerProxyClient(upstream, {'target_name':'flaky'}, **options)
+
+
+def test_breaker_opens_and_recovers():
+    async def run():
+        upstream = FlakyProxyClient()
+        client = get_breaker(upstream)
+        upstream.failing = True
+        for _ in range(4):
+            response = await client.head_object('key')
+            assert response.status_code == 500
+        assert client.breaker.state == OPEN
+
+        # Requests now fail fast, without reaching upstream
+        response = await client.get_object('key')
+        assert response.status_code == 503
+        assert 'retry-after' in response.headers
+        assert upstream.calls == 4
+
+        # After a while, a probe is let through, and its success closes the breaker
+        await asyncio.sleep(0.1)
+        upstream.failing = False
+        response = await client.get_object('key')
+        assert response.status_code == 200
+        assert client.breaker.state == CLOSED
+
+        stats = client.get_stats()['circuit_breaker']
+        assert stats['state'] == CLOSED
+        assert stats['times_opened'] == 1
+        assert stats['rejected'] == 1
+
+    asyncio.run(run())
+
+
+def test_breaker_inventory():
+    async def collect(client):
+        return [batch async for batch in client.iter_objects('key')]
+
+    async def run():
+        upstream = FlakyProxyClient()
+        client = get_breaker(upstream)
+        assert await collect(client) == [['key0'], ['key1']]
+        assert client.stats['successes'] == 3
+
+        # Failed batches count against the upstream, and end the inventory
+        upstream.failing = True
+        for _ in range(2):
+            batches = await collect(client)
+            assert len(batches) == 1 and batches[0].status_code == 500
+        assert client.breaker.state == OPEN
+
+        # Inventories are rejected without reaching upstream while it is open
+        calls = upstream.calls
+        batches = await collect(client)
+        assert len(batches) == 1 and batches[0].status_code == 503
+        assert upstream.calls == calls
+
+        upstream.failing = False
+        await asyncio.sleep(0.15)
+        assert await collect(client) == [['key0'], ['key1']]
+        assert client.breaker.state == CLOSED
+    asyncio.run(run())
+
+
+def test_breaker_probe_fails():
+    async def run():
+        upstream = FlakyProxyClient()
+        client = get_breaker(upstream)
+        client.breaker.open()
+        await asyncio.sleep(0.1)
+        upstream.failing = True
+        upstream.delay = 0.05
+
+        # Only one probe is allowed at a time
+        probe = asyncio.ensure_future(client.head_object('key'))
+        await asyncio.sleep(0.01)
+        assert client.breaker.state == HALF_OPEN
+        response = await client.head_object('key')
+        assert response.status_code == 503
+        assert (await probe).status_code == 500
+        assert client.breaker.state == OPEN
+
+    asyncio.run(run())
+
+
+def test_breaker_timeout():
+    async def run():
+        upstream = FlakyProxyClient()
+        client = get_breaker(upstream, breaker_timeout=0.01)
+        upstream.delay = 1
+        start = time.monotonic()
+        response = await client.get_object('key')
+        assert response.status_code == 408
+        assert time.monotonic() - start < 0.5
+        assert client.stats['timeouts'] == 1
+
+    asyncio.run(run())
+
+
+def test_serve_stale_when_open():
+    async def run():
+        upstream = FlakyProxyClient()
+        client = CachingProxyClient(get_breaker(upstream), {'target_name':'flaky'},
+                cache_memory_size='1MiB', cache_ttl=0, cache_stale_if_error=60)
+
+        response = await client.get_object('key')
+        await response({"type": "http", "method": "GET"}, None, noop_send)
+        assert client.stats['fills'] == 1
+
+        upstream.failing = True
+        client.wrapped.breaker.open()
+        response = await client.get_object('key')
+        assert response.status_code == 200
+        assert response.body == b'hello'
+        assert client.stats['stale_hits'] == 1
+
+    asyncio.run(run())
+
+
+async def noop_send(message):
+    pass
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.client_file import FileProxyClient
+from x2s3.coalesce import CoalescingProxyClient
+from x2s3.settings import Target, Settings
+
+
+class CountingFileProxyClient(FileProxyClient):
+    """ File client which counts calls and is slow to respond, 
+        so that concurrent requests overlap.
+    """
+
+    def __init__(self, proxy_kwargs, **kwargs):
+        super().__init__(proxy_kwargs, **kwargs)
+        self.calls = 0
+
+    async def head_object(self, key, conditions=None):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return await super().head_object(key, conditions=conditions)
+
+    async def get_object(self, key, range_header=None, if_range=None, conditions=None):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return await super().get_object(key, range_header=range_header, if_range=if_range,
+                conditions=conditions)
+
+
+async def read_response(response, disconnect_after=None):
+    """ Run the given response and return the body it sends.
+    """
+    body = []
+    disconnected = asyncio.Event()
+
+    async def receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+            if disconnect_after is not None and len(body) >= disconnect_after:
+                disconnected.set()
+                await asyncio.sleep(0.1)
+
+    scope = {"type": "http", "method": "GET", "headers": [], "extensions": {}}
+    await response(scope, receive, send)
+    return b''.join(body)
+
+
+@pytest.fixture
+def data():
+    with open("requirements.txt", "rb") as f:
+        return f.read()
+
+
+def create_client():
+    wrapped = CountingFileProxyClient({'target_name':'test'}, path='.')
+    return CoalescingProxyClient(wrapped, {'target_name':'test'}), wrapped
+
+
+def test_coalesce_get(data):
+    async def run():
+        client, wrapped = create_client()
+        responses = await asyncio.gather(*[client.get_object("requirements.txt") for _ in range(5)])
+        assert wrapped.calls == 1
+        assert all(r.status_code == 200 for r in responses)
+        bodies = await asyncio.gather(*[read_response(r) for r in responses])
+        assert all(body == data for body in bodies)
+        assert client.stats['coalesced'] == 4
+
+        # Different ranges are not shared
+        await asyncio.gather(
+            client.get_object("requirements.txt", range_header='bytes=0-9'),
+            client.get_object("requirements.txt", range_header='bytes=10-19'))
+        assert wrapped.calls == 3
+    asyncio.run(run())
+
+
+def test_coalesce_disconnect(data):
+    async def run():
+        client, wrapped = create_client()
+        responses = await asyncio.gather(*[client.get_object("requirements.txt") for _ in range(3)])
+        bodies = await asyncio.gather(
+            read_response(responses[0], disconnect_after=1),
+            read_response(responses[1]),
+            read_response(responses[2]))
+        assert bodies[1] == data
+        assert bodies[2] == data
+    asyncio.run(run())
+
+
+def test_coalesce_head_missing():
+    async def run():
+        client, wrapped = create_client()
+        responses = await asyncio.gather(*[client.head_object("missing") for _ in range(3)])
+        assert wrapped.calls == 1
+        assert all(r.status_code == 404 for r in responses)
+        responses = await asyncio.gather(*[client.get_object("missing") for _ in range(3)])
+        assert wrapped.calls == 2
+        assert all(r.status_code == 404 for r in responses)
+    asyncio.run(run())
+
+
+def test_coalesce_app():
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(
+            name='coalesced',
+            client='file',
+            options={'path':'.', 'coalesce_requests':'true'}
+        )
+    ]
+    app = create_app(settings)
+    with TestClient(app) as client:
+        assert isinstance(app.clients['coalesced'], CoalescingProxyClient)
+        response = client.get("/coalesced/requirements.txt", headers={'Range':'bytes=0-9'})
+        assert response.status_code == 206
+        response = client.get("/coalesced?list-type=2&prefix=tests/")
+        assert response.status_code == 200
+        assert 'test_coalesce.py' in response.text
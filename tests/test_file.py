@@ -1,16 +1,22 @@
+import asyncio
+import os
+import threading
+import time
 import urllib.parse
 
 import pytest
 from fastapi.testclient import TestClient
 from pydantic import HttpUrl
 
+from x2s3 import client_file
 from x2s3.app import create_app
-from x2s3.client_file import STATIC_ETAG
+from x2s3.client_file import STATIC_ETAG, FileStream, FileProxyClient
+from x2s3.etags import EtagIndex
 from x2s3.settings import Target, Settings
-from x2s3.utils import parse_xml
+from x2s3.utils import parse_xml, decode_token
 
 @pytest.fixture
-def get_settings():
+def get_settings(tmp_path):
     settings = Settings()
     settings.base_url = HttpUrl('http://testserver')
     settings.targets = [
@@ -26,6 +32,15 @@ def get_settings():
                 'path':'.', 
                 'calculate_etags':'true'
             }
+        ),
+        Target(
+            name='local-files-with-etag-index',
+            client='file',
+            options={
+                'path':'.', 
+                'calculate_etags':'true',
+                'etag_index_dir':str(tmp_path)
+            }
         )
     ]
     return settings
@@ -48,6 +63,14 @@ def test_get_html_root(app):
                 assert target.name not in response.text
 
 
+def test_browse_bucket(app):
+    with TestClient(app) as client:
+        response = client.get("/local-files/tests/")
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith("text/html")
+        assert 'test_file.py' in response.text
+
+
 def test_list_objects(app):
     with TestClient(app) as client:
         bucket_name = 'local-files'
@@ -79,6 +102,55 @@ def test_list_objects_with_etags(app):
             assert etag!=STATIC_ETAG
 
 
+def test_list_objects_with_etag_index(app):
+    with TestClient(app) as client:
+        def get_etags():
+            response = client.get("/local-files-with-etag-index?list-type=2&prefix=tests/&delimiter=/")
+            assert response.status_code == 200
+            root = parse_xml(response.text)
+            return {c.find('Key').text: c.find('ETag').text for c in root.findall('Contents')}
+
+        # ETags are returned immediately, and then computed in the background
+        etags = get_etags()
+        assert etags
+        for etag in etags.values():
+            assert etag.startswith('"')
+            assert etag != STATIC_ETAG
+
+        for _ in range(50):
+            etags = get_etags()
+            if all('-' in etag for etag in etags.values()):
+                break
+            time.sleep(0.1)
+
+        response = client.get("/local-files-with-etags?list-type=2&prefix=tests/&delimiter=/")
+        root = parse_xml(response.text)
+        expected = {c.find('Key').text: c.find('ETag').text for c in root.findall('Contents')}
+        assert etags == expected
+
+
+def test_etag_index_pending_limit(tmp_path):
+    index = EtagIndex(str(tmp_path / 'etags.db'), workers=1, max_pending=2)
+    computed = []
+    index.compute = lambda path, version: computed.append(path)
+    # Hold the worker, so that nothing leaves the queue
+    release = threading.Event()
+    index.executor.submit(release.wait)
+    try:
+        paths = []
+        for i in range(5):
+            path = tmp_path / f'file{i}'
+            path.write_text(str(i))
+            paths.append(str(path))
+            assert index.get(str(path), os.stat(path)) is None
+        assert len(index.pending) == 2
+    finally:
+        release.set()
+        index.executor.shutdown(wait=True)
+        index.close()
+    assert computed == paths[:2]
+
+
 def test_list_objects_delimiter(app):
     with TestClient(app) as client:
         bucket_name = 'local-files'
@@ -92,6 +164,90 @@ def test_list_objects_delimiter(app):
         assert root.find('IsTruncated').text == "false"
 
 
+def list_pages(client, url):
+    """ Follow the continuation tokens and return every key and common prefix.
+    """
+    keys = []
+    token = None
+    while True:
+        response = client.get(url + (f"&continuation-token={token}" if token else ""))
+        assert response.status_code == 200
+        root = parse_xml(response.text)
+        keys += [c.find('Prefix').text for c in root.findall('CommonPrefixes')]
+        keys += [c.find('Key').text for c in root.findall('Contents')]
+        if root.find('IsTruncated').text != 'true':
+            return keys
+        token = root.find('NextContinuationToken').text
+
+
+def test_list_objects_pagination(app):
+    with TestClient(app) as client:
+        url = "/local-files?list-type=2&prefix=x2s3/"
+        expected = list_pages(client, url)
+        assert len(expected) > 10
+        assert expected == sorted(expected)
+        assert list_pages(client, url + "&max-keys=3") == expected
+
+        url = "/local-files?list-type=2&delimiter=/"
+        expected = list_pages(client, url)
+        assert 'x2s3/' in expected and 'requirements.txt' in expected
+        assert sorted(list_pages(client, url + "&max-keys=2")) == sorted(expected)
+
+        response = client.get("/local-files?list-type=2&continuation-token=%25%25")
+        assert response.status_code == 400
+
+
+def test_list_objects_start_after(app):
+    with TestClient(app) as client:
+        keys = list_pages(client, "/local-files?list-type=2&prefix=x2s3/")
+        start_after = keys[4]
+        response = client.get(f"/local-files?list-type=2&prefix=x2s3/&start-after={start_after}")
+        root = parse_xml(response.text)
+        assert root.find('StartAfter').text == start_after
+        assert [c.find('Key').text for c in root.findall('Contents')] == keys[5:]
+
+
+def test_list_objects_order(tmp_path):
+    # Keys are listed in lexicographic order across directories
+    for name in ['a.txt', 'a/b', 'a/b.txt', 'a-c/d', 'ab', 'b']:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(name)
+    client = FileProxyClient({'target_name':'test'}, path=str(tmp_path))
+    for max_keys in (1, 2, 100):
+        keys = []
+        cursor = None
+        while True:
+            res = client.walk_path('', cursor, None, max_keys)
+            keys += [c.Key for c in res['contents']]
+            if res['is_truncated'] != 'true':
+                break
+            cursor = decode_token(res['next_token'])
+        assert keys == ['a-c/d', 'a.txt', 'a/b', 'a/b.txt', 'ab', 'b']
+
+
+def test_list_objects_invalid_names(tmp_path):
+    # Names which aren't UTF-8 can end a page, and the listing resumes after them
+    try:
+        for name in [b'a\xff', b'b', b'd\xfe/e']:
+            path = os.path.join(os.fsencode(tmp_path), name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('x')
+    except OSError:
+        pytest.skip("The filesystem doesn't allow names which aren't UTF-8")
+    client = FileProxyClient({'target_name':'test'}, path=str(tmp_path))
+    for delimiter, expected in [(None, ['a\udcff', 'b', 'd\udcfe/e']), ('/', ['a\udcff', 'b', 'd\udcfe/'])]:
+        keys = []
+        cursor = None
+        while True:
+            res = client.walk_path('', cursor, delimiter, 1)
+            keys += [c.Key for c in res['contents']] + res['common_prefixes']
+            if res['is_truncated'] != 'true':
+                break
+            cursor = decode_token(res['next_token'])
+        assert keys == expected
+
+
 def test_head_object(app):
     with TestClient(app) as client:
         response = client.head("/local-files/requirements.txt")
@@ -100,6 +256,21 @@ def test_head_object(app):
         assert response.status_code == 404
 
 
+def test_object_etag_not_hashed(app, monkeypatch):
+    def fail_calc_etag(*args):
+        raise AssertionError("Files must not be hashed while a request waits")
+    monkeypatch.setattr(client_file, 'calc_etag', fail_calc_etag)
+    with TestClient(app) as client:
+        expected = client.head("/local-files/requirements.txt").headers['etag']
+        # Without an ETag index, objects get the ETag derived from their stat data
+        response = client.head("/local-files-with-etags/requirements.txt")
+        assert response.status_code == 200
+        assert response.headers['etag'] == expected
+        response = client.get("/local-files-with-etags/requirements.txt")
+        assert response.status_code == 200
+        assert response.headers['etag'] == expected
+
+
 def test_get_object(app):
     with TestClient(app) as client:
         response = client.get("/local-files/requirements.txt")
@@ -115,3 +286,112 @@ def test_get_object_missing(app):
         assert response.headers['content-type'] == "application/xml"
         root = parse_xml(response.text)
         assert root.find('Code').text == 'NoSuchKey'
+
+
+def test_get_object_range(app):
+    with open("requirements.txt", "rb") as f:
+        data = f.read()
+    with TestClient(app) as client:
+        response = client.get("/local-files/requirements.txt", headers={'Range':'bytes=0-9'})
+        assert response.status_code == 206
+        assert response.headers['content-range'] == f"bytes 0-9/{len(data)}"
+        assert response.content == data[:10]
+
+        response = client.get("/local-files/requirements.txt", headers={'Range':'bytes=-7'})
+        assert response.status_code == 206
+        assert response.content == data[-7:]
+
+        response = client.get("/local-files/requirements.txt", headers={'Range':f'bytes={len(data)}-'})
+        assert response.status_code == 416
+        assert response.headers['content-range'] == f"bytes */{len(data)}"
+
+
+def test_get_object_multirange(app):
+    with open("requirements.txt", "rb") as f:
+        data = f.read()
+    with TestClient(app) as client:
+        response = client.get("/local-files/requirements.txt", headers={'Range':'bytes=0-4,10-14'})
+        assert response.status_code == 206
+        content_type = response.headers['content-type']
+        assert content_type.startswith("multipart/byteranges; boundary=")
+        boundary = content_type.split('boundary=')[1]
+        assert int(response.headers['content-length']) == len(response.content)
+        parts = response.content.split(f"--{boundary}".encode())
+        assert len(parts) == 4
+        assert parts[1].endswith(b"\r\n\r\n" + data[0:5] + b"\r\n")
+        assert parts[2].endswith(b"\r\n\r\n" + data[10:15] + b"\r\n")
+        assert parts[3] == b"--\r\n"
+
+
+def test_get_object_if_range(app):
+    with TestClient(app) as client:
+        response = client.head("/local-files/requirements.txt")
+        assert response.headers['accept-ranges'] == 'bytes'
+        last_modified = response.headers['last-modified']
+        response = client.get("/local-files/requirements.txt", 
+            headers={'Range':'bytes=0-9', 'If-Range':last_modified})
+        assert response.status_code == 206
+        response = client.get("/local-files/requirements.txt", 
+            headers={'Range':'bytes=0-9', 'If-Range':'Sat, 01 Jan 2000 00:00:00 GMT'})
+        assert response.status_code == 200
+        assert 'aiobotocore' in response.text
+
+
+def test_get_object_conditional(app):
+    with TestClient(app) as client:
+        response = client.head("/local-files/requirements.txt")
+        etag = response.headers['etag']
+        last_modified = response.headers['last-modified']
+
+        response = client.get("/local-files/requirements.txt", headers={'If-None-Match':etag})
+        assert response.status_code == 304
+        assert response.headers['etag'] == etag
+        assert response.content == b''
+        response = client.head("/local-files/requirements.txt", headers={'If-None-Match':etag})
+        assert response.status_code == 304
+        response = client.get("/local-files/requirements.txt", headers={'If-Modified-Since':last_modified})
+        assert response.status_code == 304
+        response = client.get("/local-files/requirements.txt", 
+            headers={'If-None-Match':'"other"', 'If-Modified-Since':last_modified})
+        assert response.status_code == 200
+        assert 'aiobotocore' in response.text
+
+        response = client.get("/local-files/requirements.txt", headers={'If-Match':etag})
+        assert response.status_code == 200
+        response = client.get("/local-files/requirements.txt", headers={'If-Match':'"other"'})
+        assert response.status_code == 412
+        response = client.get("/local-files/requirements.txt", 
+            headers={'If-Unmodified-Since':'Sat, 01 Jan 2000 00:00:00 GMT'})
+        assert response.status_code == 412
+
+        response = client.get("/local-files/requirements.txt", 
+            headers={'Range':'bytes=0-9', 'If-Range':etag})
+        assert response.status_code == 206
+
+
+def run_file_stream(response, extensions):
+    messages = []
+    async def send(message):
+        messages.append(message)
+    scope = {'type':'http', 'method':'GET', 'extensions':extensions}
+    asyncio.run(response(scope, None, send))
+    return messages
+
+
+def test_file_stream_pathsend():
+    size = os.path.getsize("requirements.txt")
+    response = FileStream("requirements.txt", size)
+    messages = run_file_stream(response, {'http.response.pathsend': {}})
+    assert messages[0]['type'] == 'http.response.start'
+    assert messages[1] == {'type':'http.response.pathsend', 'path':'requirements.txt'}
+
+
+def test_file_stream_zerocopysend():
+    size = os.path.getsize("requirements.txt")
+    response = FileStream("requirements.txt", size, ranges=[(5, 14)], status_code=206)
+    messages = run_file_stream(response, {'http.response.pathsend': {}, 'http.response.zerocopysend': {}})
+    assert messages[0]['status'] == 206
+    assert messages[1]['type'] == 'http.response.zerocopysend'
+    assert messages[1]['offset'] == 5
+    assert messages[1]['count'] == 10
+    assert messages[-1]['more_body'] is False
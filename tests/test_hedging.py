@@ -0,0 +1,108 @@
+import asyncio
+
+from x2s3.hedging import Hedger, LATENCY_MIN_SAMPLES
+
+
+def make_call(delays):
+    """ Returns a call which takes the next of the given delays each time
+        it is made, and returns the index of the attempt.
+    """
+    attempts = []
+
+    async def call():
+        attempt = len(attempts)
+        attempts.append(attempt)
+        await asyncio.sleep(delays[attempt] if attempt < len(delays) else 0)
+        return attempt
+
+    return call, attempts
+
+
+async def warm_up(hedger, op, delay=0.01):
+    for _ in range(LATENCY_MIN_SAMPLES):
+        call, _ = make_call([delay])
+        await hedger.call(op, call)
+
+
+def test_hedge_wins():
+    async def run():
+        hedger = Hedger(percentile=50, budget=1)
+        await warm_up(hedger, 'get')
+        call, attempts = make_call([1, 0])
+        result = await hedger.call('get', call)
+        assert result == 1
+        assert len(attempts) == 2
+        assert hedger.stats['hedged'] == 1
+        assert hedger.stats['hedge_wins'] == 1
+        assert 'get_delay_ms' in hedger.get_stats()
+
+    asyncio.run(run())
+
+
+def test_fast_requests_not_hedged():
+    async def run():
+        hedger = Hedger(percentile=50, budget=1)
+        await warm_up(hedger, 'head', delay=0.05)
+        call, attempts = make_call([0])
+        assert await hedger.call('head', call) == 0
+        assert len(attempts) == 1
+        assert hedger.stats['hedged'] == 0
+
+    asyncio.run(run())
+
+
+def test_first_attempt_wins():
+    async def run():
+        hedger = Hedger(percentile=50, budget=1)
+        await warm_up(hedger, 'get')
+
+        started = asyncio.Event()
+
+        async def call():
+            if not started.is_set():
+                started.set()
+                # The first attempt is slow, but still beats the hedge
+                await asyncio.sleep(0.05)
+                return 'first'
+            await asyncio.sleep(0.1)
+            return 'second'
+
+        result = await hedger.call('get', call)
+        assert result == 'first'
+        assert hedger.stats['hedged'] == 1
+        assert hedger.stats['hedge_wins'] == 0
+
+    asyncio.run(run())
+
+
+def test_failed_attempt_falls_back():
+    async def run():
+        hedger = Hedger(percentile=50, budget=1)
+        await warm_up(hedger, 'list')
+        attempts = []
+
+        async def call():
+            attempts.append(None)
+            if len(attempts) == 1:
+                await asyncio.sleep(0.05)
+                raise ConnectionError()
+            await asyncio.sleep(0.1)
+            return 'ok'
+
+        assert await hedger.call('list', call) == 'ok'
+        assert hedger.stats['hedge_wins'] == 1
+
+    asyncio.run(run())
+
+
+def test_budget():
+    async def run():
+        hedger = Hedger(percentile=50, budget=0.01, burst=1)
+        await warm_up(hedger, 'get')
+        for _ in range(2):
+            call, _ = make_call([0.1, 0])
+            await hedger.call('get', call)
+        assert hedger.stats['hedged'] == 1
+        assert hedger.stats['over_budget'] == 1
+
+    asyncio.run(run())
@@ -0,0 +1,67 @@
+import gzip
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.settings import Target, Settings
+
+FILES = ['a.txt', 'a/b', 'a/c/d', 'a-c/d', 'ab', 'b/0', 'b/1', 'b/2/0', 'c d']
+
+
+@pytest.fixture
+def app(tmp_path):
+    root = tmp_path / 'root'
+    for name in FILES:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(name='files', client='file', options={'path':str(root)}),
+        Target(name='cached', client='file', options={
+            'path':str(root),
+            'cache_control':{'listings':{'max_age':60, 'vary':'Accept'}}
+        })
+    ]
+    return create_app(settings)
+
+
+def test_inventory(app):
+    with TestClient(app) as client:
+        response = client.get("/_inventory/files", headers={'Accept-Encoding': 'identity'})
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        lines = [orjson.loads(line) for line in response.content.splitlines()]
+        assert [line['Key'] for line in lines] == sorted(FILES)
+        assert lines[0]['Size'] == len(lines[0]['Key'])
+        assert lines[0]['ETag'] and lines[0]['LastModified']
+
+        response = client.get("/_inventory/files?prefix=b", headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['content-encoding'] == 'gzip'
+        lines = [orjson.loads(line) for line in response.content.splitlines()]
+        assert [line['Key'] for line in lines] == ['b/0', 'b/1', 'b/2/0']
+
+        with client.stream("GET", "/_inventory/files", headers={'Accept-Encoding': 'gzip'}) as response:
+            data = gzip.decompress(b''.join(response.iter_raw()))
+        assert len(data.splitlines()) == len(FILES)
+
+        assert client.get("/_inventory/files?prefix=zzz").content == b''
+        assert client.get("/_inventory/missing").status_code == 404
+
+
+def test_inventory_encoding(app):
+    with TestClient(app) as client:
+        for accept_encoding, compressed in [('gzip;q=0', False), ('identity, *;q=0.5', True),
+                                            ('br, GZIP;q=0.8', True), ('*, gzip;q=0', False)]:
+            response = client.get("/_inventory/files", headers={'Accept-Encoding': accept_encoding})
+            assert response.status_code == 200
+            assert ('content-encoding' in response.headers) == compressed
+            assert response.headers['vary'] == 'Accept-Encoding'
+
+        # The listing policy's Vary is added to the response's own
+        response = client.get("/_inventory/cached", headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['vary'] == 'Accept-Encoding, Accept'
+        assert response.headers['cache-control'] == 'public, max-age=60'
@@ -0,0 +1,95 @@
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3 import list_json
+from x2s3.app import create_app
+from x2s3.settings import Target, Settings
+from x2s3.utils import parse_xml
+
+FILES = ['a.txt', 'a/b', 'a/c/d', 'a-c/d', 'ab', 'b/0', 'b/1', 'b/2/0', 'c d'] + \
+        [f'many/{i:03}' for i in range(25)]
+
+
+@pytest.fixture
+def app(tmp_path):
+    root = tmp_path / 'root'
+    for name in FILES:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [Target(name='files', client='file', options={'path':str(root)})]
+    return create_app(settings)
+
+
+def get_xml_entries(client, query):
+    root = parse_xml(client.get(f"/files/?list-type=2&{query}").text)
+    entries = {c.findtext('Key'): c for c in root.findall('Contents')}
+    entries.update({c.findtext('Prefix'): None for c in root.findall('CommonPrefixes')})
+    return entries, root
+
+
+@pytest.mark.parametrize("query", ["", "delimiter=/", "prefix=a/&delimiter=/", "prefix=many/",
+                                   "max-keys=3", "start-after=a/b", "encoding-type=url"])
+def test_list_ndjson(app, query, monkeypatch):
+    # Stream several pages from the client
+    monkeypatch.setattr(list_json, 'LIST_JSON_PAGE_SIZE', 4)
+    with TestClient(app) as client:
+        response = client.get(f"/files/?list-type=2&format=ndjson&{query}")
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        lines = [orjson.loads(line) for line in response.text.splitlines()]
+        summary = lines.pop()
+
+        expected, root = get_xml_entries(client, query)
+        keys = [line.get('Key', line.get('Prefix')) for line in lines]
+        assert keys == sorted(expected)
+        assert summary['KeyCount'] == len(keys)
+        assert summary['IsTruncated'] == (root.findtext('IsTruncated') == 'true')
+        assert summary['NextContinuationToken'] == root.findtext('NextContinuationToken')
+        for line in lines:
+            if 'Key' in line:
+                xml = expected[line['Key']]
+                assert line['Size'] == int(xml.findtext('Size'))
+                assert line['ETag'] == xml.findtext('ETag')
+                assert line['LastModified'] == xml.findtext('LastModified')
+
+
+def test_list_json(app, monkeypatch):
+    monkeypatch.setattr(list_json, 'LIST_JSON_PAGE_SIZE', 2)
+    with TestClient(app) as client:
+        response = client.get("/files/?list-type=2&delimiter=/&max-keys=5",
+                headers={'Accept': 'application/json'})
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/json'
+        listing = orjson.loads(response.content)
+        assert listing['Name'] == 'files'
+        assert listing['Delimiter'] == '/'
+        assert listing['MaxKeys'] == 5
+        assert listing['CommonPrefixes'] == ['a-c/', 'a/', 'b/']
+        assert [c['Key'] for c in listing['Contents']] == ['a.txt', 'ab']
+        assert listing['Contents'][0]['Size'] == len('a.txt')
+        assert listing['KeyCount'] == 5
+        assert listing['IsTruncated']
+
+        # Resume from the continuation token, with a page size larger than S3 allows
+        token = listing['NextContinuationToken']
+        response = client.get(f"/files/?list-type=2&delimiter=/&max-keys=5000"
+                f"&format=json&continuation-token={token}")
+        listing = orjson.loads(response.content)
+        assert listing['CommonPrefixes'] == ['many/']
+        assert [c['Key'] for c in listing['Contents']] == ['c d']
+        assert not listing['IsTruncated']
+        assert listing['NextContinuationToken'] is None
+
+        # Empty listings, and errors in the first page
+        listing = orjson.loads(client.get("/files/?list-type=2&format=json&prefix=zzz").content)
+        assert listing['Contents'] == [] and listing['KeyCount'] == 0
+        response = client.get("/files/?list-type=2&format=json&continuation-token=%25")
+        assert response.status_code == 400
+
+        # Other clients still get XML
+        response = client.get("/files/?list-type=2&format=yaml")
+        assert response.headers['content-type'] == 'application/xml'
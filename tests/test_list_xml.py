@@ -0,0 +1,114 @@
+import random
+
+import xml.etree.ElementTree as ET
+
+from x2s3.client import ObjectListing
+from x2s3.utils import get_list_xml, iter_list_xml, ListEntry, LIST_XML_CHUNK_SIZE, \
+    LIST_XML_KEYS, parse_xml, add_elem, add_telem, elem_to_str, get_list_entry, url_encode
+
+NAMES = ['a', 'b/c', 'tab\tand space ', 'amp&<lt>gt', '"quotes\'', 'é', '\U0001F600', 
+         'cr\r\nlf', '%2F+']
+
+
+def get_list_xml_etree(contents, common_prefixes, **kwargs):
+    """ Creates S3-style XML elements for the given object listing, using 
+        ElementTree. This is the reference for the output of get_list_xml.
+    """
+    is_url_encode = kwargs.get('EncodingType')=='url'
+
+    root = ET.Element("ListBucketResult")
+
+    for key in LIST_XML_KEYS:
+        value = kwargs.get(key)
+        if is_url_encode and key in ['Delimiter', 'Prefix', 'Key', 'StartAfter']:
+            value = url_encode(value)
+        add_telem(root, key, value)
+
+    for cp in common_prefixes or ():
+        if is_url_encode:
+            cp = url_encode(cp)
+        common_prefixes_elem = add_elem(root, "CommonPrefixes")
+        add_telem(common_prefixes_elem, "Prefix", cp)
+
+    for obj in contents or ():
+        obj = get_list_entry(obj)
+        key = obj.Key
+        if is_url_encode:
+            key = url_encode(key)
+        contents_elem = add_elem(root, "Contents")
+        add_telem(contents_elem, "Key", key)
+        add_telem(contents_elem, "ETag", obj.ETag)
+        add_telem(contents_elem, "Size", obj.Size)
+        add_telem(contents_elem, "LastModified", obj.LastModified)
+        add_telem(contents_elem, "StorageClass", obj.StorageClass)
+
+    return elem_to_str(root)
+
+
+def random_listing(rng, count):
+    contents = []
+    for i in range(count):
+        key = f"{rng.choice(NAMES)}/{i}"
+        contents.append(ListEntry(key, rng.choice([f'"{i}"', None, '']), 
+                rng.choice([str(i), 0, None]), rng.choice(['2024-01-01T00:00:00.000Z', None]),
+                rng.choice(['STANDARD', None])))
+    common_prefixes = [f"{rng.choice(NAMES)}{i}/" for i in range(rng.randrange(5))]
+    kwargs = {
+        'Name': 'bucket&name',
+        'Prefix': rng.choice(['', None, 'a<b/']),
+        'Delimiter': rng.choice(['/', None]),
+        'MaxKeys': rng.choice([1000, 0]),
+        'EncodingType': rng.choice([None, 'url']),
+        'KeyCount': len(contents) + len(common_prefixes),
+        'IsTruncated': rng.choice(['true', 'false']),
+        'ContinuationToken': rng.choice([None, 'abc=']),
+        'NextContinuationToken': rng.choice([None, 'def=']),
+        'StartAfter': rng.choice([None, 'a b'])
+    }
+    return contents, common_prefixes, kwargs
+
+
+def test_list_xml_identical():
+    rng = random.Random(42)
+    for count in [0, 1, 10, LIST_XML_CHUNK_SIZE + 10]:
+        for _ in range(20):
+            contents, common_prefixes, kwargs = random_listing(rng, count)
+            expected = get_list_xml_etree(contents, common_prefixes, **kwargs)
+            assert get_list_xml(contents, common_prefixes, **kwargs) == expected
+            # Dicts and generators of entries are also accepted
+            dicts = [entry._asdict() for entry in contents]
+            assert get_list_xml(iter(dicts), common_prefixes, **kwargs) == expected
+
+
+def test_list_xml_special():
+    assert get_list_xml([], []) == get_list_xml_etree([], [])
+    assert get_list_xml([ListEntry('', None, None, None, None)], ['']) == \
+        get_list_xml_etree([ListEntry('', None, None, None, None)], [''])
+
+
+def test_list_xml_chunks():
+    contents = [ListEntry(f"key{i}", '"etag"', '1', None, None) for i in range(3 * LIST_XML_CHUNK_SIZE)]
+    chunks = list(iter_list_xml(iter(contents), [], Name='bucket'))
+    assert len(chunks) > 2
+    assert b''.join(chunks) == get_list_xml_etree(contents, [], Name='bucket')
+
+
+def test_list_xml_surrogates():
+    # Undecodable file names are written as character references
+    contents = [ListEntry('lone\udcff', None, None, None, None)]
+    assert get_list_xml(contents, []) == get_list_xml_etree(contents, [])
+
+
+def test_object_listing_xml():
+    contents = [ListEntry(f"a&b/{i}", f'"{i}"', i, '2024-01-01T00:00:00.000Z', 'STANDARD')
+            for i in range(10)]
+    listing = ObjectListing(contents, ['c/', 'é/'], is_truncated=True, next_token='abc',
+            Name='bucket', Prefix='', Delimiter='/', MaxKeys=12)
+    xml = listing.get_xml()
+    root = parse_xml(xml)
+    assert root.findtext('KeyCount') == '12'
+    assert root.findtext('IsTruncated') == 'true'
+    assert root.findtext('NextContinuationToken') == 'abc'
+    # Listings can be recovered from their XML, for clients which only implement list_objects_v2
+    parsed = ObjectListing.from_xml(xml)
+    assert parsed.get_xml() == xml
@@ -0,0 +1,157 @@
+import asyncio
+import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.client import ObjectListing
+from x2s3.client_aioboto import AiobotoProxyClient
+from x2s3.listing_cache import ListingCacheProxyClient
+from x2s3.settings import Target, Settings
+from x2s3.utils import parse_xml
+
+FILES = [f'many/{i:03}' for i in range(10)] + ['other/a']
+
+
+@pytest.fixture
+def app(tmp_path):
+    root = tmp_path / 'root'
+    for name in FILES:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.metrics = True
+    settings.targets = [
+        Target(
+            name='files',
+            client='file',
+            options={
+                'path':str(root),
+                'listing_cache_ttl':'60'
+            }
+        )
+    ]
+    return create_app(settings)
+
+
+def count_calls(cache):
+    calls = []
+    list_objects = cache.wrapped.list_objects
+    async def counting_list_objects(*args):
+        calls.append(args)
+        return await list_objects(*args)
+    cache.wrapped.list_objects = counting_list_objects
+    return calls
+
+
+def get_keys(response):
+    root = parse_xml(response.text)
+    return [c.findtext('Key') for c in root.findall('Contents')], \
+            root.findtext('NextContinuationToken')
+
+
+def test_listing_hits(app):
+    with TestClient(app) as client:
+        cache = app.clients['files']
+        calls = count_calls(cache)
+        response = client.get("/files/?list-type=2&prefix=other/")
+        assert response.status_code == 200
+        for _ in range(3):
+            response = client.get("/files/?list-type=2&prefix=other/")
+            assert get_keys(response)[0] == ['other/a']
+        assert len(calls) == 1
+        assert cache.stats['misses'] == 1
+        assert cache.stats['hits'] == 3
+
+        # Different parameters are different pages
+        response = client.get("/files/?list-type=2&prefix=other/&encoding-type=url")
+        assert response.status_code == 200
+        assert len(calls) == 2
+
+        # Expired and invalidated pages are listed again
+        for page in cache.pages.values():
+            page.expires = 0
+        client.get("/files/?list-type=2&prefix=other/")
+        assert len(calls) == 3
+        cache.invalidate(prefix='other/')
+        client.get("/files/?list-type=2&prefix=other/")
+        assert len(calls) == 4
+
+
+def test_next_page_prefetch(app):
+    with TestClient(app) as client:
+        cache = app.clients['files']
+        calls = count_calls(cache)
+        keys = []
+        token = None
+        query = "/files/?list-type=2&prefix=many/&max-keys=4"
+        while True:
+            response = client.get(query + (f"&continuation-token={token}" if token else ""))
+            assert response.status_code == 200
+            page, token = get_keys(response)
+            keys.extend(page)
+            if not token:
+                break
+        assert keys == FILES[:10]
+        # Only the first page waited for the client, the rest were prefetched
+        assert cache.stats['misses'] == 1
+        assert cache.stats['prefetches'] == 2
+        assert cache.stats['hits'] + cache.stats['prefetch_hits'] == 2
+        assert len(calls) == 3
+
+
+def test_errors_not_cached(app):
+    with TestClient(app) as client:
+        cache = app.clients['files']
+        for _ in range(2):
+            response = client.get("/files/?list-type=2&continuation-token=%25")
+            assert response.status_code == 400
+        assert cache.stats['misses'] == 2
+        assert not cache.pages
+
+
+class FakeS3Client:
+    """ Answers ListObjectsV2 for keys 0-9, validating MaxKeys as botocore does.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def list_objects_v2(self, Bucket, MaxKeys, ContinuationToken=None, **kwargs):
+        assert isinstance(MaxKeys, int)
+        self.calls.append(ContinuationToken)
+        start = int(ContinuationToken or 0)
+        keys = [str(i) for i in range(start, min(start + MaxKeys, 10))]
+        response = {
+            'Contents': [{'Key': key, 'ETag': '"etag"', 'Size': 1,
+                          'LastModified': datetime.datetime(2024, 1, 1)} for key in keys],
+            'IsTruncated': start + MaxKeys < 10
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+
+def test_s3_listing_cache():
+    async def run():
+        client = AiobotoProxyClient({'target_name': 's3'}, bucket='bucket')
+        s3 = FakeS3Client()
+        async def get_client():
+            return s3
+        client.get_client = get_client
+        cache = ListingCacheProxyClient(client, {'target_name': 's3'}, listing_cache_ttl=60)
+
+        listing = await cache.list_objects(None, None, None, None, '4', '', None)
+        assert isinstance(listing, ObjectListing)
+        assert [obj.Key for obj in listing.contents] == ['0', '1', '2', '3']
+        # The next page is prefetched, with the same page size
+        listing = await cache.list_objects(listing.next_token, None, None, None, 4, '', None)
+        assert [obj.Key for obj in listing.contents] == ['4', '5', '6', '7']
+        await asyncio.sleep(0.01)
+        assert s3.calls == [None, '4', '8']
+        assert cache.stats['misses'] == 1
+        await cache.shutdown()
+    asyncio.run(run())
@@ -0,0 +1,202 @@
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3 import listing_index
+from x2s3.app import create_app
+from x2s3.client_file import FileProxyClient
+from x2s3.listing_index import ListingIndex
+from x2s3.settings import Target, Settings
+from x2s3.utils import parse_xml
+
+FILES = ['a.txt', 'a/b', 'a/c/d', 'a-c/d', 'ab', 'b/0', 'b/1', 'b/2/0']
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'root'
+    for name in FILES:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    return root
+
+
+@pytest.fixture
+def index(tree, tmp_path):
+    index = ListingIndex(str(tree), str(tmp_path / 'listing.db'), watch=False)
+    index.rescan()
+    yield index
+    index.close()
+
+
+def list_keys(index, prefix='', cursor=None, delimiter=None, max_keys=1000):
+    entries, _ = index.list(prefix, cursor, delimiter, max_keys)
+    return [key for key, _ in entries]
+
+
+def test_index_list(index):
+    assert list_keys(index) == sorted(FILES)
+    assert list_keys(index, delimiter='/') == ['a-c/', 'a.txt', 'a/', 'ab', 'b/']
+    assert list_keys(index, prefix='a/', delimiter='/') == ['a/b', 'a/c/']
+    assert list_keys(index, prefix='b/') == ['b/0', 'b/1', 'b/2/0']
+    assert list_keys(index, cursor='a/b') == ['a/c/d', 'ab', 'b/0', 'b/1', 'b/2/0']
+    # A cursor at a common prefix skips the keys beneath it
+    assert list_keys(index, cursor='a/', delimiter='/') == ['ab', 'b/']
+
+    entries, is_truncated = index.list('', None, '/', 2)
+    assert [key for key, _ in entries] == ['a-c/', 'a.txt']
+    assert is_truncated
+    assert entries[0][1] is None
+    assert entries[1][1].st_size == len('a.txt')
+
+    assert index.get('a/c/d').st_size == len('a/c/d')
+    assert index.get('a/c') is None
+
+
+def test_index_update(index, tree):
+    (tree / 'new').write_text('new')
+    os.remove(tree / 'ab')
+    index.rescan()
+    assert 'new' in list_keys(index)
+    assert 'ab' not in list_keys(index)
+
+    (tree / 'b' / '3').write_text('3')
+    index.update_path(str(tree / 'b' / '3'))
+    assert index.get('b/3') is not None
+
+    os.rename(tree / 'a', tree / 'z')
+    index.update_path(str(tree / 'a'))
+    index.update_path(str(tree / 'z'))
+    assert list_keys(index, prefix='a/') == []
+    assert list_keys(index, prefix='z/') == ['z/b', 'z/c/d']
+
+
+def test_index_reused(index, tree, tmp_path):
+    index2 = ListingIndex(str(tree), str(tmp_path / 'listing.db'), watch=False)
+    try:
+        assert index2.ready
+        assert list_keys(index2) == sorted(FILES)
+    finally:
+        index2.close()
+
+
+def test_index_skips_invalid_names(tree, tmp_path):
+    try:
+        with open(os.path.join(os.fsencode(tree), b'bad\xff'), 'w') as f:
+            f.write('bad')
+    except OSError:
+        pytest.skip("The filesystem doesn't allow names which aren't UTF-8")
+    index = ListingIndex(str(tree), str(tmp_path / 'listing.db'), watch=False)
+    try:
+        index.rescan()
+        assert index.ready
+        assert list_keys(index) == sorted(FILES)
+        index.update_path(os.path.join(str(tree), os.fsdecode(b'bad\xff')))
+        assert list_keys(index) == sorted(FILES)
+    finally:
+        index.close()
+
+
+def test_index_single_writer(tree, tmp_path, monkeypatch):
+    monkeypatch.setattr(listing_index, 'WRITER_POLL_INTERVAL', 0.05)
+    db_path = str(tmp_path / 'listing.db')
+    writer = ListingIndex(str(tree), db_path, watch=False)
+    reader = ListingIndex(str(tree), db_path, watch=False)
+    try:
+        writer.start()
+        reader.start()
+        assert writer.writer and not reader.writer
+        for _ in range(50):
+            if reader.ready:
+                break
+            time.sleep(0.1)
+        assert reader.ready
+        assert reader.stats['rescans'] == 0
+        assert list_keys(reader) == sorted(FILES)
+
+        # The reader takes over once the writer is gone
+        writer.close()
+        for _ in range(50):
+            if reader.writer:
+                break
+            time.sleep(0.1)
+        assert reader.writer
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_symlink_cycles(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'a' / 'sub').mkdir(parents=True)
+    (root / 'a' / 'x').write_text('x')
+    (root / 'a' / 'sub' / 'y').write_text('y')
+    # A link back to an ancestor isn't followed, but other links are
+    os.symlink('..', root / 'a' / 'sub' / 'loop')
+    os.symlink('a/sub', root / 'c')
+    expected = ['a/sub/y', 'a/x', 'c/loop/x', 'c/y']
+
+    client = FileProxyClient({'target_name':'test'}, path=str(root))
+    res = client.walk_path('', None, None, 1000)
+    assert [c.Key for c in res['contents']] == expected
+    res = client.walk_path('', 'c/loop/x', None, 1000)
+    assert [c.Key for c in res['contents']] == ['c/y']
+
+    index = ListingIndex(str(root), str(tmp_path / 'listing.db'), watch=False)
+    try:
+        index.rescan()
+        assert list_keys(index) == expected
+    finally:
+        index.close()
+
+
+@pytest.fixture
+def get_settings(tree, tmp_path):
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(
+            name='walked',
+            client='file',
+            options={'path':str(tree)}
+        ),
+        Target(
+            name='indexed',
+            client='file',
+            options={'path':str(tree), 'listing_index_dir':str(tmp_path / 'index')}
+        )
+    ]
+    return settings
+
+
+def test_indexed_target(get_settings, tree):
+    app = create_app(get_settings)
+    with TestClient(app) as client:
+        for _ in range(50):
+            if app.clients['indexed'].get_stats()['listing_index']['ready']:
+                break
+            time.sleep(0.1)
+
+        for query in ["list-type=2", "list-type=2&delimiter=/", "list-type=2&prefix=a/&delimiter=/",
+                      "list-type=2&max-keys=3", "list-type=2&start-after=a/b"]:
+            walked = client.get(f"/walked/?{query}")
+            indexed = client.get(f"/indexed/?{query}")
+            assert indexed.status_code == 200
+            assert indexed.text.replace('indexed', 'walked') == walked.text
+
+        response = client.head("/indexed/a/c/d")
+        assert response.status_code == 200
+        assert response.headers['etag'] == client.head("/walked/a/c/d").headers['etag']
+
+        # New files are picked up by watching the filesystem
+        (tree / 'watched').write_text('watched')
+        for _ in range(100):
+            root = parse_xml(client.get("/indexed/?list-type=2&delimiter=/").text)
+            keys = [c.find('Key').text for c in root.findall('Contents')]
+            if 'watched' in keys:
+                break
+            time.sleep(0.1)
+        assert 'watched' in keys
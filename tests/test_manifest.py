@@ -0,0 +1,100 @@
+import os
+import sys
+import subprocess
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.etags import calc_etag, ETAG_PART_SIZE
+from x2s3.manifest import Manifest, write_manifest
+from x2s3.settings import Target, Settings
+from x2s3.utils import parse_xml
+
+FILES = ['a.txt', 'a/b', 'a/c/d', 'a-c/d', 'ab', 'b/0', 'b/1', 'b/2/0', 'é']
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'root'
+    for name in FILES:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    return root
+
+
+@pytest.fixture
+def manifest(tree, tmp_path):
+    path = str(tmp_path / 'manifest.tsv')
+    assert write_manifest(str(tree), path) == len(FILES)
+    manifest = Manifest(path)
+    yield manifest
+    manifest.close()
+
+
+def list_keys(manifest, prefix='', cursor=None, delimiter=None, max_keys=1000):
+    entries, _ = manifest.list(prefix, cursor, delimiter, max_keys)
+    return [key for key, _ in entries]
+
+
+def test_manifest_list(manifest):
+    keys = sorted(FILES)
+    assert list_keys(manifest) == keys
+    for i, key in enumerate(keys):
+        assert list_keys(manifest, cursor=key) == keys[i+1:]
+        assert manifest.get(key).st_size == len(key.encode())
+    assert manifest.get('a') is None
+    assert manifest.get('zzz') is None
+    assert manifest.get('') is None
+
+    assert list_keys(manifest, delimiter='/') == ['a-c/', 'a.txt', 'a/', 'ab', 'b/', 'é']
+    assert list_keys(manifest, prefix='a/', delimiter='/') == ['a/b', 'a/c/']
+    assert list_keys(manifest, cursor='a/', delimiter='/') == ['ab', 'b/', 'é']
+
+    entries, is_truncated = manifest.list('b/', None, None, 2)
+    assert [key for key, _ in entries] == ['b/0', 'b/1']
+    assert is_truncated
+
+
+def test_manifest_cli(tree, tmp_path):
+    path = str(tmp_path / 'cli.tsv')
+    subprocess.run([sys.executable, '-m', 'x2s3.manifest', str(tree), path, '--calculate-etags'],
+            check=True)
+    manifest = Manifest(path)
+    try:
+        assert manifest.get('a/b').etag == f'"{calc_etag(tree / "a/b", ETAG_PART_SIZE)}"'
+    finally:
+        manifest.close()
+
+
+def test_manifest_target(manifest, tree):
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(name='walked', client='file', options={'path':str(tree)}),
+        Target(name='frozen', client='file', options={'path':str(tree), 'manifest':manifest.path})
+    ]
+    app = create_app(settings)
+    with TestClient(app) as client:
+        for query in ["list-type=2", "list-type=2&delimiter=/", "list-type=2&prefix=a/&delimiter=/",
+                      "list-type=2&max-keys=3"]:
+            walked = parse_xml(client.get(f"/walked/?{query}").text)
+            frozen = parse_xml(client.get(f"/frozen/?{query}").text)
+            for tag in ['Contents/Key', 'Contents/Size', 'CommonPrefixes/Prefix', 'IsTruncated']:
+                assert [e.text for e in frozen.findall(tag)] == [e.text for e in walked.findall(tag)]
+
+        response = client.get("/frozen/a/c/d")
+        assert response.status_code == 200
+        assert response.text == 'a/c/d'
+        assert response.headers['etag'] == client.head("/walked/a/c/d").headers['etag']
+
+        lines = client.get("/_inventory/frozen").content.splitlines()
+        assert [orjson.loads(line)['Key'] for line in lines] == sorted(FILES)
+
+        # Metadata comes from the manifest, not the filesystem
+        (tree / 'new').write_text('new')
+        assert client.head("/frozen/new").status_code == 404
+        os.remove(tree / 'ab')
+        assert client.head("/frozen/ab").status_code == 200
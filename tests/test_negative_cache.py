@@ -0,0 +1,88 @@
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.settings import Target, Settings
+from x2s3.utils import parse_xml
+
+
+@pytest.fixture
+def get_settings():
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.metrics = True
+    settings.targets = [
+        Target(
+            name='local-files',
+            client='file',
+            options={
+                'path':'.',
+                'negative_cache_ttl':'60'
+            }
+        )
+    ]
+    return settings
+
+
+@pytest.fixture
+def app(get_settings):
+    return create_app(get_settings)
+
+
+def test_missing_key(app):
+    with TestClient(app) as client:
+        cache = app.clients['local-files']
+        response = client.get("/local-files/missing")
+        assert response.status_code == 404
+        assert cache.stats['stored'] == 1
+        assert cache.stats['misses'] == 1
+
+        for _ in range(3):
+            response = client.head("/local-files/missing")
+            assert response.status_code == 404
+            response = client.get("/local-files/missing")
+            assert response.status_code == 404
+            root = parse_xml(response.text)
+            assert root.find('Code').text == 'NoSuchKey'
+        assert cache.stats['hits'] == 6
+        assert cache.stats['misses'] == 1
+
+        cache.invalidate(key="missing")
+        response = client.get("/local-files/missing")
+        assert response.status_code == 404
+        assert cache.stats['misses'] == 2
+
+
+def test_listing_proves_absence(app):
+    with TestClient(app) as client:
+        cache = app.clients['local-files']
+        response = client.get("/local-files?list-type=2&prefix=tests/&delimiter=/")
+        assert response.status_code == 200
+
+        response = client.get("/local-files/tests/missing.py")
+        assert response.status_code == 404
+        response = client.get("/local-files/tests/missing/chunk")
+        assert response.status_code == 404
+        assert cache.stats['hits'] == 2
+        assert cache.stats['misses'] == 0
+
+        # Listed keys are still fetched
+        response = client.get("/local-files/tests/test_negative_cache.py")
+        assert response.status_code == 200
+
+        cache.invalidate(prefix="tests/")
+        response = client.get("/local-files/tests/missing.py")
+        assert response.status_code == 404
+        assert cache.stats['misses'] == 2
+
+
+def test_metrics(app):
+    with TestClient(app) as client:
+        client.get("/local-files/missing")
+        client.get("/local-files/missing")
+        response = client.get("/_metrics")
+        assert response.status_code == 200
+        stats = response.json()['local-files']['negative_cache']
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
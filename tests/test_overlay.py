@@ -0,0 +1,120 @@
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import HttpUrl
+
+from x2s3.app import create_app
+from x2s3.settings import Target, Settings
+from x2s3.utils import parse_xml
+
+
+@pytest.fixture
+def layers(tmp_path):
+    hot = tmp_path / 'hot'
+    full = tmp_path / 'full'
+    for path, content in [
+            (hot / 'a.txt', 'hot a'),
+            (hot / 'data' / 's0' / '1', 'hot chunk'),
+            (full / 'a.txt', 'full a'),
+            (full / 'b.txt', 'full b'),
+            (full / 'data' / 'attributes.json', '{}'),
+            (full / 'data' / 's0' / '0', 'full chunk'),
+            (full / 'data' / 's0' / '1', 'full chunk'),
+            (full / 'data' / 's1' / '0', 'full chunk'),
+            (full / 'z' / '0', 'full z')]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return hot, full
+
+
+@pytest.fixture
+def get_settings(layers):
+    hot, full = layers
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(
+            name='overlay',
+            client='overlay',
+            options={
+                'layers': [
+                    {'name':'hot', 'client':'file', 'options':{'path':str(hot)}},
+                    {'name':'full', 'client':'file', 'options':{'path':str(full)}}
+                ]
+            }
+        )
+    ]
+    return settings
+
+
+@pytest.fixture
+def app(get_settings):
+    return create_app(get_settings)
+
+
+def list_all(client, params):
+    """ Follow the continuation tokens and return every key and common prefix.
+    """
+    keys, prefixes = [], []
+    token = None
+    while True:
+        page_params = dict(params)
+        if token:
+            page_params['continuation-token'] = token
+        response = client.get("/overlay/", params=page_params)
+        assert response.status_code == 200
+        root = parse_xml(response.text)
+        keys += [c.findtext('Key') for c in root.findall('Contents')]
+        prefixes += [c.findtext('Prefix') for c in root.findall('CommonPrefixes')]
+        if root.findtext('IsTruncated') != 'true':
+            return keys, prefixes
+        token = root.findtext('NextContinuationToken')
+
+
+def test_overlay_get_object(app):
+    with TestClient(app) as client:
+        response = client.get("/overlay/a.txt")
+        assert response.status_code == 200
+        assert response.text == 'hot a'
+
+        response = client.get("/overlay/b.txt")
+        assert response.status_code == 200
+        assert response.text == 'full b'
+
+        response = client.head("/overlay/data/s0/0")
+        assert response.status_code == 200
+
+        response = client.get("/overlay/missing")
+        assert response.status_code == 404
+
+        stats = app.clients['overlay'].get_stats()['overlay']
+        assert stats['hot']['hits'] == 1
+        assert stats['full']['hits'] == 2
+
+
+def test_overlay_list_objects(app):
+    with TestClient(app) as client:
+        expected = ['a.txt', 'b.txt', 'data/attributes.json', 
+                    'data/s0/0', 'data/s0/1', 'data/s1/0', 'z/0']
+        for max_keys in (1, 2, 3, 1000):
+            keys, prefixes = list_all(client, {'list-type':2, 'max-keys':max_keys})
+            assert keys == expected
+            assert prefixes == []
+
+
+def test_overlay_list_objects_delimiter(app):
+    with TestClient(app) as client:
+        for max_keys in (1, 2, 1000):
+            keys, prefixes = list_all(client, {'list-type':2, 'max-keys':max_keys, 'delimiter':'/'})
+            assert keys == ['a.txt', 'b.txt']
+            assert prefixes == ['data/', 'z/']
+
+            keys, prefixes = list_all(client, 
+                {'list-type':2, 'max-keys':max_keys, 'delimiter':'/', 'prefix':'data/'})
+            assert keys == ['data/attributes.json']
+            assert prefixes == ['data/s0/', 'data/s1/']
+
+
+def test_overlay_invalid_token(app):
+    with TestClient(app) as client:
+        response = client.get("/overlay/?list-type=2&continuation-token=%25%25%25")
+        assert response.status_code == 400
@@ -0,0 +1,206 @@
+import asyncio
+import bisect
+import random
+
+import pytest
+from fastapi.responses import JSONResponse
+
+from x2s3.client import ProxyClient, ObjectListing
+from x2s3.partitioned_listing import PartitionedLister, encode_partition_token, \
+    decode_partition_token
+from x2s3.utils import ListEntry, list_sorted, encode_token, decode_token
+
+FILES = ['a.txt', 'a/b', 'a/c/d', 'a-c/d', 'ab', 'b/0', 'b/1', 'b/2/0', 'c d']
+
+
+class MemoryProxyClient(ProxyClient):
+    """ Client for an in-memory bucket, which records the listings in flight.
+    """
+
+    def __init__(self, keys, fail_prefix=None):
+        self.keys = sorted(keys)
+        self.fail_prefix = fail_prefix
+        self.active = 0
+        self.max_active = 0
+        self.calls = 0
+
+    def seek(self, key, inclusive=True):
+        i = (bisect.bisect_left if inclusive else bisect.bisect_right)(self.keys, key)
+        for key in self.keys[i:]:
+            yield key, ListEntry(key, '"etag"', len(key), '2024-01-01T00:00:00.000Z', 'STANDARD')
+
+    async def list_objects(self, continuation_token, delimiter, encoding_type, fetch_owner,
+                           max_keys, prefix, start_after):
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        if self.fail_prefix and prefix.startswith(self.fail_prefix):
+            return JSONResponse({"error":"Upstream endpoint timed out"}, status_code=408)
+        self.calls += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.001)
+        finally:
+            self.active -= 1
+        def seek(key, inclusive):
+            # StartAfter compares keys, unlike a token after a common prefix
+            if start_after and (key < start_after or (key == start_after and inclusive)):
+                key, inclusive = start_after, False
+            return self.seek(key, inclusive)
+
+        cursor = decode_token(continuation_token) if continuation_token else None
+        entries, is_truncated = list_sorted(seek, prefix or '', cursor, delimiter, int(max_keys))
+        return ObjectListing([obj for _, obj in entries if obj is not None],
+                [key for key, obj in entries if obj is None], is_truncated=is_truncated,
+                next_token=encode_token(entries[-1][0]) if entries else None)
+
+
+def zarr_keys():
+    keys = ['img.zarr/.zattrs', 'img.zarr/.zgroup']
+    for level in range(3):
+        keys.append(f'img.zarr/{level}/.zarray')
+        for z in range(4):
+            for y in range(5):
+                keys += [f'img.zarr/{level}/{z}/{y}/{x}' for x in range(6)]
+    return keys
+
+
+async def collect(batches):
+    keys = []
+    async for batch in batches:
+        assert isinstance(batch, list)
+        keys += [obj.Key for obj in batch]
+    return keys
+
+
+@pytest.mark.parametrize("keys", [FILES, zarr_keys(), [f'{i:04}' for i in range(50)], []])
+def test_partitioned_lister(keys):
+    async def run():
+        client = MemoryProxyClient(keys)
+        lister = PartitionedLister(client, 4, page_size=7)
+        assert await collect(lister.iter_objects('')) == sorted(keys)
+        assert client.max_active <= 4
+        if keys and keys[0].startswith('img.zarr/'):
+            assert client.max_active > 1
+        prefix_keys = [k for k in sorted(keys) if k.startswith('img.zarr/1/')]
+        assert await collect(lister.iter_objects('img.zarr/1')) == prefix_keys
+
+        # The default implementation is sequential, but lists the same objects
+        assert await collect(client.iter_objects('')) == sorted(keys)
+    asyncio.run(run())
+
+
+def test_partitioned_lister_errors():
+    async def run():
+        client = MemoryProxyClient(zarr_keys(), fail_prefix='img.zarr/1/')
+        lister = PartitionedLister(client, 4, page_size=7)
+        keys = []
+        async for batch in lister.iter_objects(''):
+            if not isinstance(batch, list):
+                assert batch.status_code == 408
+                break
+            keys += [obj.Key for obj in batch]
+        else:
+            assert False, "Error was not yielded"
+        assert all(key < 'img.zarr/1/' for key in keys)
+
+        # Stopping early cancels the partitions which were listed ahead
+        client = MemoryProxyClient(zarr_keys())
+        batches = lister.iter_objects('')
+        lister.client = client
+        await batches.__anext__()
+        await batches.aclose()
+        await asyncio.sleep(0.05)
+        calls = client.calls
+        await asyncio.sleep(0.05)
+        assert client.calls == calls
+        assert client.active == 0
+        assert not [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    asyncio.run(run())
+
+
+def random_keys(rng):
+    keys = set()
+    for _ in range(rng.randrange(1, 300)):
+        depth = rng.randrange(1, 5)
+        parts = [rng.choice(['a', 'b', 'a-c', 'a.b', 'é', 'z' * rng.randrange(1, 3)]) 
+                for _ in range(depth)]
+        key = '/'.join(parts)
+        if rng.random() < 0.05:
+            key += '/'
+        keys.add(key)
+    # A key can't also be the parent of another key on a filesystem, but it can in S3
+    return sorted(keys)
+
+
+def many_prefixes():
+    return [f'dir{i:04}/{j}' for i in range(200) for j in range(2)] + ['dir0050.txt', 'top']
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_partitioned_lister_resume(seed):
+    rng = random.Random(seed)
+    keys = sorted(many_prefixes() if seed == 0 else zarr_keys() if seed == 1 else random_keys(rng))
+    async def run():
+        client = MemoryProxyClient(keys)
+        lister = PartitionedLister(client, rng.choice([2, 4, 8]), page_size=rng.choice([3, 7, 50]))
+        assert await collect(lister.iter_objects('')) == keys
+        cursors = rng.sample(keys, min(len(keys), 20)) + ['a', 'a/', 'b/', 'dir0100/', 'é/']
+        for cursor in cursors:
+            assert await collect(lister.iter_objects('', cursor)) == [k for k in keys if k > cursor]
+
+        # Paging through the listing with tokens which resume after the last key
+        listed = []
+        cursor = None
+        while True:
+            contents, is_truncated = await lister.list('', cursor, 25)
+            listed += [obj.Key for obj in contents]
+            if not is_truncated:
+                break
+            cursor = decode_partition_token(encode_partition_token(contents[-1].Key))
+        assert listed == keys
+    asyncio.run(run())
+
+
+def test_partitioned_lister_groups():
+    async def run():
+        # Many small sub-prefixes are listed in ranges, rather than one at a time
+        client = MemoryProxyClient(many_prefixes())
+        lister = PartitionedLister(client, 8, page_size=1000)
+        assert await collect(lister.iter_objects('')) == sorted(many_prefixes())
+        assert client.calls < 20
+        assert client.max_active > 1
+    asyncio.run(run())
+
+
+def test_partitioned_lister_concurrency():
+    async def run():
+        # Sub-partitions are split again at each depth, but the partitions
+        # running at all depths are capped, and so are the requests of 
+        # listings which share a semaphore
+        keys = [f'{a}/{b}/{c}/{d}' for a in range(3) for b in range(3) 
+                for c in range(3) for d in range(3)]
+        client = MemoryProxyClient(keys)
+        semaphore = asyncio.Semaphore(4)
+        listers = [PartitionedLister(client, 4, page_size=2, semaphore=semaphore) for _ in range(2)]
+        max_running = 0
+        for lister in listers:
+            start_partition = lister.start_partition
+            def counting_start_partition(partition, lister=lister, start_partition=start_partition):
+                nonlocal max_running
+                start_partition(partition)
+                max_running = max(max_running, len(lister.running))
+            lister.start_partition = counting_start_partition
+
+        results = await asyncio.gather(*[collect(lister.iter_objects('')) for lister in listers])
+        assert results == [sorted(keys)] * 2
+        assert max_running <= 4 + listers[0].max_depth
+        assert 1 < client.max_active <= 4
+    asyncio.run(run())
+
+
+def test_partition_tokens():
+    assert decode_partition_token(encode_partition_token('a/b')) == 'a/b'
+    assert decode_partition_token(encode_token('a/b')) is None
+    assert decode_partition_token('1ueGcxLPRx1Tr/XYExHnhbYLgveDs2J/wm36Hy4vbOwM=') is None
+    assert decode_partition_token('~%%%') is None
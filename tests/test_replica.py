@@ -0,0 +1,92 @@
+import pytest
+from fastapi.testclient import TestClient
+from fastapi.responses import JSONResponse
+from pydantic import HttpUrl
+
+from x2s3 import registry
+from x2s3.app import create_app
+from x2s3.client import ProxyClient
+from x2s3.settings import Target, Settings
+from x2s3.utils import parse_xml
+
+
+class FailingProxyClient(ProxyClient):
+    """ Client for a replica whose endpoint is down.
+    """
+
+    def __init__(self, proxy_kwargs, **kwargs):
+        pass
+
+    async def head_object(self, key, conditions=None):
+        return JSONResponse({"error":"Upstream endpoint timed out"}, status_code=408)
+
+    async def get_object(self, key, range_header=None, if_range=None, conditions=None):
+        return JSONResponse({"error":"Upstream endpoint timed out"}, status_code=408)
+
+    async def list_objects_v2(self, *args):
+        return JSONResponse({"error":"Upstream endpoint timed out"}, status_code=408)
+
+
+registry.register_implementation('failing', FailingProxyClient, clobber=True)
+
+
+@pytest.fixture
+def get_settings():
+    settings = Settings()
+    settings.base_url = HttpUrl('http://testserver')
+    settings.targets = [
+        Target(
+            name='replicated',
+            client='replica',
+            options={
+                'replica_explore': 0,
+                'replicas': [
+                    {'name':'down', 'client':'failing'},
+                    {'name':'local', 'client':'file', 'options':{'path':'.'}}
+                ]
+            }
+        )
+    ]
+    return settings
+
+
+@pytest.fixture
+def app(get_settings):
+    return create_app(get_settings)
+
+
+def test_replica_failover(app):
+    with TestClient(app) as client:
+        response = client.get("/replicated/requirements.txt")
+        assert response.status_code == 200
+        assert 'aiobotocore' in response.text
+
+        stats = app.clients['replicated'].get_stats()['replica']
+        assert stats['failovers'] == 1
+        assert stats['replicas']['down']['healthy'] == False
+        assert stats['replicas']['local']['requests'] == 1
+
+        # The failed replica is avoided until it cools down
+        response = client.head("/replicated/requirements.txt")
+        assert response.status_code == 200
+        stats = app.clients['replicated'].get_stats()['replica']
+        assert stats['failovers'] == 1
+        assert stats['replicas']['local']['requests'] == 2
+        assert stats['replicas']['local']['latency_ms'] is not None
+
+
+def test_replica_listing_continuation(app):
+    with TestClient(app) as client:
+        response = client.get("/replicated/?list-type=2&max-keys=2")
+        assert response.status_code == 200
+        root = parse_xml(response.text)
+        token = root.find('NextContinuationToken').text
+        assert token.startswith('local:')
+
+        response = client.get(f"/replicated/?list-type=2&max-keys=2&continuation-token={token}")
+        assert response.status_code == 200
+        root = parse_xml(response.text)
+        assert root.find('ContinuationToken').text == token
+
+        response = client.get("/replicated/?list-type=2&continuation-token=unknown:abc")
+        assert response.status_code == 400
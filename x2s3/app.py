@@ -13,6 +13,14 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from x2s3.utils import *
 from x2s3 import registry
+from x2s3.client import ObjectListing
+from x2s3.cache import CachingProxyClient
+from x2s3.cache_control import CacheControl
+from x2s3.circuit_breaker import CircuitBreakerProxyClient
+from x2s3.coalesce import CoalescingProxyClient
+from x2s3.list_json import get_list_format, get_list_json_response, get_inventory_response
+from x2s3.listing_cache import ListingCacheProxyClient
+from x2s3.negative_cache import NegativeCacheProxyClient
 from x2s3.settings import get_settings
 
 def create_app(settings):
@@ -59,6 +67,7 @@ def create_app(settings):
 
         # Configure targets
         app.clients = {}
+        app.cache_controls = {}
         for target_name in app.settings.get_target_map():
             target_key = target_name.lower()
             target_config = app.settings.get_target_config(target_key)
@@ -69,15 +78,50 @@ def create_app(settings):
             client = registry.client(target_config.client,
                 proxy_kwargs, **target_config.options)
 
+            if CircuitBreakerProxyClient.is_enabled(target_config.options):
+                client = CircuitBreakerProxyClient(client, proxy_kwargs, **target_config.options)
+
+            if CachingProxyClient.is_enabled(target_config.options):
+                client = CachingProxyClient(client, proxy_kwargs, **target_config.options)
+
+            if CoalescingProxyClient.is_enabled(target_config.options):
+                client = CoalescingProxyClient(client, proxy_kwargs, **target_config.options)
+
+            if ListingCacheProxyClient.is_enabled(target_config.options):
+                client = ListingCacheProxyClient(client, proxy_kwargs, **target_config.options)
+
+            if NegativeCacheProxyClient.is_enabled(target_config.options):
+                client = NegativeCacheProxyClient(client, proxy_kwargs, **target_config.options)
+
             if target_key in app.clients:
                 logger.warning(f"Overriding target key: {target_key}")
 
             app.clients[target_key] = client
+
+            cache_control = CacheControl.from_options(target_config.options)
+            if cache_control is not None:
+                app.cache_controls[target_key] = cache_control
+
             logger.debug(f"Configured target {target_name}")
 
+        for target_key, client in app.clients.items():
+            await client.startup()
+
         logger.info(f"Server ready with {len(app.clients)} targets")
 
 
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        """ Runs once when the service is stopping.
+            Releases any resources held by the proxy clients.
+        """
+        for target_key, client in app.clients.items():
+            try:
+                await client.shutdown()
+            except:
+                logger.opt(exception=sys.exc_info()).warning(f"Error shutting down target {target_key}")
+
+
     def get_client(target_name):
         target_key = target_name.lower()
         if target_key in app.clients:
@@ -85,6 +129,24 @@ def create_app(settings):
         return None
 
 
+    def apply_cache_control(target_name, response, key=None, listing=False):
+        """ Add the target's caching headers, if any, to the given response.
+        """
+        cache_control = app.cache_controls.get(target_name.lower())
+        if cache_control is None:
+            return response
+        return cache_control.apply(response, key=key, listing=listing)
+
+
+    async def get_object(request, client, key):
+        """ Calls GetObject on the client, passing along any relevant request headers.
+        """
+        return await client.get_object(key,
+            range_header=request.headers.get('range'),
+            if_range=request.headers.get('if-range'),
+            conditions=get_conditions(request.headers))
+
+
     def get_target(request, path):
         target_path = path
         base_url = app.settings.base_url
@@ -137,52 +199,29 @@ def create_app(settings):
         if client is None:
             raise HTTPException(status_code=500, detail="Client for target bucket not found")
 
-        response = await client.list_objects_v2(continuation_token, '/', None,
-                                                False, max_keys, prefix, None)
+        listing = await client.list_objects(continuation_token, '/', None,
+                                            False, max_keys, prefix, None)
 
-        if response.status_code != 200:
+        if not isinstance(listing, ObjectListing):
             # Return error respone
-            return response
+            return apply_cache_control(target_name, listing)
 
-        xml = response.body.decode("utf-8")
-        root = parse_xml(xml)
-
-        common_prefixes = []
-        cps = [c for c in root.findall('CommonPrefixes')]
-        if cps:
-            for cp in cps:
-                common_prefixes += [dir_path(e.text) for e in cp.iter('Prefix')] if cps else []
+        common_prefixes = [dir_path(cp) for cp in listing.common_prefixes]
 
         contents = []
-        cs = [c for c in root.findall('Contents')]
-        if cs:
-            for c in cs:
-                key_elem = c.find('Key')
-                if key_elem is not None and key_elem.text != prefix:
-
-                    content = {'key': key_elem.text}
-
-                    size_elem = c.find('Size')
-                    if size_elem is not None and size_elem.text:
-                        num_bytes = int(size_elem.text)
-                        content['size'] = humanize_bytes(num_bytes)
-
-                    lm_elem = c.find('LastModified')
-                    if lm_elem is not None and lm_elem.text:
-                        content['lastmod'] = format_isoformat_as_local(lm_elem.text)
-
-                    contents.append(content)
-
-        next_token = None
-        truncated_elem = root.find('IsTruncated')
-        if truncated_elem is not None and truncated_elem.text=='true':
-            next_ct_elem = root.find('NextContinuationToken')
-            next_token = next_ct_elem.text
+        for obj in listing.contents:
+            if obj.Key != prefix:
+                content = {'key': obj.Key}
+                if obj.Size:
+                    content['size'] = humanize_bytes(int(obj.Size))
+                if obj.LastModified:
+                    content['lastmod'] = format_isoformat_as_local(obj.LastModified)
+                contents.append(content)
 
         target_prefix = '' if is_virtual else '/'+target_name
         parent_prefix = dir_path(os.path.dirname(prefix.rstrip('/')))
 
-        return templates.TemplateResponse("browse.html", {
+        response = templates.TemplateResponse("browse.html", {
             "request": request,
             "prefix": prefix,
             "index_url": app.settings.base_url or '/',
@@ -191,8 +230,9 @@ def create_app(settings):
             "contents": contents,
             "parent_prefix": parent_prefix,
             "remove_prefix": remove_prefix,
-            "continuation_token": next_token
+            "continuation_token": listing.next_token
         })
+        return apply_cache_control(target_name, response, listing=True)
 
 
     @app.get('/favicon.ico', include_in_schema=False)
@@ -205,6 +245,36 @@ def create_app(settings):
         return """User-agent: *\nDisallow: /"""
 
 
+    @app.get('/_metrics', include_in_schema=False)
+    async def metrics():
+        """ Returns runtime statistics (e.g. cache hits) for each target.
+        """
+        if not app.settings.metrics:
+            return get_nosuchbucket_response('_metrics')
+        return JSONResponse({target_key: client.get_stats() 
+                for target_key, client in app.clients.items()})
+
+
+    @app.get('/_inventory/{target_name}', include_in_schema=False)
+    async def inventory(request: Request, target_name: str,
+                        prefix: Optional[str] = Query(None, alias="prefix")):
+        """ Streams the key, size, last modified time and ETag of every object 
+            in the target (or beneath the given prefix) as NDJSON, gzipped 
+            if the client accepts it.
+        """
+        target_config = app.settings.get_target_config(target_name)
+        if not target_config:
+            return get_nosuchbucket_response(target_name)
+
+        client = get_client(target_name)
+        if client is None:
+            raise HTTPException(status_code=500, detail="Client for target bucket not found")
+
+        compress = accepts_encoding(request.headers.get('accept-encoding'), 'gzip')
+        response = await get_inventory_response(client, prefix, compress=compress)
+        return apply_cache_control(target_name, response, listing=True)
+
+
     @app.get("/{path:path}")
     async def target_dispatcher(request: Request,
                                 path: str,
@@ -243,12 +313,20 @@ def create_app(settings):
         if list_type:
             if not target_path:
                 if list_type == 2:
-                    return await client.list_objects_v2(continuation_token, delimiter, \
-                        encoding_type, fetch_owner, max_keys, prefix, start_after)
+                    list_format = get_list_format(request)
+                    if list_format:
+                        response = await get_list_json_response(client, list_format,
+                            continuation_token, delimiter, encoding_type, fetch_owner,
+                            max_keys, prefix, start_after)
+                    else:
+                        response = await client.list_objects_v2(continuation_token, delimiter, \
+                            encoding_type, fetch_owner, max_keys, prefix, start_after)
+                    return apply_cache_control(target_name, response, listing=True)
                 else:
                     raise HTTPException(status_code=400, detail="Invalid list type")
             else:
-                return await client.get_object(target_path)
+                response = await get_object(request, client, target_path)
+                return apply_cache_control(target_name, response, key=target_path)
 
         if not target_path or target_path.endswith("/"):
             if app.settings.ui:
@@ -259,7 +337,8 @@ def create_app(settings):
             else:
                 return get_nosuchbucket_response(target_name)
         else:
-            return await client.get_object(target_path)
+            response = await get_object(request, client, target_path)
+            return apply_cache_control(target_name, response, key=target_path)
 
 
 
@@ -279,7 +358,9 @@ def create_app(settings):
             if client is None:
                 raise HTTPException(status_code=500, detail="Client for target bucket not found")
 
-            return await client.head_object(target_path)
+            response = await client.head_object(target_path,
+                    conditions=get_conditions(request.headers))
+            return apply_cache_control(target_name, response, key=target_path)
         except:
             logger.opt(exception=sys.exc_info()).info("Error requesting head")
             return JSONResponse({"error":"Error requesting HEAD"}, status_code=500)
@@ -0,0 +1,504 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+from collections import OrderedDict
+from typing_extensions import override
+
+import anyio
+from loguru import logger
+from fastapi.responses import Response
+
+from x2s3.utils import *
+from x2s3.client import ProxyClient, ProxyClientWrapper
+from x2s3.client_file import FileStream
+
+# Response headers which describe a particular transfer and are not cached
+UNCACHED_HEADERS = {
+    'content-length',
+    'content-range',
+    'connection',
+    'date',
+    'server',
+    'transfer-encoding'
+}
+
+
+class CacheEntry:
+    """ A cached object (or a single byte range of an object) along with
+        the response headers and validators needed to serve and revalidate it.
+        The content is either held in memory (body) or on disk (path).
+    """
+
+    def __init__(self, key, headers, size, expires,
+                 body=None, path=None, content_range=None):
+        self.key = key
+        self.headers = headers
+        self.size = size
+        self.expires = expires
+        self.body = body
+        self.path = path
+        self.content_range = content_range
+
+    @property
+    def etag(self):
+        return self.headers.get('etag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('last-modified')
+
+    @property
+    def last_modified_timestamp(self):
+        last_modified = parse_http_date(self.last_modified) if self.last_modified else None
+        return last_modified.timestamp() if last_modified else None
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def to_dict(self):
+        return {
+            'key': self.key,
+            'headers': self.headers,
+            'size': self.size,
+            'expires': self.expires,
+            'content_range': self.content_range
+        }
+
+
+class MemoryCache:
+    """ LRU cache of small objects held in memory, bounded by total size in bytes.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, entry):
+        self.remove(entry.key)
+        self.entries[entry.key] = entry
+        self.size += entry.size
+        while self.size > self.capacity and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+
+class DiskCache:
+    """ LRU cache of larger objects stored as files in a local directory,
+        bounded by total size in bytes. Each object is stored in a data file
+        with a JSON metadata file beside it, so that the cache survives restarts.
+
+        File names are derived from the cache key and ETag, so a new version of
+        an object never overwrites a file which may still be streaming.
+        Several worker processes may share the directory, but the capacity
+        is enforced separately by each of them.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.size = 0
+        self.entries = OrderedDict()
+        os.makedirs(self.path, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """ Index the entries which are already on disk, oldest first.
+        """
+        metas = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                meta_path = os.path.join(self.path, name)
+                try:
+                    metas.append((os.stat(meta_path).st_mtime, meta_path))
+                except FileNotFoundError:
+                    pass
+
+        for _, meta_path in sorted(metas):
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                entry = CacheEntry(path=meta_path.removesuffix('.json') + '.data', **meta)
+                if os.path.exists(entry.path):
+                    self.add(entry)
+            except Exception:
+                logger.opt(exception=sys.exc_info()).warning(f"Could not load cache entry {meta_path}")
+
+        logger.debug(f"Loaded {len(self.entries)} cached objects ({self.size} bytes) from {self.path}")
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if not os.path.exists(entry.path):
+                # Evicted by another worker
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+        return entry
+
+    def get_temp_file(self):
+        """ Create a temporary file in the cache directory to write new content into.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        return os.fdopen(fd, 'wb'), temp_path
+
+    def put(self, entry, temp_path):
+        """ Add an entry whose content was written into the given temporary file.
+        """
+        name = hashlib.sha256(f"{entry.key}\n{entry.etag}".encode()).hexdigest()
+        base_path = os.path.join(self.path, name)
+        entry.path = base_path + '.data'
+        os.replace(temp_path, entry.path)
+        with open(base_path + '.json.tmp', 'w') as f:
+            json.dump(entry.to_dict(), f)
+        os.replace(base_path + '.json.tmp', base_path + '.json')
+        self.add(entry)
+
+    def add(self, entry):
+        old = self.entries.pop(entry.key, None)
+        if old is not None:
+            self.size -= old.size
+            if old.path != entry.path:
+                self.delete_files(old)
+        self.entries[entry.key] = entry
+        self.size += entry.size
+        while self.size > self.capacity and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            self.delete_files(evicted)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+            self.delete_files(entry)
+
+    def delete_files(self, entry):
+        for path in (entry.path, entry.path.removesuffix('.data') + '.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class CacheFillResponse(Response):
+    """ Send the wrapped response to the client while copying its body
+        into the cache. The entry is only added once the whole body
+        has been received from upstream.
+    """
+
+    def __init__(self, response, cache, entry):
+        self.response = response
+        self.cache = cache
+        self.entry = entry
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        # Disable zero-copy extensions so that the body passes through send()
+        scope = dict(scope)
+        scope['extensions'] = {}
+
+        entry = self.entry
+        chunks = []
+        received = 0
+        complete = False
+        file, temp_path = None, None
+        if entry.body is None:
+            file, temp_path = self.cache.disk.get_temp_file()
+
+        async def tee_send(message):
+            nonlocal received, complete
+            if message['type'] == 'http.response.body':
+                body = message.get('body', b'')
+                if body:
+                    received += len(body)
+                    if file is None:
+                        chunks.append(body)
+                    else:
+                        await anyio.to_thread.run_sync(file.write, body)
+                if not message.get('more_body', False):
+                    complete = True
+            await send(message)
+
+        try:
+            await self.response(scope, receive, tee_send)
+        finally:
+            if file is not None:
+                file.close()
+            if complete and received == entry.size:
+                if file is None:
+                    entry.body = b''.join(chunks)
+                    self.cache.memory.put(entry)
+                else:
+                    self.cache.disk.put(entry, temp_path)
+                    temp_path = None
+                self.cache.stats['fills'] += 1
+            if temp_path is not None:
+                os.remove(temp_path)
+
+
+class CachingProxyClient(ProxyClientWrapper):
+    """ Read-through object cache in front of another ProxyClient.
+
+        Objects up to cache_memory_max_object_size are kept in a memory LRU of
+        cache_memory_size bytes. Larger objects, up to cache_disk_max_object_size,
+        are kept in cache_dir, which holds up to cache_disk_size bytes.
+        Entries are served without contacting upstream for cache_ttl seconds,
+        and are then revalidated against the upstream ETag and Last-Modified.
+
+        Whole objects are cached, and can then serve any byte range. Ranged
+        requests for objects which are not cached are also cached, per range.
+    """
+
+    stats_name = 'cache'
+
+    def __init__(self, wrapped: ProxyClient, proxy_kwargs, **kwargs):
+        super().__init__(wrapped)
+        self.proxy_kwargs = proxy_kwargs or {}
+        self.target_name = self.proxy_kwargs['target_name']
+        self.ttl = float(kwargs.get('cache_ttl', 60))
+        self.stale_if_error = float(kwargs.get('cache_stale_if_error', 0))
+
+        self.memory = MemoryCache(parse_size(kwargs.get('cache_memory_size', '64MiB')))
+        self.memory_max_object_size = parse_size(kwargs.get('cache_memory_max_object_size', '1MiB'))
+
+        self.disk = None
+        self.disk_max_object_size = 0
+        if 'cache_dir' in kwargs:
+            disk_path = os.path.join(kwargs['cache_dir'], self.target_name)
+            self.disk = DiskCache(disk_path, parse_size(kwargs.get('cache_disk_size', '10GiB')))
+            self.disk_max_object_size = parse_size(kwargs.get('cache_disk_max_object_size', '1GiB'))
+
+        self.stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'revalidations': 0,
+            'stale_hits': 0,
+            'fills': 0
+        }
+
+
+    @staticmethod
+    def is_enabled(options):
+        """ Returns true if the given target options configure a cache.
+        """
+        return 'cache_memory_size' in options or 'cache_dir' in options
+
+
+    def get_entry(self, cache_key):
+        entry = self.memory.get(cache_key)
+        if entry is not None:
+            return entry
+        if self.disk is not None:
+            return self.disk.get(cache_key)
+        return None
+
+
+    def remove_entry(self, cache_key):
+        self.memory.remove(cache_key)
+        if self.disk is not None:
+            self.disk.remove(cache_key)
+
+
+    async def revalidate(self, key, entry):
+        """ Check a stale entry against upstream. Returns true if it is
+            still valid, in which case its expiry is extended. Returns None
+            if upstream couldn't be checked.
+        """
+        self.stats['revalidations'] += 1
+        conditions = {'if-none-match': entry.etag} if entry.etag else None
+        response = await self.wrapped.head_object(key, conditions=conditions)
+        if is_upstream_error(response.status_code):
+            return None
+        if response.status_code == 304:
+            entry.expires = time.time() + self.ttl
+            return True
+        if response.status_code != 200:
+            return False
+
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if (etag or entry.etag) and etag != entry.etag:
+            return False
+        if not etag and last_modified != entry.last_modified:
+            return False
+
+        entry.expires = time.time() + self.ttl
+        return True
+
+
+    async def lookup(self, key, cache_key):
+        """ Returns a fresh (or successfully revalidated) entry, or None.
+        """
+        entry = self.get_entry(cache_key)
+        if entry is None:
+            return None
+        if entry.is_fresh():
+            valid = True
+        else:
+            valid = await self.revalidate(key, entry)
+            if valid is None:
+                if time.time() < entry.expires + self.stale_if_error:
+                    # Upstream is failing, so serve the stale entry for a while
+                    self.stats['stale_hits'] += 1
+                    return entry
+                return None
+        if valid:
+            self.stats['memory_hits' if entry.body is not None else 'disk_hits'] += 1
+            return entry
+        self.remove_entry(cache_key)
+        return None
+
+
+    def get_entry_response(self, entry, range_header, if_range, conditions=None):
+        """ Serve a response from the given cache entry, applying any
+            request conditions and requested byte ranges.
+        """
+        response = get_conditional_response(conditions, entry.headers,
+                entry.etag, entry.last_modified_timestamp)
+        if response is not None:
+            return response
+
+        headers = dict(entry.headers)
+        media_type = headers.pop('content-type', None)
+        headers['accept-ranges'] = 'bytes'
+
+        if entry.content_range:
+            # The entry is itself a single range of the object
+            headers['content-range'] = entry.content_range
+            headers['content-length'] = str(entry.size)
+            return self.send_entry(entry, None, None, 206, headers, media_type)
+
+        ranges = None
+        if range_header and if_range_matches(if_range, entry.etag, entry.last_modified_timestamp):
+            ranges = parse_range_header(range_header, entry.size)
+
+        if ranges is None:
+            headers['content-length'] = str(entry.size)
+            return self.send_entry(entry, None, None, 200, headers, media_type)
+
+        if not ranges:
+            return get_invalidrange_response(entry.size)
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers['content-length'] = str(end - start + 1)
+            headers['content-range'] = format_content_range(start, end, entry.size)
+            return self.send_entry(entry, ranges, None, 206, headers, media_type)
+
+        boundary = get_multipart_boundary()
+        headers['content-length'] = str(get_multipart_length(boundary, media_type, ranges, entry.size))
+        return self.send_entry(entry, ranges, boundary, 206, headers, media_type)
+
+
+    def send_entry(self, entry, ranges, boundary, status_code, headers, part_type):
+        media_type = part_type
+        if boundary:
+            media_type = f"multipart/byteranges; boundary={boundary}"
+
+        if entry.path is not None:
+            return FileStream(entry.path, entry.size, ranges=ranges, boundary=boundary,
+                    part_type=part_type, status_code=status_code, headers=headers,
+                    media_type=media_type)
+
+        if not ranges:
+            content = entry.body
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            content = entry.body[start:end+1]
+        else:
+            parts = []
+            for start, end in ranges:
+                parts.append(get_multipart_part_header(boundary, part_type, start, end, entry.size))
+                parts.append(entry.body[start:end+1])
+                parts.append(b"\r\n")
+            parts.append(get_multipart_footer(boundary))
+            content = b''.join(parts)
+
+        return Response(content=content, status_code=status_code,
+                headers=headers, media_type=media_type)
+
+
+    def fill(self, cache_key, response):
+        """ Wrap the given upstream response so that its content is cached
+            as it is sent, if it is cacheable.
+        """
+        if response.status_code not in (200, 206):
+            return response
+
+        headers = {k: v for k, v in response.headers.items() if k not in UNCACHED_HEADERS}
+        content_range = response.headers.get('content-range')
+        if response.status_code == 206 and not content_range:
+            # Multipart responses are not cached
+            return response
+
+        length = response.headers.get('content-length')
+        if length is None:
+            return response
+        size = int(length)
+
+        entry = CacheEntry(cache_key, headers, size, time.time() + self.ttl,
+                content_range=content_range)
+        if size <= self.memory_max_object_size:
+            entry.body = b''
+        elif self.disk is None or size > self.disk_max_object_size:
+            return response
+
+        return CacheFillResponse(response, self, entry)
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
+        entry = await self.lookup(key, key)
+        if entry is not None:
+            response = get_conditional_response(conditions, entry.headers,
+                    entry.etag, entry.last_modified_timestamp)
+            if response is not None:
+                return response
+            headers = dict(entry.headers)
+            headers['content-length'] = str(entry.size)
+            headers['accept-ranges'] = 'bytes'
+            return Response(headers=headers)
+        return await self.wrapped.head_object(key, conditions=conditions)
+
+
+    @override
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
+        entry = await self.lookup(key, key)
+        if entry is not None:
+            return self.get_entry_response(entry, range_header, if_range, conditions)
+
+        if range_header and ',' not in range_header and not if_range:
+            range_key = f"{key}\n{range_header}"
+            entry = await self.lookup(key, range_key)
+            if entry is not None:
+                return self.get_entry_response(entry, None, None, conditions)
+            self.stats['misses'] += 1
+            response = await self.wrapped.get_object(key, range_header=range_header,
+                    conditions=conditions)
+            return self.fill(range_key, response)
+
+        self.stats['misses'] += 1
+        response = await self.wrapped.get_object(key, range_header=range_header, if_range=if_range,
+                conditions=conditions)
+        if range_header:
+            return response
+        return self.fill(key, response)
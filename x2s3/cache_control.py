@@ -0,0 +1,128 @@
+import time
+from fnmatch import fnmatchcase
+
+from x2s3.utils import *
+
+
+def merge_vary(vary, other):
+    """ Returns a Vary header with the fields of both of the given ones.
+    """
+    fields = [f.strip() for f in vary.split(',') if f.strip()]
+    names = {f.lower() for f in fields}
+    for field in other.split(','):
+        field = field.strip()
+        if field and field.lower() not in names:
+            fields.append(field)
+            names.add(field.lower())
+    return ', '.join(fields)
+
+
+class CachePolicy:
+    """ Caching instructions for downstream caches (browsers, CDNs and
+        reverse proxies like Nginx), rendered as Cache-Control, Expires
+        and Vary response headers.
+    """
+
+    def __init__(self, max_age=None, s_maxage=None, stale_while_revalidate=None,
+                 stale_if_error=None, immutable=False, public=True, no_store=False, vary=None):
+        self.max_age = None if max_age is None else int(max_age)
+        self.s_maxage = None if s_maxage is None else int(s_maxage)
+        self.stale_while_revalidate = None if stale_while_revalidate is None else int(stale_while_revalidate)
+        self.stale_if_error = None if stale_if_error is None else int(stale_if_error)
+        self.immutable = parse_bool(immutable)
+        self.public = parse_bool(public)
+        self.no_store = parse_bool(no_store)
+        self.vary = vary
+
+
+    def get_cache_control(self):
+        if self.no_store:
+            return "no-store"
+        directives = ["public" if self.public else "private"]
+        if self.max_age is not None:
+            directives.append(f"max-age={self.max_age}")
+        if self.s_maxage is not None:
+            directives.append(f"s-maxage={self.s_maxage}")
+        if self.stale_while_revalidate is not None:
+            directives.append(f"stale-while-revalidate={self.stale_while_revalidate}")
+        if self.stale_if_error is not None:
+            directives.append(f"stale-if-error={self.stale_if_error}")
+        if self.immutable:
+            directives.append("immutable")
+        return ", ".join(directives)
+
+
+    def get_headers(self):
+        """ Returns the response headers for this policy.
+        """
+        headers = {'Cache-Control': self.get_cache_control()}
+        if self.no_store:
+            headers['Expires'] = format_http_date(0)
+        elif self.max_age is not None:
+            headers['Expires'] = format_http_date(time.time() + self.max_age)
+        if self.vary:
+            headers['Vary'] = self.vary
+        return headers
+
+
+class CacheControl:
+    """ Per-target policies for the Cache-Control, Expires and Vary headers.
+
+        Objects, listings and errors each have their own policy, and objects
+        can be given different policies by matching their keys against
+        glob patterns, e.g. to make chunks immutable while metadata
+        expires quickly. The first matching rule wins, and its settings are
+        layered over the object policy. Responses which have no applicable
+        policy are sent without caching headers.
+    """
+
+    def __init__(self, objects=None, listings=None, errors=None, rules=None):
+        self.objects_options = objects or {}
+        self.objects = CachePolicy(**self.objects_options) if objects else None
+        self.listings = CachePolicy(**listings) if listings else None
+        self.errors = CachePolicy(**errors) if errors else None
+        self.rules = []
+        for rule in rules or []:
+            rule = dict(rule)
+            pattern = rule.pop('pattern')
+            self.rules.append((pattern, CachePolicy(**{**self.objects_options, **rule})))
+
+
+    @staticmethod
+    def from_options(options):
+        """ Returns the CacheControl configured by the cache_control
+            target option, or None if there isn't one.
+        """
+        if 'cache_control' not in options:
+            return None
+        return CacheControl(**options['cache_control'])
+
+
+    def get_object_policy(self, key):
+        for pattern, policy in self.rules:
+            if fnmatchcase(key, pattern):
+                return policy
+        return self.objects
+
+
+    def apply(self, response, key=None, listing=False):
+        """ Add the caching headers for the given object key (or listing)
+            to the response, and return it.
+        """
+        if 300 <= response.status_code < 400 and response.status_code != 304:
+            # Redirects carry their own caching headers
+            return response
+        if response.status_code >= 400:
+            policy = self.errors
+        elif listing:
+            policy = self.listings
+        else:
+            policy = self.get_object_policy(key or '')
+
+        if policy is not None:
+            for name, value in policy.get_headers().items():
+                if name == 'Vary' and 'vary' in response.headers:
+                    # Keep what the response itself varies on
+                    value = merge_vary(response.headers['vary'], value)
+                response.headers[name] = value
+        return response
@@ -0,0 +1,255 @@
+import time
+import asyncio
+from collections import deque
+from typing_extensions import override
+
+from loguru import logger
+from fastapi.responses import JSONResponse
+
+from x2s3.utils import *
+from x2s3.client import ProxyClient, ProxyClientWrapper
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """ Tracks the outcomes of recent requests to an upstream endpoint.
+
+        The breaker opens when at least failure_rate of the last window requests
+        failed (once min_requests have been seen). While it is open, requests
+        are rejected. After open_seconds it becomes half-open, and lets up to
+        probes trial requests through. If they succeed the breaker closes,
+        otherwise it opens again.
+    """
+
+    def __init__(self, window=20, min_requests=10, failure_rate=0.5, open_seconds=30, probes=1):
+        self.outcomes = deque(maxlen=window)
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = CLOSED
+        self.opened_at = None
+        self.probes_in_flight = 0
+        self.times_opened = 0
+
+
+    def get_retry_after(self):
+        """ Returns the number of seconds until the breaker becomes half-open.
+        """
+        if self.state != OPEN:
+            return 0
+        return max(1, self.open_seconds - (time.monotonic() - self.opened_at))
+
+
+    def allow(self):
+        """ Returns the state in which a request was admitted,
+            or None if it must be rejected.
+        """
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return None
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probes_in_flight >= self.probes:
+                return None
+            self.probes_in_flight += 1
+        return self.state
+
+
+    def record(self, success, admitted):
+        """ Record the outcome of a request which was admitted in the given state.
+            The outcome is None if the request finished without a result,
+            e.g. because it was cancelled.
+        """
+        if admitted == HALF_OPEN:
+            self.probes_in_flight -= 1
+            if success is True:
+                self.close()
+            elif success is False:
+                self.open()
+            return
+
+        if success is None or self.state != CLOSED:
+            return
+        self.outcomes.append(success)
+        if len(self.outcomes) >= self.min_requests:
+            failures = self.outcomes.count(False)
+            if failures >= self.failure_rate * len(self.outcomes):
+                self.open()
+
+
+    def open(self):
+        if self.state != OPEN:
+            self.times_opened += 1
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+
+    def close(self):
+        self.state = CLOSED
+        self.outcomes.clear()
+
+
+class CircuitBreakerProxyClient(ProxyClientWrapper):
+    """ Stops sending requests to an unhealthy upstream endpoint, so that
+        requests for the target fail fast instead of holding worker slots
+        and connections until the upstream times out.
+
+        Responses with 5xx or 408 status, and calls which take longer than
+        breaker_timeout seconds (if set), count as failures. While the
+        breaker is open, requests are answered with 503 Service Unavailable.
+        Combined with cache_stale_if_error, cached objects are served stale instead.
+    """
+
+    stats_name = 'circuit_breaker'
+
+    def __init__(self, wrapped: ProxyClient, proxy_kwargs, **kwargs):
+        super().__init__(wrapped)
+        self.proxy_kwargs = proxy_kwargs or {}
+        self.target_name = self.proxy_kwargs['target_name']
+        self.timeout = None
+        if 'breaker_timeout' in kwargs:
+            self.timeout = float(kwargs['breaker_timeout'])
+        self.breaker = CircuitBreaker(
+            window=int(kwargs.get('breaker_window', 20)),
+            min_requests=int(kwargs.get('breaker_min_requests', 10)),
+            failure_rate=float(kwargs.get('breaker_failure_rate', 0.5)),
+            open_seconds=float(kwargs.get('breaker_open_seconds', 30)),
+            probes=int(kwargs.get('breaker_probes', 1)))
+        self.stats = {
+            'successes': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'rejected': 0
+        }
+
+
+    @staticmethod
+    def is_enabled(options):
+        """ Returns true if the given target options enable the circuit breaker.
+        """
+        return parse_bool(options.get('circuit_breaker', False))
+
+
+    @override
+    def get_stats(self):
+        stats = super().get_stats()
+        stats[self.stats_name]['state'] = self.breaker.state
+        stats[self.stats_name]['times_opened'] = self.breaker.times_opened
+        return stats
+
+
+    def admit(self):
+        """ Returns the state in which a request was admitted by the breaker,
+            or None if it was rejected.
+        """
+        admitted = self.breaker.allow()
+        if admitted is None:
+            self.stats['rejected'] += 1
+        return admitted
+
+
+    def record(self, success, admitted):
+        """ Record the outcome of a request which was admitted in the given state.
+        """
+        if success is not None:
+            self.stats['successes' if success else 'failures'] += 1
+        previous_state = self.breaker.state
+        self.breaker.record(success, admitted)
+        if self.breaker.state != previous_state:
+            if self.breaker.state == OPEN:
+                logger.warning(f"Upstream for {self.target_name} is unhealthy, failing fast "
+                        f"for {self.breaker.open_seconds} seconds")
+            elif self.breaker.state == CLOSED:
+                logger.info(f"Upstream for {self.target_name} has recovered")
+
+
+    async def call(self, call):
+        admitted = self.admit()
+        if admitted is None:
+            return get_serviceunavailable_response(self.breaker.get_retry_after())
+
+        success = None
+        try:
+            if self.timeout is None:
+                response = await call()
+            else:
+                response = await asyncio.wait_for(call(), self.timeout)
+            success = not is_upstream_error(response.status_code)
+            return response
+        except asyncio.TimeoutError:
+            success = False
+            self.stats['timeouts'] += 1
+            return JSONResponse({"error":"Upstream endpoint timed out"}, status_code=408)
+        finally:
+            self.record(success, admitted)
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
+        return await self.call(lambda: self.wrapped.head_object(key, conditions=conditions))
+
+
+    @override
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
+        return await self.call(lambda: self.wrapped.get_object(key, range_header=range_header,
+                if_range=if_range, conditions=conditions))
+
+
+    @override
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        return await self.call(lambda: self.wrapped.list_objects(continuation_token,
+                delimiter, encoding_type, fetch_owner, max_keys, prefix, start_after))
+
+
+    @override
+    async def iter_objects(self, prefix: str):
+        # Each batch is a request to the upstream, which is admitted and 
+        # recorded like any other call
+        batches = self.wrapped.iter_objects(prefix)
+
+        async def next_batch():
+            async for batch in batches:
+                return batch
+            return None
+
+        try:
+            while True:
+                admitted = self.admit()
+                if admitted is None:
+                    yield get_serviceunavailable_response(self.breaker.get_retry_after())
+                    return
+
+                success = None
+                try:
+                    if self.timeout is None:
+                        batch = await next_batch()
+                    else:
+                        batch = await asyncio.wait_for(next_batch(), self.timeout)
+                    success = isinstance(batch, list) or batch is None \
+                            or not is_upstream_error(batch.status_code)
+                except asyncio.TimeoutError:
+                    success = False
+                    self.stats['timeouts'] += 1
+                    batch = JSONResponse({"error":"Upstream endpoint timed out"}, status_code=408)
+                finally:
+                    self.record(success, admitted)
+
+                if batch is None:
+                    return
+                yield batch
+                if not isinstance(batch, list):
+                    return
+        finally:
+            await batches.aclose()
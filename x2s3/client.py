@@ -1,3 +1,66 @@
+import heapq
+
+from fastapi.responses import Response
+
+from x2s3.utils import get_list_xml, get_list_entry, parse_xml
+
+# Number of keys in each page listed by the default ProxyClient.iter_objects
+INVENTORY_PAGE_SIZE = 1000
+
+
+class ObjectListing:
+    """ The result of a ListObjectsV2 request, from which the S3 XML, the 
+        HTML browser and any other format are rendered, without having to 
+        parse a serialized listing.
+
+        The contents are ListEntry records, and the params are the request 
+        parameters which are echoed back in the listing (Name, Prefix, 
+        Delimiter, MaxKeys, EncodingType, ContinuationToken and StartAfter).
+        Listings can be shared between requests (e.g. when requests are 
+        coalesced), so they must not be modified once they are returned.
+    """
+
+    # Listings can be handled like successful responses
+    status_code = 200
+
+    def __init__(self, contents, common_prefixes, is_truncated=False, next_token=None, **params):
+        self.contents = [get_list_entry(obj) for obj in contents]
+        self.common_prefixes = list(common_prefixes)
+        self.is_truncated = is_truncated
+        self.next_token = next_token if is_truncated else None
+        self.params = params
+
+    @staticmethod
+    def from_xml(xml):
+        """ Returns the listing in the given ListObjectsV2 XML.
+        """
+        root = parse_xml(xml)
+        contents = [{child.tag: child.text for child in c} for c in root.findall('Contents')]
+        common_prefixes = [c.findtext('Prefix') for c in root.findall('CommonPrefixes')]
+        params = {key: root.findtext(key) for key in ('Name', 'Prefix', 'Delimiter', 'MaxKeys',
+                'EncodingType', 'ContinuationToken', 'StartAfter')}
+        return ObjectListing(contents, common_prefixes, root.findtext('IsTruncated') == 'true',
+                root.findtext('NextContinuationToken'), **params)
+
+    def iter_entries(self):
+        """ Yields the (key, entry) pairs in the listing, with the common 
+            prefixes (whose entry is None) interleaved in key order, as they
+            are in S3 listings.
+        """
+        prefixes = ((prefix, None) for prefix in self.common_prefixes)
+        objects = ((obj.Key, obj) for obj in self.contents)
+        return heapq.merge(prefixes, objects, key=lambda entry: entry[0])
+
+    def get_xml(self):
+        return get_list_xml(self.contents, self.common_prefixes, **self.params,
+                KeyCount=len(self.contents) + len(self.common_prefixes),
+                IsTruncated='true' if self.is_truncated else 'false',
+                NextContinuationToken=self.next_token)
+
+    def get_response(self):
+        return Response(content=self.get_xml(), media_type="application/xml")
+
+
 class ProxyClient:
     """ Interface for a client that implements an S3-like interface 
         to key-value access against some backend service. 
@@ -7,16 +70,46 @@ class ProxyClient:
         for viewers like Neuroglancer, N5 Viewer, Vizarr, etc.
     """
 
-    async def head_object(self, key: str):
+    async def startup(self):
+        """
+        Called once when the service starts, before any requests are served.
+        Clients can use this to acquire long-lived resources, like connection pools.
+        """
+
+    async def shutdown(self):
+        """
+        Called once when the service stops. Clients should release any 
+        resources that were acquired in startup().
+        """
+
+    def get_stats(self):
+        """
+        Returns a dictionary of runtime statistics (e.g. cache hit counts) 
+        for monitoring. 
+        """
+        return {}
+
+    async def head_object(self, key: str, conditions: dict = None):
         """
         Basic interface for AWS S3's HeadObject API.
         https://docs.aws.amazon.com/AmazonS3/latest/API/API_HeadObject.html
+
+        The conditions are the conditional request headers, if any, as returned 
+        by get_conditions. Clients should respond with 304 Not Modified or 
+        412 Precondition Failed as described in RFC 7232.
         """
 
-    async def get_object(self, key: str):
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
         """
         Basic interface for AWS S3's GetObject API.
         https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
+
+        The range_header and if_range are the values of the HTTP Range and 
+        If-Range request headers, if any. Clients should respond with 206 
+        Partial Content (or multipart/byteranges for multiple ranges) 
+        as described in RFC 7233. The conditions are handled as for head_object, 
+        before any range is applied.
         """
 
     async def list_objects_v2(self,
@@ -30,5 +123,107 @@ class ProxyClient:
         """
         Basic interface for AWS S3's ListObjectsV2 API.
         https://docs.aws.amazon.com/AmazonS3/latest/API/API_ListObjectsV2.html
+
+        Returns the listing from list_objects rendered as S3 XML. Clients 
+        should implement list_objects instead of this method.
         """
-    
\ No newline at end of file
+        listing = await self.list_objects(continuation_token, delimiter, 
+                encoding_type, fetch_owner, max_keys, prefix, start_after)
+        if isinstance(listing, ObjectListing):
+            return listing.get_response()
+        return listing
+
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        """
+        Structured interface for AWS S3's ListObjectsV2 API, which takes the 
+        same parameters as list_objects_v2. Returns an ObjectListing, or an 
+        error response.
+
+        Clients which only implement list_objects_v2 are supported by parsing
+        its XML.
+        """
+        if type(self).list_objects_v2 is ProxyClient.list_objects_v2:
+            raise NotImplementedError(f"{type(self).__name__} does not implement list_objects")
+        response = await self.list_objects_v2(continuation_token, delimiter, 
+                encoding_type, fetch_owner, max_keys, prefix, start_after)
+        if response.status_code != 200:
+            return response
+        return ObjectListing.from_xml(response.body)
+
+    async def iter_objects(self, prefix: str):
+        """
+        Yields every object beneath the given prefix in key order, as lists
+        of ListEntry records, for exporting the inventory of a target. If part
+        of the listing fails, its error response is yielded instead, and
+        nothing more is yielded.
+
+        By default, the objects are listed a page at a time with list_objects.
+        """
+        continuation_token = None
+        while True:
+            listing = await self.list_objects(continuation_token, None, None, None,
+                    INVENTORY_PAGE_SIZE, prefix, None)
+            if not isinstance(listing, ObjectListing):
+                yield listing
+                return
+            if listing.contents:
+                yield listing.contents
+            if not listing.is_truncated:
+                return
+            continuation_token = listing.next_token
+
+
+class ProxyClientWrapper(ProxyClient):
+    """ Base class for clients which add behavior (e.g. caching) in front of 
+        another ProxyClient. By default, every call is delegated to the 
+        wrapped client.
+    """
+
+    # Name under which this wrapper's statistics are reported
+    stats_name = None
+
+    def __init__(self, wrapped: ProxyClient):
+        self.wrapped = wrapped
+        self.stats = {}
+
+    async def startup(self):
+        await self.wrapped.startup()
+
+    async def shutdown(self):
+        await self.wrapped.shutdown()
+
+    def get_stats(self):
+        stats = self.wrapped.get_stats()
+        if self.stats_name:
+            stats[self.stats_name] = dict(self.stats)
+        return stats
+
+    async def head_object(self, key: str, conditions: dict = None):
+        return await self.wrapped.head_object(key, conditions=conditions)
+
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
+        return await self.wrapped.get_object(key, range_header=range_header, if_range=if_range,
+                conditions=conditions)
+
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        return await self.wrapped.list_objects(continuation_token, delimiter, 
+                encoding_type, fetch_owner, max_keys, prefix, start_after)
+
+    async def iter_objects(self, prefix: str):
+        async for batch in self.wrapped.iter_objects(prefix):
+            yield batch
@@ -1,6 +1,11 @@
 import os
 import sys
 import typing
+import time
+import asyncio
+from fnmatch import fnmatchcase
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack
 from typing_extensions import override
 
 from loguru import logger
@@ -9,10 +14,16 @@ import botocore
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
 from aiobotocore.session import get_session
 from aiobotocore.config import AioConfig
-from fastapi.responses import Response, StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse, RedirectResponse
 
 from x2s3.utils import *
-from x2s3.client import ProxyClient
+from x2s3.client import ProxyClient, ObjectListing
+from x2s3.hedging import Hedger
+from x2s3.partitioned_listing import PartitionedLister, PARTITION_PAGE_SIZE, \
+    PARTITION_TOKEN_PREFIX, encode_partition_token, decode_partition_token
+
+# Maximum number of object sizes remembered for deciding on redirects
+OBJECT_SIZE_CACHE_SIZE = 10000
 
 def handle_s3_exception(e, key=None):
     """ Handle various cases of generic errors from the boto AWS API.
@@ -26,6 +37,12 @@ def handle_s3_exception(e, key=None):
         code = e.response['ResponseMetadata']['HTTPStatusCode']
         if e.response["Error"]["Code"] == "NoSuchKey":
             return get_nosuchkey_response(key)
+        elif int(code) == 304:
+            return get_notmodified_response(e.response['ResponseMetadata'].get('HTTPHeaders', {}))
+        elif e.response["Error"]["Code"] == "PreconditionFailed" or int(code) == 412:
+            return get_preconditionfailed_response()
+        elif e.response["Error"]["Code"] == "InvalidRange" or int(code) == 416:
+            return get_invalidrange_response(e.response["Error"].get("ActualObjectSize"))
         elif int(code) == 404 and key:
             return get_nosuchkey_response(key)
         else:
@@ -36,6 +53,43 @@ def handle_s3_exception(e, key=None):
         return JSONResponse({"error":"Error communicating with AWS S3"}, status_code=500)
 
 
+def get_error_status(e):
+    """ Returns the HTTP status code of the given boto ClientError.
+    """
+    return int(e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0))
+
+
+def get_object_headers(s3_res):
+    """ Returns the HTTP headers describing the object in the given 
+        HeadObject or GetObject result.
+    """
+    return {
+        "ETag": s3_res.get("ETag"),
+        "Content-Length": str(s3_res.get("ContentLength")),
+        "Last-Modified": format_http_date(s3_res.get("LastModified").timestamp()),
+        "Accept-Ranges": "bytes"
+    }
+
+
+def get_condition_params(conditions):
+    """ Returns the HeadObject/GetObject parameters which pass the given 
+        conditional request headers on to S3.
+    """
+    params = {}
+    if not conditions:
+        return params
+    if conditions.get('if-match'):
+        params['IfMatch'] = conditions['if-match']
+    if conditions.get('if-none-match'):
+        params['IfNoneMatch'] = conditions['if-none-match']
+    for name, param in (('if-modified-since', 'IfModifiedSince'),
+                        ('if-unmodified-since', 'IfUnmodifiedSince')):
+        date = parse_http_date(conditions.get(name))
+        if date:
+            params[param] = date
+    return params
+
+
 class AiobotoProxyClient(ProxyClient):
 
     def __init__(self, proxy_kwargs, **kwargs):
@@ -67,38 +121,144 @@ class AiobotoProxyClient(ProxyClient):
         if 'endpoint' in kwargs:
             self.client_kwargs['endpoint_url'] = kwargs.get('endpoint')
 
+        # Connection pool settings for the long-lived client
+        config_kwargs = {
+            'max_pool_connections': int(kwargs.get('max_pool_connections', 50)),
+            'connect_timeout': float(kwargs.get('connect_timeout', 60)),
+            'read_timeout': float(kwargs.get('read_timeout', 60)),
+            'tcp_keepalive': parse_bool(kwargs.get('tcp_keepalive', False)),
+        }
+
+        if 'max_attempts' in kwargs:
+            config_kwargs['retries'] = {'max_attempts': int(kwargs['max_attempts'])}
+
+        if 'keepalive_timeout' in kwargs:
+            config_kwargs['connector_args'] = {
+                'keepalive_timeout': float(kwargs['keepalive_timeout'])
+            }
+
+        if self.anonymous:
+            config_kwargs['signature_version'] = botocore.UNSIGNED
+
+        # Large objects can be served by redirecting to a presigned URL
+        self.redirect_min_size = None
+        if 'redirect_min_size' in kwargs:
+            self.redirect_min_size = parse_size(kwargs['redirect_min_size'])
+        self.redirect_patterns = parse_list(kwargs.get('redirect_patterns'))
+        self.redirect_expires = int(kwargs.get('redirect_expires', 300))
+        self.object_size_ttl = float(kwargs.get('redirect_head_ttl', 60))
+        self.object_sizes = OrderedDict()
+
+        # Large objects can be fetched with concurrent ranged GETs
+        self.parallel_min_size = None
+        if 'parallel_min_size' in kwargs:
+            self.parallel_min_size = parse_size(kwargs['parallel_min_size'])
+        self.parallel_part_size = parse_size(kwargs.get('parallel_part_size', '8MiB'))
+        self.parallel_requests = int(kwargs.get('parallel_requests', 4))
+
+        # Slow requests for metadata and small objects can be hedged
+        self.hedger = None
+        if parse_bool(kwargs.get('hedge_requests', False)):
+            self.hedger = Hedger(percentile=float(kwargs.get('hedge_percentile', 95)),
+                    budget=float(kwargs.get('hedge_budget', 0.05)))
+        self.hedge_max_size = parse_size(kwargs.get('hedge_max_size', '1MiB'))
+
+        # Inventories and large recursive listings are listed in concurrent partitions
+        self.list_concurrency = int(kwargs.get('list_concurrency', 8))
+        self.list_semaphore = None
+
+        self.stats = {
+            'redirects': 0,
+            'parallel_gets': 0,
+            'partitioned_lists': 0
+        }
+
+        self.client_config = AioConfig(**config_kwargs)
+        self.client = None
+        self.client_lock = asyncio.Lock()
+        self.exit_stack = AsyncExitStack()
+
 
-    def get_client_creator(self):
-        session = get_session()
-        conf = AioConfig(signature_version=botocore.UNSIGNED) if self.anonymous else AioConfig()
-        return session.create_client('s3', config=conf, **self.client_kwargs)
+    @override
+    async def startup(self):
+        await self.get_client()
+
+
+    @override
+    async def shutdown(self):
+        client, self.client = self.client, None
+        if client is not None:
+            await self.exit_stack.aclose()
+            logger.debug(f"Closed S3 client for {self.target_name}")
 
 
     @override
-    async def head_object(self, key: str):
+    def get_stats(self):
+        stats = {'aioboto': dict(self.stats)}
+        if self.hedger is not None:
+            stats['hedging'] = self.hedger.get_stats()
+        return stats
+
+
+    async def call_s3(self, op, call, discard=None):
+        """ Await the given S3 call, hedging it if hedging is enabled.
+        """
+        if self.hedger is None:
+            return await call()
+        return await self.hedger.call(op, call, discard)
+
+
+    def should_hedge_get(self, real_key):
+        """ Returns true if a GetObject for the given key should be hedged, 
+            i.e. the object isn't known to be larger than hedge_max_size.
+        """
+        if self.hedger is None:
+            return False
+        cached = self.object_sizes.get(real_key)
+        return cached is None or cached[0] <= self.hedge_max_size
+
+
+    async def get_client(self):
+        """ Returns the S3 client for this target, creating it if necessary.
+            The client (and its connection pool) is shared by all requests 
+            for the lifetime of the service.
+        """
+        if self.client is None:
+            async with self.client_lock:
+                if self.client is None:
+                    session = get_session()
+                    creator = session.create_client('s3', 
+                            config=self.client_config, **self.client_kwargs)
+                    self.client = await self.exit_stack.enter_async_context(creator)
+                    logger.debug(f"Created S3 client for {self.target_name}")
+        return self.client
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
         real_key = key
         if self.bucket_prefix:
             real_key = os.path.join(self.bucket_prefix, key) if key else self.bucket_prefix
 
-        async with self.get_client_creator() as client:
-            try:
-                s3_res = await client.head_object(Bucket=self.bucket_name, Key=real_key)
-                headers = {
-                    "ETag": s3_res.get("ETag"),
-                    "Content-Length": str(s3_res.get("ContentLength")),
-                    "Last-Modified": s3_res.get("LastModified").strftime("%a, %d %b %Y %H:%M:%S GMT")
-                }
+        try:
+            client = await self.get_client()
+            condition_params = get_condition_params(conditions)
+            s3_res = await self.call_s3('head', lambda: client.head_object(
+                    Bucket=self.bucket_name, Key=real_key, **condition_params))
+            self.set_object_size(real_key, s3_res.get("ContentLength"))
+            headers = get_object_headers(s3_res)
 
-                content_type = guess_content_type(real_key)
-                headers['Content-Type'] = content_type
+            content_type = guess_content_type(real_key)
+            headers['Content-Type'] = content_type
 
-                return Response(headers=headers)
-            except Exception as e:
-                return handle_s3_exception(e, key)
+            return Response(headers=headers)
+        except Exception as e:
+            return handle_s3_exception(e, key)
 
 
     @override
-    async def get_object(self, key: str):
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
         real_key = key
         if self.bucket_prefix:
             real_key = os.path.join(self.bucket_prefix, key) if key else self.bucket_prefix
@@ -112,19 +272,302 @@ class AiobotoProxyClient(ProxyClient):
             headers['Content-Disposition'] = f'attachment; filename="{filename}"'
 
         try:
+            client = await self.get_client()
+
+            if await self.should_redirect(client, key, real_key, range_header):
+                return await self.get_redirect_response(client, real_key, content_type, headers)
+
+            condition_params = get_condition_params(conditions)
+            if not range_header and self.should_get_parallel(real_key):
+                response = await self.get_parallel_object(client, real_key, 
+                        condition_params, content_type, headers)
+                if response is not None:
+                    return response
+
+            if range_header and (',' in range_header or (if_range and 
+                    ('IfMatch' in condition_params or 'IfUnmodifiedSince' in condition_params))):
+                # S3 only supports a single range per request, and If-Range can 
+                # only be passed upstream if it doesn't clash with the request's conditions
+                return await self.get_multirange_object(client, key, real_key, 
+                        range_header, if_range, condition_params, content_type, headers)
+
+            params = {
+                "Bucket": self.bucket_name,
+                "Key": real_key,
+                **condition_params
+            }
+
+            if range_header:
+                # Let S3 evaluate the range, and the If-Range condition if there is one
+                if if_range is None:
+                    params["Range"] = range_header
+                elif if_range.startswith('"'):
+                    params["Range"] = range_header
+                    params["IfMatch"] = if_range
+                elif parse_http_date(if_range):
+                    params["Range"] = range_header
+                    params["IfUnmodifiedSince"] = parse_http_date(if_range)
+
+            try:
+                if self.should_hedge_get(real_key):
+                    s3_res = await self.call_s3('get', lambda: client.get_object(**params),
+                            discard=lambda res: res["Body"].close())
+                else:
+                    s3_res = await client.get_object(**params)
+            except botocore.exceptions.ClientError as e:
+                if if_range and get_error_status(e) == 412:
+                    # The If-Range validator doesn't match, so send the whole object
+                    s3_res = await client.get_object(Bucket=self.bucket_name, Key=real_key,
+                            **condition_params)
+                else:
+                    raise
+
+            status_code = 200
+            headers.update(get_object_headers(s3_res))
+            if s3_res.get("ContentRange"):
+                status_code = 206
+                headers["Content-Range"] = s3_res.get("ContentRange")
+            else:
+                self.set_object_size(real_key, s3_res.get("ContentLength"))
+
             return S3Stream(
-                self.get_client_creator,
-                bucket=self.bucket_name,
-                key=key,
-                real_key=real_key,
+                s3_res["Body"],
+                status_code=status_code,
                 media_type=content_type,
                 headers=headers)
         except Exception as e:
             return handle_s3_exception(e, key)
 
 
+    def set_object_size(self, real_key, size):
+        if size is None or (self.redirect_min_size is None and self.hedger is None
+                            and self.parallel_min_size is None):
+            return
+        self.object_sizes.pop(real_key, None)
+        self.object_sizes[real_key] = (size, time.time() + self.object_size_ttl)
+        while len(self.object_sizes) > OBJECT_SIZE_CACHE_SIZE:
+            self.object_sizes.popitem(last=False)
+
+
+    def get_cached_object_size(self, real_key):
+        """ Returns the size of the given object from a recent HEAD, GET
+            or listing, or None if it isn't known.
+        """
+        cached = self.object_sizes.get(real_key)
+        if cached is None:
+            return None
+        size, expires = cached
+        if time.time() < expires:
+            return size
+        del self.object_sizes[real_key]
+        return None
+
+
+    def should_get_parallel(self, real_key):
+        """ Returns true if the given object is known to be at least 
+            parallel_min_size, so that it should be fetched in parts.
+        """
+        if self.parallel_min_size is None:
+            return False
+        size = self.get_cached_object_size(real_key)
+        return size is not None and size >= self.parallel_min_size
+
+
+    async def get_object_size(self, client, real_key):
+        """ Returns the size of the given object, using a cached HEAD 
+            (or listing) result if there is a recent one. 
+            Returns None if the object can't be found.
+        """
+        size = self.get_cached_object_size(real_key)
+        if size is not None:
+            return size
+        try:
+            s3_res = await client.head_object(Bucket=self.bucket_name, Key=real_key)
+        except botocore.exceptions.ClientError:
+            # Let the GetObject report the error
+            return None
+        size = s3_res.get("ContentLength")
+        self.set_object_size(real_key, size)
+        return size
+
+
+    async def should_redirect(self, client, key, real_key, range_header):
+        """ Returns true if the given object should be served by redirecting 
+            the client to S3, instead of proxying its content.
+        """
+        if range_header and ',' in range_header:
+            # S3 can't serve multiple ranges
+            return False
+        if any(fnmatchcase(key, pattern) for pattern in self.redirect_patterns):
+            return True
+        if self.redirect_min_size is None:
+            return False
+        size = await self.get_object_size(client, real_key)
+        return size is not None and size >= self.redirect_min_size
+
+
+    async def get_redirect_response(self, client, real_key, content_type, headers):
+        """ Redirect to a short-lived presigned URL for the object, which 
+            returns the same Content-Type and Content-Disposition as a proxied response.
+        """
+        params = {
+            "Bucket": self.bucket_name,
+            "Key": real_key,
+            "ResponseContentType": content_type
+        }
+        if 'Content-Disposition' in headers:
+            params["ResponseContentDisposition"] = headers['Content-Disposition']
+        url = await client.generate_presigned_url('get_object', 
+                Params=params, ExpiresIn=self.redirect_expires)
+        self.stats['redirects'] += 1
+        # Only the client may reuse the redirect, and only while the URL is valid
+        return RedirectResponse(url, status_code=307, headers={
+            'Cache-Control': f"private, max-age={self.redirect_expires // 2}"
+        })
+
+
+    async def get_parallel_object(self, client, real_key, condition_params, content_type, headers):
+        """ Serve a whole object, which is known to be large, by fetching it in
+            parts. The first part tells us the current size and ETag of the 
+            object, and the rest are then fetched with up to parallel_requests 
+            concurrent ranged GETs. At most that many parts are buffered ahead 
+            of the client, and they are sent in order. Returns None if the 
+            object can't be fetched by range, e.g. because it is now empty.
+        """
+        part_size = self.parallel_part_size
+        try:
+            s3_res = await client.get_object(Bucket=self.bucket_name, Key=real_key,
+                    Range=f"bytes=0-{part_size-1}", **condition_params)
+        except botocore.exceptions.ClientError as e:
+            if get_error_status(e) == 416:
+                return None
+            raise
+
+        headers.update(get_object_headers(s3_res))
+        first_body = s3_res["Body"]
+        content_range = s3_res.get("ContentRange")
+        if not content_range:
+            # Upstream ignored the range and sent the whole object
+            return S3Stream(first_body, media_type=content_type, headers=headers)
+
+        size = int(content_range.rpartition('/')[2])
+        self.set_object_size(real_key, size)
+        headers["Content-Length"] = str(size)
+        if size <= part_size:
+            return S3Stream(first_body, media_type=content_type, headers=headers)
+
+        # Every part must come from the same version of the object
+        etag = s3_res.get("ETag")
+        params = {"Bucket": self.bucket_name, "Key": real_key}
+        if etag:
+            params["IfMatch"] = etag
+
+        async def stream_body(body):
+            async with body:
+                async for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+                    yield chunk
+
+        async def read_part(start, end):
+            part = await client.get_object(Range=f"bytes={start}-{end}", **params)
+            body = part["Body"]
+            async with body:
+                return await body.read()
+
+        if size < self.parallel_min_size:
+            # The object has shrunk since its size was learned
+            async def serial_iterator():
+                async for chunk in stream_body(first_body):
+                    yield chunk
+                rest = await client.get_object(Range=f"bytes={part_size}-", **params)
+                async for chunk in stream_body(rest["Body"]):
+                    yield chunk
+
+            return StreamingResponse(serial_iterator(), media_type=content_type, headers=headers)
+
+        ranges = [(start, min(start + part_size, size) - 1) 
+                  for start in range(part_size, size, part_size)]
+
+        async def parallel_iterator():
+            pending = deque()
+            next_part = 0
+
+            def fetch_parts():
+                nonlocal next_part
+                while next_part < len(ranges) and len(pending) < self.parallel_requests:
+                    pending.append(asyncio.ensure_future(read_part(*ranges[next_part])))
+                    next_part += 1
+
+            try:
+                # Fetch the next parts while the first one is streaming
+                fetch_parts()
+                async for chunk in stream_body(first_body):
+                    yield chunk
+                while pending:
+                    data = await pending.popleft()
+                    fetch_parts()
+                    for i in range(0, len(data), STREAM_CHUNK_SIZE):
+                        yield data[i:i+STREAM_CHUNK_SIZE]
+            finally:
+                for task in pending:
+                    task.cancel()
+
+        self.stats['parallel_gets'] += 1
+        return StreamingResponse(parallel_iterator(), media_type=content_type, headers=headers)
+
+
+    async def get_multirange_object(self, client, key, real_key, range_header, 
+                                    if_range, condition_params, content_type, headers):
+        """ Serve a multipart/byteranges response by fetching each range 
+            from S3 separately.
+        """
+        s3_res = await client.head_object(Bucket=self.bucket_name, Key=real_key,
+                **condition_params)
+        headers.update(get_object_headers(s3_res))
+        size = s3_res.get("ContentLength")
+        last_modified = s3_res.get("LastModified").timestamp()
+
+        ranges = None
+        if if_range_matches(if_range, s3_res.get("ETag"), last_modified):
+            ranges = parse_range_header(range_header, size)
+
+        if ranges is None:
+            s3_res = await client.get_object(Bucket=self.bucket_name, Key=real_key)
+            headers.update(get_object_headers(s3_res))
+            return S3Stream(s3_res["Body"], media_type=content_type, headers=headers)
+
+        if not ranges:
+            return get_invalidrange_response(size)
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            s3_res = await client.get_object(Bucket=self.bucket_name, Key=real_key, 
+                    Range=f"bytes={start}-{end}")
+            headers.update(get_object_headers(s3_res))
+            headers["Content-Range"] = format_content_range(start, end, size)
+            return S3Stream(s3_res["Body"], status_code=206, media_type=content_type, headers=headers)
+
+        boundary = get_multipart_boundary()
+        del headers['Content-Type']
+        headers["Content-Length"] = str(get_multipart_length(boundary, content_type, ranges, size))
+
+        async def multipart_iterator():
+            for start, end in ranges:
+                yield get_multipart_part_header(boundary, content_type, start, end, size)
+                part = await client.get_object(Bucket=self.bucket_name, Key=real_key, 
+                        Range=f"bytes={start}-{end}")
+                body = part["Body"]
+                async with body:
+                    async for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+                        yield chunk
+                yield b"\r\n"
+            yield get_multipart_footer(boundary)
+
+        return StreamingResponse(multipart_iterator(), status_code=206, headers=headers,
+                media_type=f"multipart/byteranges; boundary={boundary}")
+
+
     @override
-    async def list_objects_v2(self,
+    async def list_objects(self,
                             continuation_token: str,
                             delimiter: str,
                             encoding_type: str,
@@ -133,6 +576,19 @@ class AiobotoProxyClient(ProxyClient):
                             prefix: str,
                             start_after: str):
 
+        # Partitioned listings have their own continuation tokens, which 
+        # resume after a key, so any listing can be continued with StartAfter
+        cursor = decode_partition_token(continuation_token)
+        if cursor is None and continuation_token and continuation_token.startswith(PARTITION_TOKEN_PREFIX):
+            return get_invalidtoken_response()
+
+        # Large recursive listings are listed in concurrent partitions. The 
+        # owners of objects aren't listed, so FetchOwner is left to S3.
+        if not delimiter and not fetch_owner and self.list_concurrency > 1 and max_keys is not None \
+                and int(max_keys) > PARTITION_PAGE_SIZE and (cursor is not None or not continuation_token):
+            return await self.list_partitioned(continuation_token, encoding_type, 
+                    int(max_keys), prefix, start_after, cursor)
+
         # prefix user-supplied prefix with configured prefix
         real_prefix = prefix
         if self.bucket_prefix:
@@ -142,118 +598,135 @@ class AiobotoProxyClient(ProxyClient):
         if real_prefix and not real_prefix.endswith('/'):
             real_prefix += '/'
 
-        async with self.get_client_creator() as client:
-            try:
-                params = {
-                    "Bucket": self.bucket_name,
-                    "ContinuationToken": continuation_token,
-                    "Delimiter": delimiter,
-                    "EncodingType": encoding_type,
-                    "FetchOwner": fetch_owner,
-                    "MaxKeys": max_keys,
-                    "Prefix": real_prefix,
-                    "StartAfter": start_after
-                }
-                # Remove any None values because boto3 doesn't like those
-                params = {k: v for k, v in params.items() if v is not None}
-
-                response = await client.list_objects_v2(**params)
-                next_token = remove_prefix(self.bucket_prefix, response.get("NextContinuationToken", ""))
-                is_truncated = "true" if response.get("IsTruncated", False) else "false"
-
-                contents = []
-                for obj in response.get("Contents", []):
-                    contents.append({
-                        'Key': remove_prefix(self.bucket_prefix, obj["Key"]),
-                        'LastModified': obj["LastModified"].isoformat(),
-                        'ETag': obj.get("ETag"),
-                        'Size': obj.get("Size"),
-                        'StorageClass': obj.get("StorageClass")
-                    })
-
-                common_prefixes = []
-                for cp in response.get("CommonPrefixes", []):
-                    common_prefix = remove_prefix(self.bucket_prefix, cp["Prefix"])
-                    common_prefixes.append(common_prefix)
-
-                kwargs = {
-                    'Name': self.target_name,
-                    'Prefix': prefix,
-                    'Delimiter': delimiter,
-                    'MaxKeys': max_keys,
-                    'EncodingType': encoding_type,
-                    'KeyCount': response.get("KeyCount", 0),
-                    'IsTruncated': is_truncated,
-                    'ContinuationToken': continuation_token,
-                    'NextContinuationToken': next_token,
-                    'StartAfter': start_after
-                }
-
-                xml = get_list_xml(contents, common_prefixes, **kwargs)
-                return Response(content=xml, media_type="application/xml")
-
-            except Exception as e:
-                return handle_s3_exception(e, key=prefix)
+        # StartAfter is a key within the target, like the listed keys
+        real_start_after = start_after if cursor is None else cursor
+        if self.bucket_prefix and real_start_after:
+            real_start_after = os.path.join(self.bucket_prefix, real_start_after)
+
+        try:
+            client = await self.get_client()
+            params = {
+                "Bucket": self.bucket_name,
+                "ContinuationToken": continuation_token if cursor is None else None,
+                "Delimiter": delimiter,
+                "EncodingType": encoding_type,
+                "FetchOwner": fetch_owner,
+                "MaxKeys": max_keys,
+                "Prefix": real_prefix,
+                "StartAfter": real_start_after
+            }
+            # Remove any None values because boto3 doesn't like those
+            params = {k: v for k, v in params.items() if v is not None}
+
+            response = await self.call_s3('list', lambda: client.list_objects_v2(**params))
+            next_token = remove_prefix(self.bucket_prefix, response.get("NextContinuationToken", ""))
+
+            contents = []
+            for obj in response.get("Contents", []):
+                self.set_object_size(obj["Key"], obj.get("Size"))
+                contents.append(ListEntry(
+                    remove_prefix(self.bucket_prefix, obj["Key"]),
+                    obj.get("ETag"),
+                    obj.get("Size"),
+                    obj["LastModified"].isoformat(),
+                    obj.get("StorageClass")))
+
+            common_prefixes = []
+            for cp in response.get("CommonPrefixes", []):
+                common_prefix = remove_prefix(self.bucket_prefix, cp["Prefix"])
+                common_prefixes.append(common_prefix)
+
+            return ObjectListing(contents, common_prefixes,
+                    is_truncated=response.get("IsTruncated", False),
+                    next_token=next_token,
+                    Name=self.target_name,
+                    Prefix=prefix,
+                    Delimiter=delimiter,
+                    MaxKeys=max_keys,
+                    EncodingType=encoding_type,
+                    ContinuationToken=continuation_token,
+                    StartAfter=start_after)
+
+        except Exception as e:
+            return handle_s3_exception(e, key=prefix)
+
+
+    def get_lister(self):
+        """ Returns a PartitionedLister for this target. The listers share 
+            a semaphore, so that at most list_concurrency listings are in 
+            flight for all of the partitioned listings of the target.
+        """
+        if self.list_semaphore is None:
+            # Created on first use, so that it belongs to the running event loop
+            self.list_semaphore = asyncio.Semaphore(self.list_concurrency)
+        return PartitionedLister(self, self.list_concurrency, semaphore=self.list_semaphore)
+
+
+    async def list_partitioned(self, continuation_token, encoding_type, max_keys,
+                               prefix, start_after, cursor):
+        """ Returns a page of a recursive listing, which is listed in 
+            concurrent partitions (see PartitionedLister).
+        """
+        lister = self.get_lister()
+        result = await lister.list(prefix or '', start_after if cursor is None else cursor, max_keys)
+        if not isinstance(result, tuple):
+            return result
+        contents, is_truncated = result
+
+        self.stats['partitioned_lists'] += 1
+        return ObjectListing(contents, [],
+                is_truncated=is_truncated,
+                next_token=encode_partition_token(contents[-1].Key) if is_truncated else None,
+                Name=self.target_name,
+                Prefix=prefix,
+                Delimiter=None,
+                MaxKeys=max_keys,
+                EncodingType=encoding_type,
+                ContinuationToken=continuation_token,
+                StartAfter=start_after)
+
+
+    @override
+    async def iter_objects(self, prefix: str):
+        lister = self.get_lister()
+        async for batch in lister.iter_objects(prefix or ''):
+            yield batch
 
 
 # Adapted from https://stackoverflow.com/questions/69617252/response-file-stream-from-s3-fastapi
 class S3Stream(StreamingResponse):
-    """ Stream the result of GetObject.
+    """ Stream the body of a GetObject result.
     """
     def __init__(
             self,
-            client_creator: typing.Callable,
-            content: typing.Any = None,
+            body: typing.Any,
             status_code: int = 200,
             headers: dict = None,
             media_type: str = None,
             background: BackgroundTask = None,
-            bucket: str = None,
-            key: str = None,
-            real_key: str = None,
     ):
-        super(S3Stream, self).__init__(content, status_code, headers, media_type, background)
-        self.client_creator = client_creator
-        self.bucket = bucket
-        self.key = key
-        self.real_key = real_key
+        super(S3Stream, self).__init__(None, status_code, headers, media_type, background)
+        self.s3_body = body
 
     async def stream_response(self, send) -> None:
-        async with self.client_creator() as client:
-            try:
-                result = await client.get_object(Bucket=self.bucket, Key=self.real_key)
-
-                await send({
-                    "type": "http.response.start",
-                    "status": self.status_code,
-                    "headers": self.raw_headers,
-                })
-
-                async for chunk in result["Body"]:
-
-                    if not isinstance(chunk, bytes):
-                        chunk = chunk.encode(self.charset)
-
-                    await send({
-                        "type": "http.response.body",
-                        "body": chunk,
-                        "more_body": True
-                    })
-
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        # The client is shared, so make sure the connection is released 
+        # back to the pool even if the downstream client goes away
+        body = self.s3_body
+        async with body:
+            async for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
                 await send({
                     "type": "http.response.body",
-                    "body": b"",
-                    "more_body": False})
-
-            except client.exceptions.NoSuchKey:
-                r = get_nosuchkey_response(self.key)
-                await send({
-                    "type": "http.response.start",
-                    "status": r.status_code,
-                    "headers": r.raw_headers,
+                    "body": chunk,
+                    "more_body": True
                 })
-                await send({
-                    "type": "http.response.body",
-                    "body": r.body,
-                    "more_body": False,
-                })
\ No newline at end of file
+
+        await send({
+            "type": "http.response.body",
+            "body": b"",
+            "more_body": False})
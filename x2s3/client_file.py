@@ -1,18 +1,40 @@
 import os
 import sys
-from hashlib import md5
+import time
+import bisect
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing_extensions import override
 
+import anyio
 from loguru import logger
-from fastapi.responses import Response, StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
+from fastapi.responses import Response, JSONResponse
 
 from x2s3.utils import *
-from x2s3.client import ProxyClient
+from x2s3.client import ProxyClient, ObjectListing
+from x2s3.etags import EtagIndex, calc_etag, get_stat_etag, ETAG_PART_SIZE, ETAG_MAX_PENDING
+from x2s3.listing_index import ListingIndex
+from x2s3.manifest import Manifest
 
 
 STATIC_ETAG = '"11111111111111111111111111111111"'
 
+# Default maximum number of directory entries kept in sorted directory listings
+DIR_CACHE_SIZE = 1000000
+
+# Default number of threads scanning directories and reading file metadata for listings
+LIST_WORKERS = 8
+
+# Directories are only cached once they haven't been modified for this long
+DIR_CACHE_SETTLE_NS = 2 * 1000 * 1000 * 1000
+
+# Number of files whose metadata is read at a time while exporting an inventory
+INVENTORY_BATCH_SIZE = 1000
+
 def handle_exception(e, key=None):
     """ Handle various cases of generic errors.
     """
@@ -20,20 +42,101 @@ def handle_exception(e, key=None):
     return JSONResponse({"error":"Internal server error"}, status_code=500)
 
 
-def file_iterator(file_path: Path):
-    """ Open a file in binary mode and stream the content
+class FileStream(Response):
+    """ Stream a file, or byte ranges of a file, using the most efficient 
+        mechanism supported by the ASGI server.
+
+        Whole files are sent with the http.response.pathsend extension, and 
+        byte ranges with http.response.zerocopysend (i.e. sendfile) if the 
+        server supports them. Otherwise, the file is read in large fixed 
+        size blocks in a worker thread.
+
+        If ranges are given, they are (start, end) tuples with inclusive ends. 
+        Multiple ranges are sent as a multipart/byteranges body, and require 
+        a boundary and the content type of the parts.
     """
-    with open(file_path, "rb") as file:
-        yield from file
+    def __init__(
+            self,
+            path: str,
+            file_size: int,
+            ranges: list = None,
+            boundary: str = None,
+            part_type: str = None,
+            status_code: int = 200,
+            headers: dict = None,
+            media_type: str = None,
+            background: BackgroundTask = None,
+    ):
+        self.path = path
+        self.file_size = file_size
+        self.ranges = ranges
+        self.boundary = boundary
+        self.part_type = part_type
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = background
+        self.init_headers(headers)
+
+
+    def get_parts(self):
+        """ Returns the list of (prefix, start, end, suffix) tuples to send.
+        """
+        if not self.ranges:
+            return [(b"", 0, self.file_size - 1, b"")]
+        if len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            return [(b"", start, end, b"")]
+        parts = []
+        for start, end in self.ranges:
+            prefix = get_multipart_part_header(self.boundary, self.part_type, 
+                    start, end, self.file_size)
+            parts.append((prefix, start, end, b"\r\n"))
+        return parts
+
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        extensions = scope.get("extensions") or {}
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif not self.ranges and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            zerocopy = "http.response.zerocopysend" in extensions
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                for prefix, start, end, suffix in self.get_parts():
+                    if prefix:
+                        await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                    if zerocopy:
+                        await send({
+                            "type": "http.response.zerocopysend",
+                            "file": file.wrapped,
+                            "offset": start,
+                            "count": end - start + 1,
+                            "more_body": True,
+                        })
+                    else:
+                        await file.seek(start)
+                        remaining = end - start + 1
+                        while remaining > 0:
+                            chunk = await file.read(min(STREAM_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                break
+                            remaining -= len(chunk)
+                            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    if suffix:
+                        await send({"type": "http.response.body", "body": suffix, "more_body": True})
 
+            footer = get_multipart_footer(self.boundary) if self.boundary else b""
+            await send({"type": "http.response.body", "body": footer, "more_body": False})
 
-# From https://teppen.io/2018/10/23/aws_s3_verify_etags/
-def calc_etag(inputfile, partsize):
-    md5_digests = []
-    with open(inputfile, 'rb') as f:
-        for chunk in iter(lambda: f.read(partsize), b''):
-            md5_digests.append(md5(chunk).digest())
-    return md5(b''.join(md5_digests)).hexdigest() + '-' + str(len(md5_digests))
+        if self.background is not None:
+            await self.background()
 
 
 class FileProxyClient(ProxyClient):
@@ -42,14 +145,112 @@ class FileProxyClient(ProxyClient):
         self.proxy_kwargs = proxy_kwargs or {}
         self.target_name = self.proxy_kwargs['target_name']
         self.root_path = str(Path(kwargs['path']).resolve())
-        self.calculate_etags = kwargs.get('calculate_etags', False)
+        self.calculate_etags = parse_bool(kwargs.get('calculate_etags', False))
+        self.dir_cache = OrderedDict()
+        self.dir_cache_entries = 0
+        self.dir_cache_size = int(kwargs.get('dir_cache_size', DIR_CACHE_SIZE))
+        self.dir_scans = {}
+        self.dir_lock = threading.Lock()
+        self.list_workers = int(kwargs.get('list_workers', LIST_WORKERS))
+        self.executor = ThreadPoolExecutor(max_workers=self.list_workers, thread_name_prefix='list')
+
+        self.etag_index = None
+        if self.calculate_etags and 'etag_index_dir' in kwargs:
+            os.makedirs(kwargs['etag_index_dir'], exist_ok=True)
+            db_path = os.path.join(kwargs['etag_index_dir'], f"{self.target_name}.etags.db")
+            self.etag_index = EtagIndex(db_path, workers=int(kwargs.get('etag_workers', 2)),
+                    max_pending=int(kwargs.get('etag_max_pending', ETAG_MAX_PENDING)))
+
+        # Metadata of read-only datasets can be served from a prebuilt manifest
+        self.manifest = None
+        if 'manifest' in kwargs:
+            self.manifest = Manifest(kwargs['manifest'])
+
+        self.listing_index = None
+        if 'listing_index_dir' in kwargs and self.manifest is None:
+            os.makedirs(kwargs['listing_index_dir'], exist_ok=True)
+            db_path = os.path.join(kwargs['listing_index_dir'], f"{self.target_name}.listing.db")
+            self.listing_index = ListingIndex(self.root_path, db_path,
+                    rescan_interval=float(kwargs.get('listing_index_rescan', 3600)),
+                    watch=parse_bool(kwargs.get('listing_index_watch', True)))
+
+
+    @override
+    async def startup(self):
+        if self.listing_index is not None:
+            self.listing_index.start()
+
 
     @override
-    async def head_object(self, key: str):
+    async def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.listing_index is not None:
+            await anyio.to_thread.run_sync(self.listing_index.close)
+            self.listing_index = None
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if self.etag_index is not None:
+            self.etag_index.close()
+            self.etag_index = None
+
+
+    def get_etag(self, path, stats):
+        """ Returns the ETag to list for the given file.
+        """
+        if self.manifest is not None:
+            return stats.etag
+        if not self.calculate_etags:
+            return STATIC_ETAG
+        if self.etag_index is None:
+            # This is VERY slow because it needs to read every file
+            return f'"{calc_etag(path, ETAG_PART_SIZE)}"'
+        # Use a cheap ETag until the real one has been computed in the background
+        return self.etag_index.get(path, stats) or get_stat_etag(stats)
+
+
+    def get_object_etag(self, path, stats):
+        """ Returns the ETag to send with the given file, which is also used to 
+            evaluate conditional requests. Unlike listings, objects always get 
+            a real validator, derived from the file's stat data unless a 
+            content ETag is already in the manifest or the ETag index. Files 
+            are never hashed while a request waits.
+        """
+        if self.manifest is not None:
+            return stats.etag
+        if self.etag_index is None:
+            return get_stat_etag(stats)
+        return self.etag_index.get(path, stats) or get_stat_etag(stats)
+
+
+    @override
+    def get_stats(self):
+        if self.listing_index is None:
+            return {}
+        return {'listing_index': {'ready': self.listing_index.ready,
+                'writer': self.listing_index.writer, **self.listing_index.stats}}
+
+
+    def get_indexed_stats(self, key):
+        """ Returns the stats of the given file from the manifest or the 
+            listing index, or None if it is not indexed.
+        """
+        if self.manifest is not None:
+            return self.manifest.get(key)
+        if self.listing_index is None or not self.listing_index.ready:
+            return None
+        return self.listing_index.get(key)
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
         try:
             path = os.path.join(self.root_path, key)
-            if not os.path.isfile(path):
-                return get_nosuchkey_response(key)
+            stats = self.get_indexed_stats(key)
+            if stats is None:
+                if self.manifest is not None or not os.path.isfile(path):
+                    return get_nosuchkey_response(key)
+                stats = os.stat(path)
 
             filename = os.path.basename(path)
             headers = {}
@@ -59,10 +260,15 @@ class FileProxyClient(ProxyClient):
             if content_type=='application/octet-stream':
                 headers['Content-Disposition'] = f'attachment; filename="{filename}"'
 
-            stats = os.stat(path)
             file_size = stats.st_size
             headers["Content-Length"] = str(file_size)
-            headers["Last-Modified"] = format_timestamp_s3(stats.st_mtime)
+            headers["Last-Modified"] = format_http_date(stats.st_mtime)
+            headers["Accept-Ranges"] = "bytes"
+            etag = headers["ETag"] = self.get_object_etag(path, stats)
+
+            response = get_conditional_response(conditions, headers, etag, stats.st_mtime)
+            if response is not None:
+                return response
 
             return Response(headers=headers)
         except Exception as e:
@@ -70,10 +276,17 @@ class FileProxyClient(ProxyClient):
 
 
     @override
-    async def get_object(self, key: str):
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
         try:
             path = os.path.join(self.root_path, key)
-            if not os.path.isfile(path):
+            if self.manifest is not None:
+                stats = self.manifest.get(key)
+                if stats is None:
+                    return get_nosuchkey_response(key)
+            elif os.path.isfile(path):
+                stats = os.stat(path)
+            else:
                 return get_nosuchkey_response(key)
 
             filename = os.path.basename(path)
@@ -84,19 +297,46 @@ class FileProxyClient(ProxyClient):
             if content_type=='application/octet-stream':
                 headers['Content-Disposition'] = f'attachment; filename="{filename}"'
 
-            stats = os.stat(path)
             file_size = stats.st_size
-            headers["Content-Length"] = str(file_size)
-            headers["Last-Modified"] = format_timestamp_s3(stats.st_mtime)
-
-            return StreamingResponse(file_iterator(path), headers=headers, media_type=content_type)
+            headers["Last-Modified"] = format_http_date(stats.st_mtime)
+            headers["Accept-Ranges"] = "bytes"
+            etag = headers["ETag"] = self.get_object_etag(path, stats)
+
+            response = get_conditional_response(conditions, headers, etag, stats.st_mtime)
+            if response is not None:
+                return response
+
+            ranges = None
+            if range_header and if_range_matches(if_range, etag, stats.st_mtime):
+                ranges = parse_range_header(range_header, file_size)
+
+            if ranges is None:
+                headers["Content-Length"] = str(file_size)
+                return FileStream(path, file_size, headers=headers, media_type=content_type)
+
+            if not ranges:
+                return get_invalidrange_response(file_size)
+
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                headers["Content-Length"] = str(end - start + 1)
+                headers["Content-Range"] = format_content_range(start, end, file_size)
+                return FileStream(path, file_size, ranges=ranges, status_code=206, 
+                        headers=headers, media_type=content_type)
+
+            boundary = get_multipart_boundary()
+            del headers['Content-Type']
+            headers["Content-Length"] = str(get_multipart_length(boundary, content_type, ranges, file_size))
+            return FileStream(path, file_size, ranges=ranges, boundary=boundary, 
+                    part_type=content_type, status_code=206, headers=headers,
+                    media_type=f"multipart/byteranges; boundary={boundary}")
 
         except Exception as e:
             return handle_exception(e, key)
 
 
     @override
-    async def list_objects_v2(self,
+    async def list_objects(self,
                             continuation_token: str,
                             delimiter: str,
                             encoding_type: str,
@@ -112,97 +352,300 @@ class FileProxyClient(ProxyClient):
         if real_prefix and not real_prefix.endswith('/'):
             real_prefix += '/'
 
+        # The listing resumes after the last key of the previous page
+        cursor = start_after
+        if continuation_token:
+            cursor = decode_token(continuation_token)
+            if cursor is None:
+                return get_invalidtoken_response()
+
         try:
-            path = str(self.root_path)
-            if real_prefix:
-                path = os.path.join(path, real_prefix)
-
-            logger.debug(f"root_path: {self.root_path}, real_prefix: {real_prefix}, path: {path}")
-
-            res = self.walk_path(path, continuation_token, delimiter, max_keys)
-            contents = res['contents']
-            is_truncated = res['is_truncated']
-            common_prefixes = sorted(res['common_prefixes'])
-
-            kwargs = {
-                'Name': self.target_name,
-                'Prefix': prefix,
-                'Delimiter': delimiter,
-                'MaxKeys': max_keys,
-                'EncodingType': encoding_type,
-                'KeyCount': len(contents) + len(common_prefixes),
-                'IsTruncated': is_truncated,
-                'ContinuationToken': continuation_token,
-                'NextContinuationToken': res['next_token'],
-                'StartAfter': start_after
-            }
-
-            xml = get_list_xml(contents, common_prefixes, **kwargs)
-            return Response(content=xml, media_type="application/xml")
+            logger.debug(f"root_path: {self.root_path}, real_prefix: {real_prefix}, cursor: {cursor}")
+
+            # Walk in a worker thread, so that slow filesystems don't block other requests
+            res = await anyio.to_thread.run_sync(self.walk_path, 
+                    real_prefix or '', cursor, delimiter, int(max_keys))
+            return ObjectListing(res['contents'], res['common_prefixes'], 
+                    is_truncated=res['is_truncated']=='true',
+                    next_token=res['next_token'],
+                    Name=self.target_name,
+                    Prefix=prefix,
+                    Delimiter=delimiter,
+                    MaxKeys=max_keys,
+                    EncodingType=encoding_type,
+                    ContinuationToken=continuation_token,
+                    StartAfter=start_after)
 
         except Exception as e:
             return handle_exception(e, key=prefix)
 
 
-    def walk_path(self, path, continuation_token, delimiter, max_keys):
-        commons = set()
-        contents = []
-
-        if os.path.isdir(path):
-            started = continuation_token is None
-            for root, dirs, filenames in os.walk(path):
-                logger.trace(f"root={root}, dirs={dirs}")
-
-                dirs.sort() # recurse in predictable (sorted) order
-                p = remove_prefix(str(self.root_path), root)
-
-                for filename in filenames:
-                    file_path = os.path.join(root, filename)
-                    key = os.path.join(p, filename)
-
-                    started = started or continuation_token == key
-                    logger.trace(f"found {key} (started={started}, len={len(contents)})")
-
-                    if len(contents)+len(commons) == max_keys:
-                        # Reached max keys to be retrieved
-                        return {
-                            'contents': contents, 
-                            'common_prefixes': commons, 
-                            'next_token': key,
-                            'is_truncated': 'true'
-                        }
-
-                    if started:
-                        # Get details
-                        stats = os.stat(file_path)
-                        file_size = stats.st_size
-
-                        etag = STATIC_ETAG
-                        if self.calculate_etags:
-                            # This is VERY slow because it needs to read every file
-                            etag = f'"{calc_etag(file_path, 8388608)}"'
-
-                        contents.append({
-                            'Key': key,
-                            'Size': str(file_size),
-                            'ETag': etag,
-                            'LastModified': format_timestamp_s3(stats.st_mtime),
-                            'StorageClass': 'STANDARD'
-                        })
-
-                if started and delimiter:
-                    # CommonPrefixes are only generated when there is a delimiter
-                    for d in dirs:
-                        common_prefix = dir_path(os.path.join(p, d))
-                        commons.add(common_prefix)
-
-                if delimiter=='/':
-                    # Do not recurse
-                    break
+    @override
+    async def iter_objects(self, prefix: str):
+        real_prefix = prefix or ''
+        if real_prefix and not real_prefix.endswith('/'):
+            real_prefix += '/'
 
-        return {
+        index = self.manifest
+        if index is None and self.listing_index is not None and self.listing_index.ready:
+            index = self.listing_index
+
+        if index is not None:
+            def next_batch(cursor):
+                res = self.walk_index(index, real_prefix, cursor, None, INVENTORY_BATCH_SIZE)
+                return res['contents'], res['is_truncated']=='true'
+        else:
+            # A single walk of the tree, instead of resuming it for every page
+            path = os.path.join(self.root_path, real_prefix) if real_prefix else self.root_path
+            keys = self.iter_keys(path, real_prefix, None, True) if os.path.isdir(path) else iter(())
+
+            def next_batch(cursor):
+                entries = list(itertools.islice(keys, INVENTORY_BATCH_SIZE))
+                contents = [obj for obj in self.executor.map(self.get_listing_object, entries)
+                        if obj is not None]
+                return contents, len(entries) == INVENTORY_BATCH_SIZE
+
+        cursor = None
+        try:
+            while True:
+                # The next batch isn't read until this one has been sent,
+                # so the walk stops when the client goes away
+                contents, is_truncated = await anyio.to_thread.run_sync(next_batch, cursor)
+                if contents:
+                    yield contents
+                    cursor = contents[-1].Key
+                if not is_truncated:
+                    return
+        except Exception as e:
+            yield handle_exception(e, key=prefix)
+
+
+    def scan_dir(self, path):
+        """ Returns the mtime of the given directory and the names of its 
+            files and subdirectories, with a trailing slash on the 
+            subdirectories, sorted in the order of the keys beneath them. 
+        """
+        mtime = os.stat(path).st_mtime_ns
+        names = []
+        with os.scandir(path) as it:
+            for entry in it:
+                # The entry type usually comes from the directory itself, without a stat
+                try:
+                    if entry.is_dir():
+                        names.append(entry.name + '/')
+                    elif entry.is_file():
+                        names.append(entry.name)
+                except OSError:
+                    # e.g. a broken symlink, or an entry deleted since scanning
+                    continue
+        names.sort()
+        return mtime, names
+
+
+    def cache_dir(self, path, mtime, names):
+        """ Caches the sorted entries of the given directory, evicting the 
+            least recently used directories if the cache is full.
+        """
+        # A directory modified in the same tick as its mtime could still
+        # change without its mtime changing, so it is cached once it settles
+        if time.time_ns() - mtime <= DIR_CACHE_SETTLE_NS or len(names) > self.dir_cache_size:
+            return
+        with self.dir_lock:
+            if path in self.dir_cache:
+                self.dir_cache_entries -= len(self.dir_cache.pop(path)[1])
+            self.dir_cache[path] = (mtime, names)
+            self.dir_cache_entries += len(names)
+            while self.dir_cache_entries > self.dir_cache_size:
+                _, (_, evicted) = self.dir_cache.popitem(last=False)
+                self.dir_cache_entries -= len(evicted)
+
+
+    def prefetch_dirs(self, paths):
+        """ Start scanning the given directories in the background, 
+            unless they are already cached or being scanned.
+        """
+        def scan(path):
+            try:
+                self.cache_dir(path, *self.scan_dir(path))
+            finally:
+                with self.dir_lock:
+                    self.dir_scans.pop(path, None)
+
+        with self.dir_lock:
+            for path in paths:
+                if path not in self.dir_cache and path not in self.dir_scans:
+                    self.dir_scans[path] = self.executor.submit(scan, path)
+
+
+    def get_dir_entries(self, path):
+        """ Returns the sorted entries of the given directory (see scan_dir).
+
+            Sorted entries are cached until the directory is modified, so that 
+            paging through a large directory doesn't read and sort it again 
+            for every page.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        with self.dir_lock:
+            scan = self.dir_scans.get(path)
+        if scan is not None:
+            # Wait for the prefetch instead of scanning the directory twice
+            try:
+                scan.result()
+            except Exception:
+                pass
+
+        with self.dir_lock:
+            cached = self.dir_cache.get(path)
+            if cached is not None and cached[0] == mtime:
+                self.dir_cache.move_to_end(path)
+                return cached[1]
+
+        mtime, names = self.scan_dir(path)
+        self.cache_dir(path, mtime, names)
+        return names
+
+
+    def iter_keys(self, path, key_prefix, after, recurse, ancestors=()):
+        """ Yields the (key, path) of each entry beneath the given directory 
+            in lexicographic order of the keys, starting after the given 
+            list of path components. If recurse is false, subdirectories are 
+            yielded as keys ending in a slash instead of being walked.
+
+            Symlinked directories are walked, except those which link back to 
+            a directory being walked (given by its (device, inode) ancestors), 
+            as in scan_files.
+        """
+        if recurse:
+            stats = os.stat(path)
+            dir_id = (stats.st_dev, stats.st_ino)
+            if dir_id in ancestors:
+                return
+            ancestors = ancestors + (dir_id,)
+
+        names = self.get_dir_entries(path)
+        start = 0
+        if after:
+            if len(after) > 1:
+                # Resume inside the subdirectory (or after it, if it's not walked)
+                dirname = after[0] + '/'
+                start = bisect.bisect_left(names, dirname)
+                if start < len(names) and names[start] == dirname:
+                    if recurse:
+                        yield from self.iter_keys(os.path.join(path, dirname), 
+                                key_prefix + dirname, after[1:], recurse, ancestors)
+                    start += 1
+            else:
+                start = bisect.bisect_right(names, after[0])
+
+        for i in range(start, len(names)):
+            name = names[i]
+            if recurse and name.endswith('/'):
+                # Scan the next few subdirectories in parallel with this one
+                self.prefetch_dirs([os.path.join(path, n) for n in 
+                        names[i+1:i+1+self.list_workers] if n.endswith('/')])
+                yield from self.iter_keys(os.path.join(path, name), key_prefix + name, None, 
+                        recurse, ancestors)
+            else:
+                yield key_prefix + name, os.path.join(path, name)
+
+
+    def walk_path(self, prefix, cursor, delimiter, max_keys):
+        """ Returns a page of up to max_keys objects and common prefixes 
+            beneath the given prefix, with keys after the given cursor. 
+
+            The walk is resumed directly at the cursor by descending through 
+            the directories named by its path, so each page only costs the 
+            entries it returns, however many pages came before it.
+        """
+        commons = []
+        contents = []
+        result = {
             'contents': contents, 
             'common_prefixes': commons, 
             'next_token': None,
             'is_truncated': 'false'
         }
+
+        if self.manifest is not None:
+            return self.walk_index(self.manifest, prefix, cursor, delimiter, max_keys)
+        if self.listing_index is not None and self.listing_index.ready:
+            return self.walk_index(self.listing_index, prefix, cursor, delimiter, max_keys)
+
+        path = os.path.join(self.root_path, prefix) if prefix else self.root_path
+        if not os.path.isdir(path):
+            return result
+
+        after = None
+        if cursor:
+            if cursor.startswith(prefix):
+                after = cursor[len(prefix):].split('/')
+            elif cursor > prefix:
+                # Every key beneath the prefix sorts before the cursor
+                return result
+
+        # CommonPrefixes are only generated when there is a delimiter
+        recurse = delimiter != '/'
+        entries = []
+        for entry in self.iter_keys(path, prefix, after, recurse):
+            entries.append(entry)
+            if len(entries) > max_keys:
+                # Reached max keys to be retrieved
+                entries.pop()
+                result['is_truncated'] = 'true'
+                result['next_token'] = encode_token(entries[-1][0] if entries else cursor or '')
+                break
+
+        # Read the metadata of the files in parallel, since each read is a 
+        # round trip to the server on network filesystems
+        for (key, _), obj in zip(entries, self.executor.map(self.get_listing_object, entries)):
+            if key.endswith('/'):
+                commons.append(key)
+            elif obj is not None:
+                contents.append(obj)
+
+        return result
+
+
+    def walk_index(self, index, prefix, cursor, delimiter, max_keys):
+        """ Returns a page of the listing from the given listing index or 
+            manifest (see walk_path).
+        """
+        entries, is_truncated = index.list(prefix, cursor, delimiter, max_keys)
+        commons = []
+        contents = []
+        for key, stats in entries:
+            if stats is None:
+                commons.append(key)
+            else:
+                file_path = os.path.join(self.root_path, key)
+                contents.append(self.get_stat_listing(key, file_path, stats))
+
+        next_token = None
+        if is_truncated:
+            next_token = encode_token(entries[-1][0] if entries else cursor or '')
+        return {
+            'contents': contents, 
+            'common_prefixes': commons, 
+            'next_token': next_token,
+            'is_truncated': 'true' if is_truncated else 'false'
+        }
+
+
+    def get_stat_listing(self, key, file_path, stats):
+        return ListEntry(key, self.get_etag(file_path, stats), str(stats.st_size), 
+                format_timestamp_s3(stats.st_mtime), 'STANDARD')
+
+
+    def get_listing_object(self, entry):
+        """ Returns the listing of the given (key, path) entry, or None if it 
+            is a common prefix or the file no longer exists.
+        """
+        key, file_path = entry
+        if key.endswith('/'):
+            return None
+        try:
+            stats = os.stat(file_path)
+        except FileNotFoundError:
+            # Deleted since its directory was read
+            return None
+        return self.get_stat_listing(key, file_path, stats)
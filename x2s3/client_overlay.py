@@ -0,0 +1,152 @@
+from typing_extensions import override
+
+from x2s3 import registry
+from x2s3.utils import *
+from x2s3.client import ProxyClient, ObjectListing
+
+# Sorts after any other character, so that listing after a common prefix plus
+# this character skips every key beneath the prefix
+MAX_CHAR = '\U0010FFFF'
+
+
+class Layer:
+    """ One layer of an overlay, e.g. a local copy of part of a dataset.
+    """
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.hits = 0
+
+
+class OverlayProxyClient(ProxyClient):
+    """ Serves a target from a stack of layers, e.g. a hot copy of part of a
+        dataset on local disk in front of the full dataset in S3.
+
+        Objects are served from the first layer which has them, and listings
+        merge every layer, with keys in upper layers hiding the same keys in
+        lower ones. Listings are paged by remembering the last key (or common
+        prefix) returned, so every layer must list keys in lexicographic
+        order and support StartAfter.
+    """
+
+    def __init__(self, proxy_kwargs, **kwargs):
+        self.proxy_kwargs = proxy_kwargs or {}
+        self.target_name = self.proxy_kwargs['target_name']
+
+        self.layers = []
+        for i, layer_config in enumerate(kwargs.get('layers', [])):
+            name = str(layer_config.get('name', f"layer{i}"))
+            client = registry.client(layer_config.get('client'),
+                    self.proxy_kwargs, **layer_config.get('options', {}))
+            self.layers.append(Layer(name, client))
+
+        if not self.layers:
+            raise ValueError(f"No layers configured for target {self.target_name}")
+
+
+    @override
+    async def startup(self):
+        for layer in self.layers:
+            await layer.client.startup()
+
+
+    @override
+    async def shutdown(self):
+        for layer in self.layers:
+            await layer.client.shutdown()
+
+
+    @override
+    def get_stats(self):
+        return {'overlay': {
+            layer.name: {'hits': layer.hits, 'client': layer.client.get_stats()}
+            for layer in self.layers
+        }}
+
+
+    async def find(self, call):
+        """ Call each layer in turn, until one of them has the object.
+        """
+        for layer in self.layers:
+            response = await call(layer.client)
+            if response.status_code != 404:
+                layer.hits += 1
+                return response
+        return response
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
+        return await self.find(lambda client: client.head_object(key, conditions=conditions))
+
+
+    @override
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
+        return await self.find(lambda client: client.get_object(key,
+                range_header=range_header, if_range=if_range, conditions=conditions))
+
+
+    @override
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        cursor = start_after
+        if continuation_token:
+            cursor = decode_token(continuation_token)
+            if cursor is None:
+                return get_invalidtoken_response()
+
+        # Don't list the keys beneath a common prefix which was already returned
+        skip_prefix = cursor if cursor and delimiter and cursor.endswith(delimiter) else None
+        layer_start_after = cursor + MAX_CHAR if skip_prefix else cursor
+
+        max_keys = int(max_keys) if max_keys is not None else 1000
+        entries = {}
+        horizon = None
+        for layer in self.layers:
+            listing = await layer.client.list_objects(None, delimiter, None,
+                    fetch_owner, max_keys, prefix, layer_start_after)
+            if not isinstance(listing, ObjectListing):
+                return listing
+
+            names = []
+            for obj in listing.contents:
+                names.append(obj.Key)
+                entries.setdefault(obj.Key, obj)
+            for common_prefix in listing.common_prefixes:
+                names.append(common_prefix)
+                entries.setdefault(common_prefix, None)
+
+            if listing.is_truncated and names:
+                # Entries past the end of this page could be missing from this layer
+                last = max(names)
+                horizon = last if horizon is None else min(horizon, last)
+
+        names = sorted(name for name in entries
+                if (not cursor or name > cursor)
+                and (not skip_prefix or not name.startswith(skip_prefix))
+                and (horizon is None or name <= horizon))
+        page = names[:max_keys]
+        is_truncated = len(page) < len(names) or horizon is not None
+        next_token = encode_token(page[-1]) if is_truncated and page else None
+
+        contents = [entries[name] for name in page if entries[name] is not None]
+        common_prefixes = [name for name in page if entries[name] is None]
+
+        return ObjectListing(contents, common_prefixes,
+                is_truncated=next_token is not None,
+                next_token=next_token,
+                Name=self.target_name,
+                Prefix=prefix,
+                Delimiter=delimiter,
+                MaxKeys=max_keys,
+                EncodingType=encoding_type,
+                ContinuationToken=continuation_token,
+                StartAfter=start_after)
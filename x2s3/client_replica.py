@@ -0,0 +1,191 @@
+import sys
+import time
+import random
+from typing_extensions import override
+
+from loguru import logger
+from fastapi.responses import JSONResponse
+
+from x2s3 import registry
+from x2s3.utils import *
+from x2s3.client import ProxyClient, ObjectListing
+
+# Separates the replica name from the replica's own continuation token
+TOKEN_SEPARATOR = ':'
+
+
+class Replica:
+    """ One copy of the target's data, with the health and the latency
+        (as an exponentially weighted moving average) of its recent requests.
+    """
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.latency = None
+        self.unhealthy_until = 0
+        self.requests = 0
+        self.failures = 0
+
+    def is_healthy(self, now):
+        return now >= self.unhealthy_until
+
+    def record_success(self, latency, alpha):
+        self.requests += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = alpha * latency + (1 - alpha) * self.latency
+
+    def record_failure(self, cooldown):
+        self.requests += 1
+        self.failures += 1
+        self.unhealthy_until = time.monotonic() + cooldown
+
+    def get_stats(self):
+        return {
+            'latency_ms': None if self.latency is None else round(self.latency * 1000, 1),
+            'healthy': self.is_healthy(time.monotonic()),
+            'requests': self.requests,
+            'failures': self.failures,
+            'client': self.client.get_stats()
+        }
+
+
+class ReplicaProxyClient(ProxyClient):
+    """ Serves a target whose data is available from several replicas,
+        e.g. a local mount, an on-premises S3 store and AWS.
+
+        Each request is sent to the healthy replica with the lowest latency.
+        Replicas that haven't been measured yet are tried first, and a small
+        fraction of requests explore other replicas so that their latencies
+        stay current. If a replica fails (5xx or timeout), it is avoided for
+        replica_cooldown seconds and the request fails over to the next one.
+        Listings are continued on the replica which started them.
+    """
+
+    def __init__(self, proxy_kwargs, **kwargs):
+        self.proxy_kwargs = proxy_kwargs or {}
+        self.target_name = self.proxy_kwargs['target_name']
+        self.alpha = float(kwargs.get('replica_ewma_alpha', 0.3))
+        self.cooldown = float(kwargs.get('replica_cooldown', 30))
+        self.explore = float(kwargs.get('replica_explore', 0.05))
+
+        self.replicas = []
+        for i, replica_config in enumerate(kwargs.get('replicas', [])):
+            name = str(replica_config.get('name', f"replica{i}"))
+            client = registry.client(replica_config.get('client'),
+                    self.proxy_kwargs, **replica_config.get('options', {}))
+            self.replicas.append(Replica(name, client))
+
+        if not self.replicas:
+            raise ValueError(f"No replicas configured for target {self.target_name}")
+
+        self.stats = {
+            'failovers': 0
+        }
+
+
+    @override
+    async def startup(self):
+        for replica in self.replicas:
+            await replica.client.startup()
+
+
+    @override
+    async def shutdown(self):
+        for replica in self.replicas:
+            await replica.client.shutdown()
+
+
+    @override
+    def get_stats(self):
+        return {'replica': {
+            **self.stats,
+            'replicas': {replica.name: replica.get_stats() for replica in self.replicas}
+        }}
+
+
+    def get_ordered_replicas(self):
+        """ Returns the replicas in the order in which they should be tried.
+        """
+        now = time.monotonic()
+        healthy = [r for r in self.replicas if r.is_healthy(now)]
+        unhealthy = [r for r in self.replicas if not r.is_healthy(now)]
+        healthy.sort(key=lambda r: r.latency or 0)
+        if len(healthy) > 1 and random.random() < self.explore:
+            healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        # Unhealthy replicas are only tried as a last resort
+        return healthy + unhealthy
+
+
+    async def call(self, op, replicas=None):
+        """ Call op with the client of each replica in turn, until one of them 
+            answers. Returns the replica which answered (or failed last) 
+            along with its response.
+        """
+        response = None
+        for i, replica in enumerate(replicas or self.get_ordered_replicas()):
+            if i > 0:
+                self.stats['failovers'] += 1
+            start = time.monotonic()
+            try:
+                response = await op(replica.client)
+            except Exception:
+                logger.opt(exception=sys.exc_info()).warning(
+                        f"Error calling replica {replica.name} of {self.target_name}")
+                response = JSONResponse({"error":"Internal server error"}, status_code=500)
+
+            if is_upstream_error(response.status_code):
+                replica.record_failure(self.cooldown)
+                continue
+
+            replica.record_success(time.monotonic() - start, self.alpha)
+            return replica, response
+        return replica, response
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
+        _, response = await self.call(lambda client: client.head_object(key, conditions=conditions))
+        return response
+
+
+    @override
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
+        _, response = await self.call(lambda client: client.get_object(key, 
+                range_header=range_header, if_range=if_range, conditions=conditions))
+        return response
+
+
+    @override
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        replicas = None
+        replica_token = None
+        if continuation_token:
+            # Continuation tokens only make sense to the replica which issued them
+            name, _, replica_token = continuation_token.partition(TOKEN_SEPARATOR)
+            replicas = [r for r in self.replicas if r.name == name]
+            if not replicas:
+                return get_invalidtoken_response()
+
+        replica, listing = await self.call(lambda client: client.list_objects(replica_token, 
+                delimiter, encoding_type, fetch_owner, max_keys, prefix, start_after), replicas)
+        if not isinstance(listing, ObjectListing):
+            return listing
+
+        # Qualify the continuation tokens with the name of the replica
+        next_token = None
+        if listing.next_token:
+            next_token = f"{replica.name}{TOKEN_SEPARATOR}{listing.next_token}"
+        return ObjectListing(listing.contents, listing.common_prefixes, 
+                is_truncated=listing.is_truncated, next_token=next_token, 
+                **{**listing.params, 'ContinuationToken': continuation_token})
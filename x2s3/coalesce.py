@@ -0,0 +1,283 @@
+import sys
+import asyncio
+from typing_extensions import override
+
+from loguru import logger
+from fastapi.responses import Response, StreamingResponse, JSONResponse
+
+from x2s3.utils import *
+from x2s3.client import ProxyClient, ProxyClientWrapper, ObjectListing
+
+# Maximum number of body chunks buffered ahead of the slowest reader of a shared response
+FANOUT_WINDOW = 16
+
+
+def copy_response(response):
+    """ Make a copy of a fully buffered response, so that it can be
+        returned to several requests. Listings are never modified, 
+        so they are shared as they are.
+    """
+    if isinstance(response, ObjectListing):
+        return response
+    copy = Response(content=response.body, status_code=response.status_code)
+    copy.raw_headers = list(response.raw_headers)
+    return copy
+
+
+def get_conditions_key(conditions):
+    """ Returns a hashable form of the given conditional request headers.
+    """
+    if not conditions:
+        return None
+    return tuple(sorted(conditions.items()))
+
+
+class Flight:
+    """ A single upstream GetObject whose response is shared by every request
+        which joins it. The upstream response is run as an ASGI app, and the
+        messages it sends are buffered and replayed to each reader.
+
+        Chunks are released once every reader has sent them. The upstream
+        response is paused when it gets more than FANOUT_WINDOW chunks ahead
+        of the slowest reader, and it is cancelled if every reader goes away.
+    """
+
+    def __init__(self):
+        self.start = None
+        self.chunks = []
+        self.first = 0
+        self.done = False
+        self.failed = False
+        self.readers = {}
+        self.next_reader = 0
+        self.changed = asyncio.Condition()
+        self.cancelled = asyncio.Event()
+        self.task = None
+
+
+    def is_joinable(self):
+        """ Returns true if a new reader can still receive the whole response.
+        """
+        return self.first == 0 and not self.failed and not self.cancelled.is_set()
+
+
+    def add_reader(self):
+        reader_id = self.next_reader
+        self.next_reader += 1
+        self.readers[reader_id] = 0
+        return reader_id
+
+
+    async def remove_reader(self, reader_id):
+        async with self.changed:
+            self.readers.pop(reader_id, None)
+            if not self.readers and not self.done:
+                self.cancelled.set()
+                self.task.cancel()
+            self.trim()
+            self.changed.notify_all()
+
+
+    def trim(self):
+        """ Release the chunks which have been sent by every reader.
+        """
+        if self.readers:
+            low = min(self.readers.values())
+            if low > self.first:
+                del self.chunks[:low - self.first]
+                self.first = low
+
+
+    async def receive(self):
+        # The upstream response only needs to know when to stop
+        await self.cancelled.wait()
+        return {"type": "http.disconnect"}
+
+
+    async def send(self, message):
+        async with self.changed:
+            if message["type"] == "http.response.start":
+                self.start = message
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                if body:
+                    self.chunks.append(body)
+                if not message.get("more_body", False):
+                    self.done = True
+            self.changed.notify_all()
+
+            # Wait for the slowest reader to catch up
+            while self.readers and not self.done and \
+                    self.first + len(self.chunks) - min(self.readers.values()) > FANOUT_WINDOW:
+                await self.changed.wait()
+
+
+    async def run(self, response_getter):
+        scope = {"type": "http", "method": "GET", "headers": [], "extensions": {}}
+        try:
+            response = await response_getter()
+            await response(scope, self.receive, self.send)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.opt(exception=sys.exc_info()).error("Error in shared upstream request")
+        finally:
+            async with self.changed:
+                if not self.done:
+                    self.failed = True
+                self.changed.notify_all()
+
+
+    async def wait_started(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.start is not None or self.failed)
+            return self.start
+
+
+    async def read(self, reader_id):
+        """ Yields the body chunks of the response, in order, for the given reader.
+        """
+        while True:
+            async with self.changed:
+                position = self.readers[reader_id]
+                await self.changed.wait_for(lambda:
+                        position < self.first + len(self.chunks) or self.done or self.failed)
+                if position < self.first + len(self.chunks):
+                    chunk = self.chunks[position - self.first]
+                    self.readers[reader_id] = position + 1
+                    self.trim()
+                    self.changed.notify_all()
+                elif self.failed:
+                    raise RuntimeError("Shared upstream request failed")
+                else:
+                    return
+            yield chunk
+
+
+class FanoutResponse(StreamingResponse):
+    """ One reader's view of a shared Flight.
+    """
+
+    def __init__(self, flight, reader_id):
+        super().__init__(None, status_code=flight.start["status"])
+        self.raw_headers = list(flight.start["headers"])
+        self.flight = flight
+        self.reader_id = reader_id
+
+    async def stream_response(self, send) -> None:
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+            async for chunk in self.flight.read(self.reader_id):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            await self.flight.remove_reader(self.reader_id)
+
+
+class CoalescingProxyClient(ProxyClientWrapper):
+    """ Deduplicates concurrent identical requests, so that they share
+        a single call to the wrapped client.
+
+        Requests are identical if they have the same key, byte range and
+        conditions (for GetObject), or listing parameters (for ListObjectsV2).
+        HEAD and listing responses are copied to every waiter, and GetObject
+        bodies are streamed to all of them as they arrive from upstream.
+    """
+
+    stats_name = 'coalesce'
+
+    def __init__(self, wrapped: ProxyClient, proxy_kwargs, **kwargs):
+        super().__init__(wrapped)
+        self.proxy_kwargs = proxy_kwargs or {}
+        self.target_name = self.proxy_kwargs['target_name']
+        self.calls = {}
+        self.flights = {}
+        self.stats = {
+            'requests': 0,
+            'coalesced': 0
+        }
+
+
+    @staticmethod
+    def is_enabled(options):
+        """ Returns true if the given target options enable request coalescing.
+        """
+        return parse_bool(options.get('coalesce_requests', False))
+
+
+    async def call_once(self, call_key, call):
+        """ Run the given call, unless an identical one is already in progress,
+            in which case its result is shared.
+        """
+        self.stats['requests'] += 1
+        task = self.calls.get(call_key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self.calls[call_key] = task
+            task.add_done_callback(lambda _: self.calls.pop(call_key, None))
+        else:
+            self.stats['coalesced'] += 1
+
+        # Shield the shared task, so that one caller going away doesn't cancel it for the rest
+        response = await asyncio.shield(task)
+        return copy_response(response)
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
+        return await self.call_once(('head', key, get_conditions_key(conditions)),
+                lambda: self.wrapped.head_object(key, conditions=conditions))
+
+
+    @override
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
+        self.stats['requests'] += 1
+        flight_key = ('get', key, range_header, if_range, get_conditions_key(conditions))
+        flight = self.flights.get(flight_key)
+        if flight is not None and flight.is_joinable():
+            self.stats['coalesced'] += 1
+        else:
+            flight = Flight()
+            self.flights[flight_key] = flight
+
+            def release(_):
+                if self.flights.get(flight_key) is flight:
+                    del self.flights[flight_key]
+
+            flight.task = asyncio.ensure_future(flight.run(
+                lambda: self.wrapped.get_object(key, range_header=range_header, if_range=if_range,
+                        conditions=conditions)))
+            flight.task.add_done_callback(release)
+
+        reader_id = flight.add_reader()
+        try:
+            start = await flight.wait_started()
+        except BaseException:
+            await flight.remove_reader(reader_id)
+            raise
+
+        if start is None:
+            await flight.remove_reader(reader_id)
+            return JSONResponse({"error":"Internal server error"}, status_code=500)
+
+        return FanoutResponse(flight, reader_id)
+
+
+    @override
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        params = (continuation_token, delimiter, encoding_type,
+                fetch_owner, max_keys, prefix, start_after)
+        return await self.call_once(('list',) + params,
+                lambda: self.wrapped.list_objects(*params))
@@ -0,0 +1,110 @@
+import os
+import sys
+import sqlite3
+import threading
+from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+# Part size used by the AWS CLI for multipart uploads, which determines the ETags of large objects
+ETAG_PART_SIZE = 8 * 1024 * 1024
+
+# Maximum number of files queued for hashing at once
+ETAG_MAX_PENDING = 10000
+
+
+# From https://teppen.io/2018/10/23/aws_s3_verify_etags/
+def calc_etag(inputfile, partsize):
+    md5_digests = []
+    with open(inputfile, 'rb') as f:
+        for chunk in iter(lambda: f.read(partsize), b''):
+            md5_digests.append(md5(chunk).digest())
+    return md5(b''.join(md5_digests)).hexdigest() + '-' + str(len(md5_digests))
+
+
+def get_file_version(stats):
+    """ Returns a tuple which identifies a particular version of a file.
+        If the file is replaced or modified, the tuple changes.
+    """
+    return (stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns)
+
+
+def get_stat_etag(stats):
+    """ Returns a cheap ETag derived from the file's stat data instead of its content.
+        It changes whenever the file does, but it won't match the ETag of
+        the same content in S3.
+    """
+    version = ':'.join(str(v) for v in get_file_version(stats))
+    return f'"{md5(version.encode()).hexdigest()}"'
+
+
+class EtagIndex:
+    """ Persistent SQLite store of content ETags for the files in a target,
+        keyed by each file's (device, inode, size, mtime).
+
+        ETags which are not yet known are computed by a pool of background
+        worker threads, so that callers never wait on reading a whole file.
+        At most max_pending files are queued at once, and files which don't
+        fit in the queue are queued again the next time they are requested.
+        The database can be shared by several worker processes.
+    """
+
+    def __init__(self, db_path, workers=2, part_size=ETAG_PART_SIZE, max_pending=ETAG_MAX_PENDING):
+        self.db_path = db_path
+        self.part_size = part_size
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='etag')
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS etags (
+                    dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, etag TEXT,
+                    PRIMARY KEY (dev, ino, size, mtime_ns))
+                """)
+            self.db.commit()
+
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.db.close()
+
+
+    def get(self, path, stats):
+        """ Returns the ETag of the given file, or None if it is not yet known,
+            in which case it is computed in the background if the queue
+            isn't full.
+        """
+        version = get_file_version(stats)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag FROM etags WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                version).fetchone()
+            if row:
+                return row[0]
+            if version not in self.pending and len(self.pending) < self.max_pending:
+                self.pending.add(version)
+                self.executor.submit(self.compute, path, version)
+        return None
+
+
+    def compute(self, path, version):
+        try:
+            etag = f'"{calc_etag(path, self.part_size)}"'
+            # Discard the result if the file changed while it was being read
+            if get_file_version(os.stat(path)) == version:
+                with self.lock:
+                    self.db.execute("INSERT OR REPLACE INTO etags VALUES (?,?,?,?,?)",
+                            version + (etag,))
+                    self.db.commit()
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.opt(exception=sys.exc_info()).error(f"Error computing ETag for {path}")
+        finally:
+            with self.lock:
+                self.pending.discard(version)
@@ -0,0 +1,161 @@
+import sys
+import time
+import asyncio
+from collections import deque
+
+from loguru import logger
+
+# Number of recent latencies kept for estimating the hedging delay
+LATENCY_WINDOW = 1000
+
+# Minimum number of latencies needed before requests are hedged
+LATENCY_MIN_SAMPLES = 20
+
+# The delay is recomputed after this many new latencies
+LATENCY_UPDATE_INTERVAL = 50
+
+
+class LatencyTracker:
+    """ Tracks a percentile of the recent latencies of one kind of request.
+    """
+
+    def __init__(self, percentile):
+        self.percentile = percentile
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.since_update = 0
+        self.value = None
+
+    def record(self, latency):
+        self.latencies.append(latency)
+        self.since_update += 1
+        if self.value is None or self.since_update >= LATENCY_UPDATE_INTERVAL:
+            self.update()
+
+    def update(self):
+        self.since_update = 0
+        if len(self.latencies) < LATENCY_MIN_SAMPLES:
+            self.value = None
+            return
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        self.value = latencies[index]
+
+    def get(self):
+        """ Returns the current percentile, or None if there are too few samples.
+        """
+        return self.value
+
+
+class HedgeBudget:
+    """ Token bucket which limits hedged requests to a fraction of all requests.
+        Each request earns the given ratio of a token, each hedge spends a
+        whole token, and at most burst tokens can be saved up.
+    """
+
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def earn(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Hedger:
+    """ Sends a second, identical request when the first one is slower than
+        the given percentile of recent requests of the same kind. Whichever
+        responds first is used, and the other is cancelled (or its result
+        discarded). A budget caps the extra load on the upstream service.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, burst=10, min_delay=0.005):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.trackers = {}
+        self.budget = HedgeBudget(budget, burst)
+        self.stats = {
+            'requests': 0,
+            'hedged': 0,
+            'hedge_wins': 0,
+            'over_budget': 0
+        }
+
+
+    def get_tracker(self, op):
+        tracker = self.trackers.get(op)
+        if tracker is None:
+            tracker = self.trackers[op] = LatencyTracker(self.percentile)
+        return tracker
+
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        for op, tracker in self.trackers.items():
+            if tracker.get() is not None:
+                stats[f"{op}_delay_ms"] = round(tracker.get() * 1000, 1)
+        return stats
+
+
+    async def call(self, op, call, discard=None):
+        """ Await call(), hedging it if it's slow. The op names the kind of request,
+            whose latencies are tracked together. If both attempts succeed, the
+            losing result is passed to discard, e.g. to close its body.
+        """
+        self.stats['requests'] += 1
+        self.budget.earn()
+        tracker = self.get_tracker(op)
+        delay = tracker.get()
+
+        start = time.monotonic()
+        tasks = [asyncio.ensure_future(call())]
+        winner = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=max(delay, self.min_delay))
+                if not done:
+                    if self.budget.spend():
+                        self.stats['hedged'] += 1
+                        tasks.append(asyncio.ensure_future(call()))
+                    else:
+                        self.stats['over_budget'] += 1
+
+            winner = await self.wait_winner(tasks)
+            if winner is not tasks[0]:
+                self.stats['hedge_wins'] += 1
+            return winner.result()
+        finally:
+            # If the first attempt lost, this is a lower bound on its latency
+            tracker.record(time.monotonic() - start)
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif discard is not None and not task.cancelled() and task.exception() is None:
+                    try:
+                        discard(task.result())
+                    except Exception:
+                        logger.opt(exception=sys.exc_info()).debug("Error discarding hedged result")
+
+
+    @staticmethod
+    async def wait_winner(tasks):
+        """ Wait for the first attempt to succeed. If an attempt fails, 
+            the others are given the chance to succeed.
+        """
+        pending = set(tasks)
+        failed = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task in done:
+                    if task.exception() is None:
+                        return task
+                    failed = failed or task
+        return failed
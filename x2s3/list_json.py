@@ -0,0 +1,202 @@
+""" JSON and NDJSON renderings of object listings and target inventories,
+    for programmatic clients which would rather not parse S3 XML.
+"""
+
+import zlib
+
+import orjson
+from loguru import logger
+from fastapi.responses import StreamingResponse
+
+from x2s3.client import ObjectListing
+from x2s3.utils import url_encode
+
+LIST_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Listings in these formats can be much longer than the 1000 keys allowed by S3
+LIST_JSON_MAX_KEYS = 100000
+
+# Number of keys requested from the client at a time, while a listing is streamed.
+# Pages larger than S3's can be listed concurrently by some clients.
+LIST_JSON_PAGE_SIZE = 10000
+
+
+def get_list_format(request):
+    """ Returns the listing format selected by the format query parameter
+        or the Accept header, or None for S3 XML.
+    """
+    list_format = request.query_params.get('format')
+    if list_format:
+        return list_format if list_format in LIST_FORMATS else None
+    accept = request.headers.get('accept', '')
+    for list_format, media_type in LIST_FORMATS.items():
+        if media_type in accept:
+            return list_format
+    return None
+
+
+def get_json_entry(obj, is_url_encode):
+    """ Returns the given ListEntry as a dict, with its size as a number.
+    """
+    key, etag, size, last_modified, storage_class = obj
+    return {
+        'Key': url_encode(key) if is_url_encode else key,
+        'ETag': etag,
+        'Size': int(size) if size is not None else None,
+        'LastModified': last_modified,
+        'StorageClass': storage_class
+    }
+
+
+async def iter_listings(client, first, max_keys, delimiter, encoding_type, fetch_owner, prefix):
+    """ Yields the given first page of a listing of up to max_keys keys,
+        followed by the rest of its pages, which are requested from the
+        client as they are needed.
+    """
+    listing = first
+    remaining = max_keys
+    while True:
+        yield listing
+        if not isinstance(listing, ObjectListing) or not listing.is_truncated:
+            return
+        remaining -= len(listing.contents) + len(listing.common_prefixes)
+        if remaining <= 0:
+            return
+        listing = await client.list_objects(listing.next_token, delimiter, encoding_type,
+                fetch_owner, min(remaining, LIST_JSON_PAGE_SIZE), prefix, None)
+
+
+async def iter_list_json(pages, list_format, params):
+    """ Generates the given listing pages as JSON or NDJSON, in chunks of bytes.
+
+        Each page is written as soon as it is received, so the listing is
+        never held in memory all at once. For NDJSON, each line is an object
+        ({"Key": ...}) or a common prefix ({"Prefix": ...}), and the last
+        line holds the KeyCount, IsTruncated and NextContinuationToken.
+    """
+    is_url_encode = params.get('EncodingType') == 'url'
+    is_ndjson = list_format == 'ndjson'
+    key_count = 0
+    object_count = 0
+    common_prefixes = []
+    last = None
+
+    if not is_ndjson:
+        header = orjson.dumps({k: v for k, v in params.items() if v is not None})
+        yield header[:-1] + (b',"Contents":[' if len(header) > 2 else b'"Contents":[')
+
+    async for listing in pages:
+        if not isinstance(listing, ObjectListing):
+            # The listing can be resumed from the last page which was sent
+            logger.warning(f"Error listing page after {key_count} keys "
+                    f"(status {listing.status_code}), truncating the listing")
+            break
+
+        lines = []
+        for key, obj in listing.iter_entries():
+            if obj is None:
+                prefix = url_encode(key) if is_url_encode else key
+                if is_ndjson:
+                    lines.append(orjson.dumps({'Prefix': prefix}))
+                else:
+                    common_prefixes.append(prefix)
+            else:
+                lines.append(orjson.dumps(get_json_entry(obj, is_url_encode)))
+        key_count += len(listing.contents) + len(listing.common_prefixes)
+        last = listing
+
+        if lines and is_ndjson:
+            yield b'\n'.join(lines) + b'\n'
+        elif lines:
+            yield (b',' if object_count else b'') + b','.join(lines)
+            object_count += len(lines)
+
+    summary = {
+        'KeyCount': key_count,
+        'IsTruncated': last.is_truncated,
+        'NextContinuationToken': last.next_token
+    }
+    if is_ndjson:
+        yield orjson.dumps(summary) + b'\n'
+    else:
+        yield b'],"CommonPrefixes":' + orjson.dumps(common_prefixes) + b',' + orjson.dumps(summary)[1:]
+
+
+async def get_list_json_response(client, list_format, continuation_token, delimiter,
+                                 encoding_type, fetch_owner, max_keys, prefix, start_after):
+    """ Returns a JSON or NDJSON listing of up to max_keys keys, which is 
+        streamed as its pages are listed by the client. If the first page 
+        can't be listed, the client's error response is returned instead.
+    """
+    max_keys = max(0, min(int(max_keys), LIST_JSON_MAX_KEYS))
+    first = await client.list_objects(continuation_token, delimiter, encoding_type,
+            fetch_owner, min(max_keys, LIST_JSON_PAGE_SIZE), prefix, start_after)
+    if not isinstance(first, ObjectListing):
+        return first
+
+    is_url_encode = encoding_type == 'url'
+    params = {
+        'Name': first.params.get('Name'),
+        'Prefix': url_encode(prefix) if is_url_encode else prefix,
+        'Delimiter': url_encode(delimiter) if is_url_encode else delimiter,
+        'MaxKeys': max_keys,
+        'EncodingType': encoding_type,
+        'ContinuationToken': continuation_token,
+        'StartAfter': url_encode(start_after) if is_url_encode else start_after
+    }
+    pages = iter_listings(client, first, max_keys, delimiter, encoding_type, fetch_owner, prefix)
+    return StreamingResponse(iter_list_json(pages, list_format, params),
+            media_type=LIST_FORMATS[list_format])
+
+
+async def iter_inventory(first, batches, compressor=None):
+    """ Generates NDJSON lines for the given batches of objects, in chunks of
+        bytes, which are compressed if a compressor is given. 
+
+        If part of the inventory fails, the stream is aborted, so that a
+        partial inventory is never mistaken for a complete one.
+    """
+    batch = first
+    try:
+        while batch is not None:
+            if not isinstance(batch, list):
+                raise RuntimeError(f"Error listing inventory (status {batch.status_code})")
+            chunk = b''.join(orjson.dumps(get_json_entry(obj, False)) + b'\n' for obj in batch)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+            batch = None
+            async for batch in batches:
+                break
+    finally:
+        await batches.aclose()
+    if compressor is not None:
+        yield compressor.flush()
+
+
+async def get_inventory_response(client, prefix, compress=False):
+    """ Returns an NDJSON stream of every object beneath the given prefix,
+        which is listed as it is sent, or the client's error response if 
+        the listing fails before anything is sent.
+    """
+    batches = client.iter_objects(prefix)
+    first = []
+    async for first in batches:
+        break
+    if not isinstance(first, list):
+        await batches.aclose()
+        return first
+
+    # The body depends on the Accept-Encoding, which shared caches must know
+    headers = {'Vary': 'Accept-Encoding'}
+    compressor = None
+    if compress:
+        # gzip framing, so that the stream can be saved as a .ndjson.gz file
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(iter_inventory(first, batches, compressor),
+            headers=headers, media_type=LIST_FORMATS['ndjson'])
@@ -0,0 +1,181 @@
+import sys
+import time
+import asyncio
+from collections import OrderedDict
+from typing_extensions import override
+
+from loguru import logger
+
+from x2s3.utils import *
+from x2s3.client import ProxyClient, ProxyClientWrapper, ObjectListing
+
+# Maximum number of next pages which are prefetched at the same time
+LISTING_PREFETCH_MAX = 100
+
+
+class CachedListing:
+    """ A listing page which is served from the cache until it expires.
+    """
+
+    def __init__(self, listing, expires):
+        self.listing = listing
+        self.expires = expires
+
+    @property
+    def size(self):
+        return len(self.listing.contents) + len(self.listing.common_prefixes)
+
+
+class ListingCacheProxyClient(ProxyClientWrapper):
+    """ Caches listing pages, so that repeated listings (e.g. from the browse
+        UI, or viewers walking directories) are answered without asking the
+        wrapped client.
+
+        Pages are cached for listing_cache_ttl seconds, keyed by all of the
+        listing parameters, including the continuation token. When a page
+        which is truncated is served, the next page is usually requested
+        right after it, so it is fetched in the background, and a request
+        for it waits for the prefetch instead of listing it again. The cache
+        holds at most listing_cache_size listed keys and common prefixes,
+        evicting the least recently used pages first.
+    """
+
+    stats_name = 'listing_cache'
+
+    def __init__(self, wrapped: ProxyClient, proxy_kwargs, **kwargs):
+        super().__init__(wrapped)
+        self.proxy_kwargs = proxy_kwargs or {}
+        self.target_name = self.proxy_kwargs['target_name']
+        self.ttl = float(kwargs.get('listing_cache_ttl', 10))
+        self.max_size = int(kwargs.get('listing_cache_size', 100000))
+        self.prefetch = parse_bool(kwargs.get('listing_cache_prefetch', True))
+        self.pages = OrderedDict()
+        self.pages_size = 0
+        self.prefetches = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'prefetches': 0,
+            'prefetch_hits': 0
+        }
+
+
+    @staticmethod
+    def is_enabled(options):
+        """ Returns true if the given target options enable the listing cache.
+        """
+        return 'listing_cache_ttl' in options or 'listing_cache_size' in options
+
+
+    @override
+    async def shutdown(self):
+        for task in self.prefetches.values():
+            task.cancel()
+        await super().shutdown()
+
+
+    def invalidate(self, prefix: str = None):
+        """ Forget the cached listings beneath the given prefix, e.g. after
+            new data has been added to the target, or every listing if no
+            prefix is given.
+        """
+        for page_key in list(self.pages):
+            page_prefix = page_key[5] or ''
+            if prefix is None or page_prefix.startswith(prefix) or prefix.startswith(page_prefix):
+                self.remove_page(page_key)
+
+
+    def remove_page(self, page_key):
+        page = self.pages.pop(page_key, None)
+        if page is not None:
+            self.pages_size -= page.size
+
+
+    def get_page(self, page_key):
+        page = self.pages.get(page_key)
+        if page is None:
+            return None
+        if time.time() >= page.expires:
+            self.remove_page(page_key)
+            return None
+        self.pages.move_to_end(page_key)
+        return page.listing
+
+
+    def add_page(self, page_key, listing):
+        page = CachedListing(listing, time.time() + self.ttl)
+        if page.size > self.max_size:
+            return
+        self.remove_page(page_key)
+        self.pages[page_key] = page
+        self.pages_size += page.size
+        while self.pages_size > self.max_size:
+            _, evicted = self.pages.popitem(last=False)
+            self.pages_size -= evicted.size
+
+
+    async def fetch_page(self, page_key):
+        """ Lists the given page with the wrapped client, and caches it.
+        """
+        listing = await self.wrapped.list_objects(*page_key)
+        if isinstance(listing, ObjectListing):
+            self.add_page(page_key, listing)
+        return listing
+
+
+    def prefetch_next(self, page_key, listing):
+        """ Start listing the page after the given one in the background.
+        """
+        if not self.prefetch or not listing.is_truncated or not listing.next_token:
+            return
+        _, delimiter, encoding_type, fetch_owner, max_keys, prefix, _ = page_key
+        next_key = (listing.next_token, delimiter, encoding_type, fetch_owner, max_keys, prefix, None)
+        if next_key in self.prefetches or len(self.prefetches) >= LISTING_PREFETCH_MAX \
+                or self.get_page(next_key) is not None:
+            return
+
+        async def run():
+            try:
+                await self.fetch_page(next_key)
+            except Exception:
+                logger.opt(exception=sys.exc_info()).warning(
+                        f"Error prefetching listing of {self.target_name}/{prefix or ''}")
+            finally:
+                self.prefetches.pop(next_key, None)
+
+        self.stats['prefetches'] += 1
+        self.prefetches[next_key] = asyncio.ensure_future(run())
+
+
+    @override
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        # The key is also the arguments for the wrapped client, which may 
+        # require max_keys to be a number (e.g. botocore's MaxKeys)
+        page_key = (continuation_token, delimiter, encoding_type, fetch_owner,
+                int(max_keys) if max_keys is not None else None, prefix, start_after)
+
+        listing = self.get_page(page_key)
+        if listing is not None:
+            self.stats['hits'] += 1
+        else:
+            prefetch = self.prefetches.get(page_key)
+            if prefetch is not None:
+                # Shield the prefetch, so that this caller going away doesn't cancel it
+                await asyncio.shield(prefetch)
+                listing = self.get_page(page_key)
+            if listing is not None:
+                self.stats['prefetch_hits'] += 1
+            else:
+                self.stats['misses'] += 1
+                listing = await self.fetch_page(page_key)
+
+        if isinstance(listing, ObjectListing):
+            self.prefetch_next(page_key, listing)
+        return listing
@@ -0,0 +1,370 @@
+import os
+import sys
+import stat
+import sqlite3
+import threading
+from collections import namedtuple
+
+from loguru import logger
+
+from x2s3.utils import get_upper_bound, list_sorted
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Number of scanned files written to the index at a time
+SCAN_BATCH_SIZE = 10000
+
+# Number of seconds between checks by the processes which aren't writing the
+# index, for whether it is ready, and whether the writer has gone away
+WRITER_POLL_INTERVAL = 10
+
+# The parts of a file's stat data which are needed to list it and derive its ETag
+IndexedStats = namedtuple('IndexedStats', ['st_dev', 'st_ino', 'st_size', 'st_mtime_ns', 'st_mtime'])
+
+
+def get_indexed_stats(row):
+    """ Returns the stats of a (dev, ino, size, mtime_ns) row from the index.
+    """
+    dev, ino, size, mtime_ns = row
+    # Rounded in the same way as os.stat
+    mtime = mtime_ns // 1000000000 + (mtime_ns % 1000000000) * 1e-9
+    return IndexedStats(dev, ino, size, mtime_ns, mtime)
+
+
+def is_utf8(key):
+    """ Returns true if the given key can be encoded as UTF-8, which isn't
+        the case for filenames whose bytes were escaped by os.fsdecode.
+    """
+    try:
+        key.encode()
+        return True
+    except UnicodeEncodeError:
+        return False
+
+
+def scan_files(path, prefix, stop_event=None):
+    """ Yields a (key, dev, ino, size, mtime_ns) row for each file beneath
+        the given directory, whose key is the given prefix.
+
+        Symlinked directories are scanned, except those which link back to 
+        one of their own ancestors, so the keys are the same as those listed 
+        by walking the directory (see FileProxyClient.iter_keys).
+    """
+    stack = [(path, prefix, ())]
+    while stack and not (stop_event and stop_event.is_set()):
+        dir_path, dir_prefix, ancestors = stack.pop()
+        try:
+            dir_stats = os.stat(dir_path)
+            # Symlinks are followed, but not around in circles
+            dir_id = (dir_stats.st_dev, dir_stats.st_ino)
+            if dir_id in ancestors:
+                continue
+            ancestors = ancestors + (dir_id,)
+            it = os.scandir(dir_path)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        stack.append((entry.path, dir_prefix + entry.name + '/', ancestors))
+                    elif entry.is_file():
+                        stats = entry.stat()
+                        yield (dir_prefix + entry.name, stats.st_dev, stats.st_ino,
+                                stats.st_size, stats.st_mtime_ns)
+                except OSError:
+                    # e.g. a broken symlink, or an entry deleted since scanning
+                    continue
+
+
+class ListingIndex:
+    """ Persistent SQLite index of the files in a file target, keyed by their
+        keys, with the stat data needed to list them.
+
+        The index is built by a background thread, and then kept up to date
+        with inotify (through watchfiles, if it is installed) and with
+        periodic rescans, which also catch changes made by other hosts on
+        network filesystems. Once the first scan is complete (or if a previous
+        run left a complete index), listings are answered with range scans
+        over the index, instead of walking the filesystem.
+
+        When several worker processes share the index, the one which holds
+        a lock on it scans and watches the filesystem, and the others only
+        read the index, until the writer goes away and one of them takes over.
+        Files whose names aren't valid UTF-8 can't be stored, and are skipped.
+    """
+
+    def __init__(self, root_path, db_path, rescan_interval=3600, watch=True):
+        self.root_path = root_path
+        self.db_path = db_path
+        self.rescan_interval = rescan_interval
+        self.watch = watch
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.scanning = False
+        self.dirty = set()
+        self.lock_file = None
+        self.writer = False
+        self.stats = {
+            'rescans': 0,
+            'updates': 0
+        }
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    key TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER
+                ) WITHOUT ROWID
+                """)
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self.db.commit()
+            row = self.db.execute("SELECT value FROM meta WHERE name='root_path'").fetchone()
+
+        # Queries use their own connection, so that they see the last committed
+        # state of the index instead of waiting for writes to finish
+        self.reader = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+
+        # An index which was completed by a previous run can be used while it is rescanned
+        self.ready = row is not None and row[0] == root_path
+
+
+    def start(self):
+        if self.acquire_writer_lock():
+            self.start_writer()
+        else:
+            logger.info(f"Another process is indexing {self.root_path}, reading its index")
+            self.start_thread(self.run_reader, 'listing-reader')
+
+
+    def acquire_writer_lock(self):
+        """ Returns true if this process may write the index, because no 
+            other process holds its lock.
+        """
+        if fcntl is None:
+            return True
+        lock_file = open(self.db_path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+
+    def start_writer(self):
+        self.writer = True
+        self.start_thread(self.run_rescans, 'listing-rescan')
+        if self.watch:
+            if watchfiles is None:
+                logger.info(f"watchfiles is not installed, so changes to {self.root_path} "
+                        "will only be seen by periodic rescans")
+            else:
+                self.start_thread(self.run_watcher, 'listing-watch')
+
+
+    def start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+
+    def close(self):
+        self.stop_event.set()
+        # Threads may be added while joining, by a reader taking over as the writer
+        i = 0
+        while i < len(self.threads):
+            self.threads[i].join(timeout=10)
+            i += 1
+        with self.lock:
+            self.db.close()
+        with self.read_lock:
+            self.reader.close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+    def is_complete(self):
+        """ Returns true if a complete scan of the root path has been written
+            to the index, by any process.
+        """
+        with self.read_lock:
+            row = self.reader.execute("SELECT value FROM meta WHERE name='root_path'").fetchone()
+        return row is not None and row[0] == self.root_path
+
+
+    def run_reader(self):
+        """ Wait for the index to be completed by the process writing it, and
+            take over writing it if that process exits.
+        """
+        while not self.stop_event.wait(WRITER_POLL_INTERVAL):
+            try:
+                if not self.ready and self.is_complete():
+                    self.ready = True
+            except Exception:
+                logger.opt(exception=sys.exc_info()).warning(f"Error reading index of {self.root_path}")
+            if self.acquire_writer_lock():
+                logger.info(f"Taking over indexing {self.root_path}")
+                self.start_writer()
+                return
+
+
+    def run_rescans(self):
+        while not self.stop_event.is_set():
+            try:
+                self.rescan()
+            except Exception:
+                logger.opt(exception=sys.exc_info()).error(f"Error indexing {self.root_path}")
+            self.stop_event.wait(self.rescan_interval)
+
+
+    def run_watcher(self):
+        try:
+            for changes in watchfiles.watch(self.root_path, watch_filter=None,
+                    stop_event=self.stop_event, raise_interrupt=False):
+                for _, path in changes:
+                    self.update_path(path)
+        except Exception:
+            logger.opt(exception=sys.exc_info()).warning(f"Cannot watch {self.root_path} "
+                    "for changes, relying on periodic rescans")
+
+
+    def upsert(self, rows, table='objects'):
+        if not all(is_utf8(row[0]) for row in rows):
+            for row in rows:
+                if not is_utf8(row[0]):
+                    logger.warning(f"Skipping {row[0]!r}, which can't be stored in the listing index")
+            rows = [row for row in rows if is_utf8(row[0])]
+        if rows:
+            with self.lock:
+                self.db.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?,?,?,?,?)", rows)
+                self.db.commit()
+
+
+    def rescan(self):
+        """ Bring the whole index up to date with the filesystem.
+        """
+        with self.lock:
+            self.scanning = True
+            self.dirty.clear()
+            self.db.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS scan (
+                    key TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER
+                ) WITHOUT ROWID
+                """)
+            self.db.execute("DELETE FROM scan")
+            self.db.commit()
+
+        try:
+            batch = []
+            for row in scan_files(self.root_path, '', self.stop_event):
+                batch.append(row)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    self.upsert(batch, table='scan')
+                    batch = []
+            self.upsert(batch, table='scan')
+            if self.stop_event.is_set():
+                return
+
+            # Only write the differences, so that readers see a consistent
+            # index and unchanged rows aren't rewritten on every rescan
+            with self.lock:
+                self.db.execute("DELETE FROM objects WHERE key NOT IN (SELECT key FROM scan)")
+                self.db.execute("""
+                    INSERT OR REPLACE INTO objects SELECT s.* FROM scan s
+                    LEFT JOIN objects o ON o.key = s.key
+                    WHERE o.key IS NULL OR o.dev != s.dev OR o.ino != s.ino
+                    OR o.size != s.size OR o.mtime_ns != s.mtime_ns
+                    """)
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('root_path', ?)", (self.root_path,))
+                self.db.execute("DELETE FROM scan")
+                self.db.commit()
+                self.scanning = False
+                dirty, self.dirty = self.dirty, set()
+            self.ready = True
+            self.stats['rescans'] += 1
+
+            # Paths which changed during the scan may have been scanned before they changed
+            for path in dirty:
+                self.update_path(path)
+        finally:
+            with self.lock:
+                self.scanning = False
+
+
+    def update_path(self, path):
+        """ Bring the index of the given path up to date, after it changed.
+        """
+        key = os.path.relpath(path, self.root_path).replace(os.sep, '/')
+        if key == '.' or key.startswith('../') or not is_utf8(key):
+            return
+
+        with self.lock:
+            if self.scanning:
+                self.dirty.add(path)
+
+        self.stats['updates'] += 1
+        try:
+            stats = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            stats = None
+
+        if stats is not None and stat.S_ISREG(stats.st_mode):
+            self.upsert([(key, stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns)])
+        elif stats is not None and stat.S_ISDIR(stats.st_mode):
+            # e.g. a directory which was moved into the tree
+            batch = []
+            for row in scan_files(path, key + '/', self.stop_event):
+                batch.append(row)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    self.upsert(batch)
+                    batch = []
+            self.upsert(batch)
+        else:
+            # The path was deleted, and it may have been a directory
+            prefix = key + '/'
+            with self.lock:
+                self.db.execute("DELETE FROM objects WHERE key = ? OR (key >= ? AND key < ?)",
+                        (key, prefix, get_upper_bound(prefix)))
+                self.db.commit()
+
+
+    def get(self, key):
+        """ Returns the indexed stats of the file with the given key,
+            or None if it is not in the index.
+        """
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT dev, ino, size, mtime_ns FROM objects WHERE key = ?", (key,)).fetchone()
+        return get_indexed_stats(row) if row else None
+
+
+    def seek(self, key, inclusive=True):
+        """ Yields the (key, stats) entries in the index from the given key onwards.
+        """
+        rows = self.reader.execute(
+            f"SELECT key, dev, ino, size, mtime_ns FROM objects "
+            f"WHERE key {'>=' if inclusive else '>'} ? ORDER BY key", (key,))
+        for row in rows:
+            yield row[0], get_indexed_stats(row[1:])
+
+
+    def list(self, prefix, cursor, delimiter, max_keys):
+        """ Returns up to max_keys (key, stats) entries beneath the given 
+            prefix, after the given cursor (see list_sorted).
+        """
+        with self.read_lock:
+            return list_sorted(self.seek, prefix, cursor, delimiter, max_keys)
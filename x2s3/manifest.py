@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+""" Generate a manifest of the files in a read-only dataset, so that a file
+    target can answer listings and HEAD requests without touching the
+    filesystem.
+"""
+
+import os
+import mmap
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from x2s3.utils import list_sorted
+from x2s3.etags import calc_etag, get_stat_etag, ETAG_PART_SIZE
+from x2s3.listing_index import scan_files, get_indexed_stats, is_utf8
+
+MANIFEST_HEADER = b'# x2s3 manifest v1\n'
+
+# The parts of a file's stat data which are stored in the manifest
+ManifestStats = namedtuple('ManifestStats', ['st_size', 'st_mtime', 'etag'])
+
+
+def parse_line(line):
+    """ Returns the key and stats in the given manifest line.
+    """
+    key, size, mtime_ns, etag = line.split(b'\t')
+    mtime_ns = int(mtime_ns)
+    # Rounded in the same way as os.stat
+    mtime = mtime_ns // 1000000000 + (mtime_ns % 1000000000) * 1e-9
+    return key.decode(), ManifestStats(int(size), mtime, etag.decode())
+
+
+class Manifest:
+    """ Manifest of the files in a read-only dataset.
+
+        Each line holds a file's key, size, mtime (in nanoseconds) and ETag,
+        separated by tabs, and the lines are sorted by key. The manifest is
+        memory-mapped and searched by bisecting its bytes, so opening it is
+        instant and only the pages which are searched are read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MANIFEST_HEADER)] != MANIFEST_HEADER:
+            self.mm.close()
+            raise ValueError(f"{path} is not an x2s3 manifest")
+        self.start = len(MANIFEST_HEADER)
+
+
+    def close(self):
+        self.mm.close()
+
+
+    def find(self, key, inclusive=True):
+        """ Returns the offset of the first line whose key is after
+            (or equal to, if inclusive) the given key.
+        """
+        target = key.encode()
+        lo, hi = self.start, len(self.mm)
+        while lo < hi:
+            # Compare the line containing the midpoint
+            mid = (lo + hi) // 2
+            line_start = self.mm.rfind(b'\n', lo, mid) + 1 or lo
+            line_end = self.mm.find(b'\n', line_start)
+            line_key = self.mm[line_start:self.mm.find(b'\t', line_start, line_end)]
+            if line_key < target or (not inclusive and line_key == target):
+                lo = line_end + 1
+            else:
+                hi = line_start
+        return lo
+
+
+    def seek(self, key, inclusive=True):
+        """ Yields the (key, stats) entries in the manifest from the given key onwards.
+        """
+        offset = self.find(key, inclusive)
+        while offset < len(self.mm):
+            line_end = self.mm.find(b'\n', offset)
+            yield parse_line(self.mm[offset:line_end])
+            offset = line_end + 1
+
+
+    def get(self, key):
+        """ Returns the stats of the file with the given key,
+            or None if it is not in the manifest.
+        """
+        for entry_key, stats in self.seek(key):
+            return stats if entry_key == key else None
+        return None
+
+
+    def list(self, prefix, cursor, delimiter, max_keys):
+        """ Returns up to max_keys (key, stats) entries beneath the given
+            prefix, after the given cursor (see list_sorted).
+        """
+        return list_sorted(self.seek, prefix, cursor, delimiter, max_keys)
+
+
+def write_manifest(root_path, manifest_path, calculate_etags=False, workers=8):
+    """ Writes a manifest of the files beneath the given directory,
+        and returns the number of files in it.
+    """
+    rows = []
+    for row in scan_files(root_path, ''):
+        if '\t' in row[0] or '\n' in row[0] or not is_utf8(row[0]):
+            logger.warning(f"Skipping {row[0]!r}, which can't be stored in a manifest")
+            continue
+        rows.append(row)
+    rows.sort()
+
+    def get_etag(row):
+        if calculate_etags:
+            return f'"{calc_etag(os.path.join(root_path, row[0]), ETAG_PART_SIZE)}"'
+        return get_stat_etag(get_indexed_stats(row[1:]))
+
+    # Write to a temporary file, so that a target never sees a partial manifest
+    tmp_path = f"{manifest_path}.tmp"
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with open(tmp_path, 'wb') as f:
+            f.write(MANIFEST_HEADER)
+            for row, etag in zip(rows, executor.map(get_etag, rows)):
+                key, _, _, size, mtime_ns = row
+                f.write(f"{key}\t{size}\t{mtime_ns}\t{etag}\n".encode())
+    os.replace(tmp_path, manifest_path)
+    return len(rows)
+
+
+if __name__ == "__main__":
+
+    argparser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        "path",
+        help="root directory of the dataset",
+    )
+    argparser.add_argument(
+        "manifest",
+        help="path of the manifest to write",
+    )
+    argparser.add_argument(
+        "--calculate-etags",
+        action="store_true",
+        help="calculate S3-compatible ETags by hashing every file, instead of deriving them from file metadata",
+    )
+    argparser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=8,
+        help="number of threads calculating ETags",
+    )
+    args = argparser.parse_args()
+
+    count = write_manifest(os.path.abspath(args.path), args.manifest,
+            calculate_etags=args.calculate_etags, workers=args.workers)
+    logger.info(f"Wrote {count} files to {args.manifest}")
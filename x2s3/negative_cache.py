@@ -0,0 +1,198 @@
+import time
+from collections import OrderedDict
+from typing_extensions import override
+
+from x2s3.utils import *
+from x2s3.client import ProxyClient, ProxyClientWrapper, ObjectListing
+
+
+class Listing:
+    """ The complete set of keys and common prefixes directly beneath a
+        prefix (or all keys beneath it, for a recursive listing),
+        as returned by a ListObjectsV2 request that was not truncated.
+    """
+
+    def __init__(self, prefix, recursive, keys, common_prefixes, expires):
+        self.prefix = prefix
+        self.recursive = recursive
+        self.keys = keys
+        self.common_prefixes = common_prefixes
+        self.expires = expires
+
+    @property
+    def size(self):
+        return len(self.keys) + len(self.common_prefixes)
+
+    def proves_absent(self, key):
+        """ Returns true if this listing shows that the given key does not exist.
+        """
+        if not key.startswith(self.prefix) or key in self.keys:
+            return False
+        if self.recursive:
+            return True
+        rest = key[len(self.prefix):]
+        if '/' not in rest:
+            # The key would have been listed directly
+            return True
+        # The key would have been under one of the listed common prefixes
+        common_prefix = self.prefix + rest[:rest.index('/')+1]
+        return common_prefix not in self.common_prefixes
+
+
+class NegativeCacheProxyClient(ProxyClientWrapper):
+    """ Remembers keys which are known not to exist, so that repeated
+        lookups of missing keys (e.g. for sparse chunks) are answered
+        without asking the wrapped client.
+
+        Keys are added when HeadObject or GetObject returns 404, and complete
+        (non-truncated) listings are kept so that they can prove the absence
+        of keys beneath their prefix. Entries expire after negative_cache_ttl
+        seconds, and each of the two tables holds at most negative_cache_size
+        keys, evicting the oldest first.
+    """
+
+    stats_name = 'negative_cache'
+
+    def __init__(self, wrapped: ProxyClient, proxy_kwargs, **kwargs):
+        super().__init__(wrapped)
+        self.proxy_kwargs = proxy_kwargs or {}
+        self.target_name = self.proxy_kwargs['target_name']
+        self.ttl = float(kwargs.get('negative_cache_ttl', 10))
+        self.max_size = int(kwargs.get('negative_cache_size', 10000))
+        self.missing = OrderedDict()
+        self.listings = OrderedDict()
+        self.listings_size = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stored': 0
+        }
+
+
+    @staticmethod
+    def is_enabled(options):
+        """ Returns true if the given target options enable the negative cache.
+        """
+        return 'negative_cache_ttl' in options or 'negative_cache_size' in options
+
+
+    def invalidate(self, key: str = None, prefix: str = None):
+        """ Forget that keys are missing, e.g. after new data has been added
+            to the target. If a key is given, only that key is forgotten, and
+            if a prefix is given, every key and listing beneath it is forgotten.
+            With no arguments, the whole cache is cleared.
+        """
+        if key is None and prefix is None:
+            self.missing.clear()
+            self.listings.clear()
+            self.listings_size = 0
+            return
+
+        if key is not None:
+            self.missing.pop(key, None)
+            for listing_key in [lk for lk in self.listings if key.startswith(lk[0])]:
+                self.remove_listing(listing_key)
+
+        if prefix is not None:
+            for k in [k for k in self.missing if k.startswith(prefix)]:
+                del self.missing[k]
+            for listing_key in [lk for lk in self.listings
+                                if lk[0].startswith(prefix) or prefix.startswith(lk[0])]:
+                self.remove_listing(listing_key)
+
+
+    def remove_listing(self, listing_key):
+        listing = self.listings.pop(listing_key, None)
+        if listing is not None:
+            self.listings_size -= listing.size
+
+
+    def is_missing(self, key):
+        """ Returns true if the key is known not to exist.
+        """
+        now = time.time()
+        expires = self.missing.get(key)
+        if expires is not None:
+            if now < expires:
+                return True
+            del self.missing[key]
+
+        # Check the listings of every parent prefix
+        for i in range(len(key)+1):
+            if i == 0 or key[i-1] == '/':
+                for recursive in (False, True):
+                    listing_key = (key[:i], recursive)
+                    listing = self.listings.get(listing_key)
+                    if listing is not None:
+                        if now >= listing.expires:
+                            self.remove_listing(listing_key)
+                        elif listing.proves_absent(key):
+                            return True
+        return False
+
+
+    def add_missing(self, key):
+        self.missing.pop(key, None)
+        self.missing[key] = time.time() + self.ttl
+        self.stats['stored'] += 1
+        while len(self.missing) > self.max_size:
+            self.missing.popitem(last=False)
+
+
+    def add_listing(self, listing):
+        if listing.size > self.max_size:
+            return
+        listing_key = (listing.prefix, listing.recursive)
+        self.remove_listing(listing_key)
+        self.listings[listing_key] = listing
+        self.listings_size += listing.size
+        while self.listings_size > self.max_size:
+            _, evicted = self.listings.popitem(last=False)
+            self.listings_size -= evicted.size
+
+
+    async def lookup(self, key, call):
+        if self.is_missing(key):
+            self.stats['hits'] += 1
+            return get_nosuchkey_response(key)
+
+        self.stats['misses'] += 1
+        response = await call()
+        if response.status_code == 404:
+            self.add_missing(key)
+        return response
+
+
+    @override
+    async def head_object(self, key: str, conditions: dict = None):
+        return await self.lookup(key, lambda: self.wrapped.head_object(key, conditions=conditions))
+
+
+    @override
+    async def get_object(self, key: str, range_header: str = None, if_range: str = None,
+                         conditions: dict = None):
+        return await self.lookup(key,
+            lambda: self.wrapped.get_object(key, range_header=range_header, if_range=if_range,
+                    conditions=conditions))
+
+
+    @override
+    async def list_objects(self,
+                            continuation_token: str,
+                            delimiter: str,
+                            encoding_type: str,
+                            fetch_owner: str,
+                            max_keys: str,
+                            prefix: str,
+                            start_after: str):
+        listing = await self.wrapped.list_objects(continuation_token, delimiter,
+                encoding_type, fetch_owner, max_keys, prefix, start_after)
+
+        # Only complete listings can prove that a key is missing
+        if isinstance(listing, ObjectListing) and not continuation_token and not start_after \
+                and not encoding_type and delimiter in (None, '/') and not listing.is_truncated:
+            keys = {obj.Key for obj in listing.contents}
+            self.add_listing(Listing(dir_path(prefix) or '', delimiter is None,
+                    keys, set(listing.common_prefixes), time.time() + self.ttl))
+
+        return listing
@@ -0,0 +1,287 @@
+""" Lists every object beneath a large prefix by partitioning it into
+    sub-prefixes, which are listed concurrently and merged back into key order.
+"""
+
+import asyncio
+from collections import deque
+
+from x2s3.client import ObjectListing
+from x2s3.utils import encode_token, decode_token, get_upper_bound
+
+# Number of keys requested in each listing
+PARTITION_PAGE_SIZE = 1000
+
+# Partitions are split into their own sub-prefixes down to this depth
+PARTITION_MAX_DEPTH = 4
+
+# Number of pages buffered for each partition which is listed ahead
+PARTITION_BUFFER_PAGES = 2
+
+# Sorts after any other character, so that listing after a common prefix plus
+# this character skips every key beneath the prefix
+MAX_CHAR = '\U0010FFFF'
+
+# Marks the continuation tokens of partitioned listings, which can't be
+# mistaken for S3's own tokens because it isn't a base64 character
+PARTITION_TOKEN_PREFIX = '~'
+
+
+def encode_partition_token(key):
+    """ Returns a continuation token which resumes a listing after the given key.
+    """
+    return PARTITION_TOKEN_PREFIX + encode_token(key)
+
+
+def decode_partition_token(token):
+    """ Returns the key after which the given continuation token resumes a
+        listing, or None if it isn't the token of a partitioned listing.
+    """
+    if not token or not token.startswith(PARTITION_TOKEN_PREFIX):
+        return None
+    return decode_token(token[len(PARTITION_TOKEN_PREFIX):])
+
+
+class Partition:
+    """ A range of keys whose batches of objects are listed in the background
+        once the partition is started, a few pages ahead of being yielded.
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.queue = asyncio.Queue(PARTITION_BUFFER_PAGES)
+        self.task = None
+
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+    async def run(self):
+        try:
+            async for batch in self.batches:
+                await self.queue.put(batch)
+            await self.queue.put(None)
+        except Exception as e:
+            await self.queue.put(e)
+        finally:
+            # Stop listing any sub-partitions if this one is cancelled
+            await self.batches.aclose()
+
+
+    async def __aiter__(self):
+        self.start()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class PartitionedLister:
+    """ Lists the objects beneath a prefix with up to concurrency listings
+        in flight, instead of following one continuation token at a time.
+
+        The sub-prefixes of the prefix are discovered with a delimiter
+        listing. While there are only a few of them (e.g. the resolution
+        levels at the top of an OME-Zarr), each one is split into its own
+        sub-prefixes in the same way. Otherwise, consecutive sub-prefixes are
+        grouped into about one range of keys per worker, and each range is
+        listed recursively, so that many small sub-prefixes don't cost a
+        request each. Since the keys beneath a common prefix are contiguous
+        in key order, yielding each partition in the place of its common
+        prefixes keeps the listing in key order. Partitions are only listed
+        a few pages ahead of the one being yielded, so memory use is bounded
+        however large the listing is.
+
+        At every depth, partitions are only started ahead while fewer than 
+        concurrency of them are running across the whole listing, and every
+        request waits for the semaphore, which can be shared by several 
+        listings to cap the requests made by all of them.
+    """
+
+    def __init__(self, client, concurrency, delimiter='/',
+                 page_size=PARTITION_PAGE_SIZE, max_depth=PARTITION_MAX_DEPTH, semaphore=None):
+        self.client = client
+        self.concurrency = concurrency
+        self.delimiter = delimiter
+        self.page_size = page_size
+        self.max_depth = max_depth
+        self.semaphore = semaphore or asyncio.Semaphore(concurrency)
+        self.running = set()
+
+
+    def start_partition(self, partition):
+        """ Start listing the given partition, and count it as running 
+            until it has listed all of its batches.
+        """
+        if partition.task is None:
+            partition.start()
+            self.running.add(partition)
+            partition.task.add_done_callback(lambda _: self.running.discard(partition))
+
+
+    async def list_page(self, prefix, delimiter, continuation_token, start_after):
+        async with self.semaphore:
+            return await self.client.list_objects(continuation_token, delimiter,
+                    None, None, self.page_size, prefix, start_after)
+
+
+    async def iter_range(self, prefix, start_after=None, end=None):
+        """ Yields the objects beneath the given prefix, after start_after
+            and before end (if given), one page at a time.
+        """
+        continuation_token = None
+        while True:
+            listing = await self.list_page(prefix, None, continuation_token, start_after)
+            if not isinstance(listing, ObjectListing):
+                yield listing
+                return
+            contents = listing.contents
+            if end is not None:
+                contents = [obj for obj in contents if obj.Key < end]
+            if contents:
+                yield contents
+            if len(contents) < len(listing.contents) or not listing.is_truncated:
+                return
+            continuation_token, start_after = listing.next_token, None
+
+
+    def plan_page(self, prefix, listing, depth, split, bound):
+        """ Returns the items of a page of the delimiter listing of the given
+            prefix in key order, each of which is a list of objects or a
+            Partition, and the bound after the last key in the page.
+        """
+        items = []
+        common_prefixes = listing.common_prefixes
+        group_size = max(1, len(common_prefixes) // self.concurrency)
+        end = None
+        i = -1
+        for key, obj in listing.iter_entries():
+            if obj is None:
+                i += 1
+            if end is not None and key < end:
+                # Already listed with the range containing it
+                continue
+
+            if obj is not None:
+                if not items or not isinstance(items[-1], list):
+                    items.append([])
+                items[-1].append(obj)
+                bound = key
+                continue
+
+            if split:
+                items.append(Partition(self.iter_objects(key, None, depth+1)))
+            elif group_size == 1:
+                items.append(Partition(self.iter_range(key)))
+            else:
+                # The keys after the last one before this common prefix, up
+                # to the end of the last common prefix in the group
+                key = common_prefixes[min(i + group_size, len(common_prefixes)) - 1]
+                end = get_upper_bound(key)
+                items.append(Partition(self.iter_range(prefix, bound, end)))
+            bound = key + MAX_CHAR
+
+        return items, bound
+
+
+    async def iter_objects(self, prefix, start_after=None, depth=0):
+        """ Yields every object beneath the given prefix in key order, after
+            the given key if any, as lists of ListEntry records. If part of
+            the listing fails, its error response is yielded instead, and
+            nothing more is yielded.
+        """
+        if prefix and not prefix.endswith(self.delimiter):
+            prefix += self.delimiter
+
+        items = deque()
+        current = None
+        split = None
+        bound = start_after
+
+        if start_after and start_after.startswith(prefix):
+            i = start_after.find(self.delimiter, len(prefix))
+            if i >= 0:
+                # Resume inside the partition containing the key, and then
+                # list this level after every key beneath that partition
+                common_prefix = start_after[:i+len(self.delimiter)]
+                if depth + 1 < self.max_depth:
+                    items.append(Partition(self.iter_objects(common_prefix, start_after, depth+1)))
+                else:
+                    items.append(Partition(self.iter_range(common_prefix, start_after)))
+                bound = common_prefix + MAX_CHAR
+
+        page = asyncio.ensure_future(self.list_page(prefix, self.delimiter, None, bound))
+        try:
+            while items or page is not None:
+                if not items:
+                    listing = await page
+                    page = None
+                    if not isinstance(listing, ObjectListing):
+                        yield listing
+                        return
+                    if listing.is_truncated:
+                        # List the next page of this level while this one is yielded
+                        page = asyncio.ensure_future(self.list_page(prefix, self.delimiter,
+                                listing.next_token, None))
+                    if split is None:
+                        split = (depth + 1 < self.max_depth and not listing.is_truncated
+                                 and len(listing.common_prefixes) < self.concurrency)
+                    planned, bound = self.plan_page(prefix, listing, depth, split, bound)
+                    items.extend(planned)
+                    continue
+
+                current = items.popleft()
+                if isinstance(current, list):
+                    yield current
+                    continue
+
+                # List the next few partitions while this one is yielded,
+                # unless enough are already running at this or other depths
+                self.start_partition(current)
+                ahead = 1
+                for item in items:
+                    if ahead >= self.concurrency or len(self.running) >= self.concurrency:
+                        break
+                    if isinstance(item, Partition):
+                        self.start_partition(item)
+                        ahead += 1
+
+                async for batch in current:
+                    yield batch
+                    if not isinstance(batch, list):
+                        return
+        finally:
+            if page is not None:
+                page.cancel()
+            if isinstance(current, Partition):
+                current.cancel()
+            for item in items:
+                if isinstance(item, Partition):
+                    item.cancel()
+
+
+    async def list(self, prefix, start_after, max_keys):
+        """ Returns up to max_keys objects beneath the given prefix after 
+            start_after, and whether there are more, or an error response.
+        """
+        contents = []
+        batches = self.iter_objects(prefix, start_after)
+        try:
+            async for batch in batches:
+                if not isinstance(batch, list):
+                    return batch
+                contents.extend(batch)
+                if len(contents) > max_keys:
+                    break
+        finally:
+            await batches.aclose()
+        return contents[:max_keys], len(contents) > max_keys
@@ -97,6 +97,12 @@ known_implementations = {
     "file": {
         "class": "x2s3.client_file.FileProxyClient"
     },
+    "overlay": {
+        "class": "x2s3.client_overlay.OverlayProxyClient"
+    },
+    "replica": {
+        "class": "x2s3.client_replica.ReplicaProxyClient"
+    },
 }
 
 assert list(known_implementations) == sorted(
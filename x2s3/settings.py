@@ -1,4 +1,4 @@
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional
 from functools import cache
 
 from pydantic import HttpUrl, BaseModel
@@ -13,7 +13,7 @@ class Target(BaseModel):
     name: str
     browseable: bool = True
     client: str = "aioboto"
-    options: Dict[str,str] = {}
+    options: Dict[str,Any] = {}
 
 
 class Settings(BaseSettings):
@@ -27,6 +27,7 @@ class Settings(BaseSettings):
     ui: bool = True
     virtual_buckets: bool = False
     base_url: Optional[HttpUrl] = None
+    metrics: bool = False
     targets: List[Target] = []
     target_map: Dict[str, Target] = {}
 
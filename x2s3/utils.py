@@ -1,13 +1,30 @@
+import base64
+import binascii
 import inspect
 import urllib
+import secrets
 import xml.etree.ElementTree as ET
+from collections import namedtuple
 from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
 from mimetypes import guess_type
 
 from loguru import logger
 from dateutil import parser
 from fastapi.responses import Response
 
+# Size of the blocks read from upstream and sent downstream when streaming objects
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Requests with more byte ranges than this are served in full
+MAX_RANGES = 100
+
+# Request headers which make a GET or HEAD request conditional
+CONDITIONAL_HEADERS = ('if-match', 'if-none-match', 'if-modified-since', 'if-unmodified-since')
+
+# Response headers which are repeated in a 304 Not Modified response
+NOT_MODIFIED_HEADERS = ('etag', 'last-modified', 'cache-control', 'expires', 'vary')
+
 # From https://stackoverflow.com/questions/1094841/get-a-human-readable-version-of-a-file-size
 def humanize_bytes(num, suffix="B"):
     for unit in ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"):
@@ -25,6 +42,39 @@ def remove_prefix(prefix, key):
     return key
 
 
+def parse_bool(value):
+    """ Parse a boolean option, which may be given as a string 
+        (e.g. "true", "false") in the target options.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
+def parse_size(value):
+    """ Parse a size option given in bytes, either as a number or as a
+        string with a unit suffix, e.g. "512KiB", "64MB" or "10G".
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    s = value.strip().upper().removesuffix('B').removesuffix('I')
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def parse_list(value):
+    """ Parse a list option, which may be given as a list or as 
+        a comma separated string.
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(',') if v.strip()]
+    return list(value)
+
+
 def dir_path(path):
     """ Ensure that the given path ends in a slash, 
         indicating that it points to a folder and not an object.
@@ -80,56 +130,181 @@ def get_bucket_list_xml(buckets):
     return elem_to_str(root)
 
 
-def get_list_xml(contents, common_prefixes, **kwargs):
-    """ Creates S3-style XML elements for the given object listing.
+# The elements of a listing, in the order in which they are written
+LIST_XML_KEYS = [
+    'Name', 
+    'Prefix',
+    'Delimiter',
+    'KeyCount',
+    'MaxKeys',
+    'EncodingType',
+    'IsTruncated',
+    'ContinuationToken',
+    'NextContinuationToken',
+    'StartAfter'
+]
+
+# Number of entries written to each chunk of a streamed listing
+LIST_XML_CHUNK_SIZE = 1000
+
+# Compact record of an object in a listing
+ListEntry = namedtuple('ListEntry', ['Key', 'ETag', 'Size', 'LastModified', 'StorageClass'])
+
+
+def get_list_entry(obj):
+    """ Returns the given listed object as a ListEntry, 
+        if it is a dict with the same fields.
+    """
+    if isinstance(obj, dict):
+        return ListEntry(obj["Key"], obj.get("ETag"), obj.get("Size"), 
+                obj.get("LastModified"), obj.get("StorageClass"))
+    return obj
+
+
+def escape_xml(text):
+    """ Escape the given text for use in an XML element, in the same way as ElementTree.
+    """
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def get_xml_telem(key, value):
+    """ Returns a text element, which is omitted if the value is empty (see add_telem).
     """
+    if not value:
+        return ''
+    return f"<{key}>{escape_xml(str(value))}</{key}>"
 
-    is_url_encode = False
-    if 'EncodingType' in kwargs:
-        is_url_encode = kwargs['EncodingType']=='url'
 
-    root = ET.Element("ListBucketResult")
+def iter_list_xml(contents, common_prefixes, **kwargs):
+    """ Generates S3-style XML for the given object listing, in chunks of bytes.
 
-    keys = [
-        'Name', 
-        'Prefix',
-        'Delimiter',
-        'KeyCount',
-        'MaxKeys',
-        'EncodingType',
-        'IsTruncated',
-        'ContinuationToken',
-        'NextContinuationToken',
-        'StartAfter,'
-    ]
+        The XML is written directly as text, so contents can be any iterable 
+        of ListEntry records (or dicts with the same fields), and it's never 
+        held in memory all at once. The output is identical to serializing 
+        the listing with ElementTree.
+    """
+    is_url_encode = kwargs.get('EncodingType')=='url'
 
-    for key in keys:
+    parts = []
+    for key in LIST_XML_KEYS:
         value = kwargs.get(key)
         if is_url_encode and key in ['Delimiter', 'Prefix', 'Key', 'StartAfter']:
             value = url_encode(value)
-        add_telem(root, key, value)
+        parts.append(get_xml_telem(key, value))
 
-    if common_prefixes:
-        for cp in common_prefixes:
-            value = cp
+    def entries():
+        for cp in common_prefixes or ():
             if is_url_encode:
-                value = url_encode(value)
-            common_prefixes_elem = add_elem(root, "CommonPrefixes")
-            add_telem(common_prefixes_elem, "Prefix", value)
+                cp = url_encode(cp)
+            elem = get_xml_telem("Prefix", cp)
+            yield f"<CommonPrefixes>{elem}</CommonPrefixes>" if elem else "<CommonPrefixes />"
 
-    if contents:
-        for obj in contents:
-            key = obj["Key"]
+        for obj in contents or ():
+            key, etag, size, last_modified, storage_class = get_list_entry(obj)
             if is_url_encode:
                 key = url_encode(key)
-            contents_elem = add_elem(root, "Contents")
-            add_telem(contents_elem, "Key", key)
-            add_telem(contents_elem, "ETag", obj.get("ETag"))
-            add_telem(contents_elem, "Size", obj.get("Size"))
-            add_telem(contents_elem, "LastModified", obj.get("LastModified"))
-            add_telem(contents_elem, "StorageClass", obj.get("StorageClass"))
+            elem = (get_xml_telem("Key", key)
+                    + get_xml_telem("ETag", etag)
+                    + get_xml_telem("Size", size)
+                    + get_xml_telem("LastModified", last_modified)
+                    + get_xml_telem("StorageClass", storage_class))
+            yield f"<Contents>{elem}</Contents>" if elem else "<Contents />"
+
+    started = False
+    for elem in entries():
+        parts.append(elem)
+        if len(parts) >= LIST_XML_CHUNK_SIZE:
+            chunk = ''.join(parts)
+            if chunk:
+                if not started:
+                    chunk = "<?xml version='1.0' encoding='utf-8'?>\n<ListBucketResult>" + chunk
+                    started = True
+                yield chunk.encode('utf-8', 'xmlcharrefreplace')
+            parts = []
+
+    chunk = ''.join(parts)
+    if started:
+        chunk += "</ListBucketResult>"
+    elif chunk:
+        chunk = "<?xml version='1.0' encoding='utf-8'?>\n<ListBucketResult>" + chunk + "</ListBucketResult>"
+    else:
+        chunk = "<?xml version='1.0' encoding='utf-8'?>\n<ListBucketResult />"
+    yield chunk.encode('utf-8', 'xmlcharrefreplace')
 
-    return elem_to_str(root)
+
+def get_list_xml(contents, common_prefixes, **kwargs):
+    """ Creates S3-style XML for the given object listing (see iter_list_xml).
+    """
+    return b''.join(iter_list_xml(contents, common_prefixes, **kwargs))
+
+
+def encode_token(cursor):
+    """ Encodes a listing position (usually the last key returned) 
+        as an opaque continuation token. Keys from filenames which aren't 
+        valid UTF-8 keep their original bytes.
+    """
+    return base64.urlsafe_b64encode(cursor.encode('utf-8', 'surrogateescape')).decode()
+
+
+def decode_token(token):
+    """ Decodes a continuation token created by encode_token, 
+        returning None if the token is invalid.
+    """
+    try:
+        return base64.b64decode(token.encode(), altchars=b'-_', validate=True) \
+                .decode('utf-8', 'surrogateescape')
+    except (binascii.Error, UnicodeEncodeError):
+        return None
+
+
+def get_upper_bound(prefix):
+    """ Returns the smallest string which sorts after every string starting with the prefix.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def list_sorted(seek, prefix, cursor, delimiter, max_keys):
+    """ Lists a sorted key-value store in the same way as ListObjectsV2, 
+        where seek(key, inclusive) returns an iterator over the (key, value) 
+        entries from the given key onwards, in key order.
+
+        Returns up to max_keys (key, value) entries for the keys beneath the 
+        given prefix, after the given cursor, and whether there are more. 
+        Keys are rolled up into common prefixes at the delimiter, whose 
+        values are None. Each common prefix is a single seek past the keys 
+        beneath it, so its cost doesn't depend on how many keys it contains.
+    """
+    entries = []
+    lower, inclusive = prefix, True
+    if cursor and cursor >= prefix:
+        lower, inclusive = cursor, False
+        if delimiter and cursor.endswith(delimiter):
+            lower, inclusive = get_upper_bound(cursor), True
+
+    while lower is not None and len(entries) <= max_keys:
+        next_lower = None
+        for key, value in seek(lower, inclusive):
+            if not key.startswith(prefix):
+                break
+            i = key.find(delimiter, len(prefix)) if delimiter else -1
+            if i >= 0:
+                # Skip over the rest of the keys beneath the common prefix
+                common_prefix = key[:i+len(delimiter)]
+                entries.append((common_prefix, None))
+                next_lower = get_upper_bound(common_prefix)
+                break
+            entries.append((key, value))
+            if len(entries) > max_keys:
+                break
+        lower, inclusive = next_lower, True
+
+    return entries[:max_keys], len(entries) > max_keys
 
 
 def format_timestamp_s3(timestamp):
@@ -151,6 +326,219 @@ def format_isoformat_as_local(isodate):
     return dt.strftime("%Y-%m-%d at %I:%M %p")
 
 
+def format_http_date(timestamp):
+    """ Format the given timestamp as an HTTP date, e.g. for Last-Modified.
+    """
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    """ Parse an HTTP date (e.g. from If-Range) into a timezone-aware datetime. 
+        Returns None if the value cannot be parsed.
+    """
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def parse_range_header(range_header, size):
+    """ Parse an HTTP Range header (RFC 7233) for an object of the given size.
+
+        Returns a list of (start, end) tuples, with inclusive ends. Returns None 
+        if the header should be ignored and the whole object served, i.e. if it 
+        is malformed, uses a unit other than bytes, or asks for too many ranges.
+        Returns an empty list if none of the ranges can be satisfied.
+    """
+    if not range_header:
+        return None
+
+    unit, _, range_set = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not range_set:
+        return None
+
+    specs = [spec.strip() for spec in range_set.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else None
+                if start < 0 or (end is not None and end < start):
+                    return None
+                if start >= size:
+                    # Unsatisfiable, but other ranges may still be valid
+                    continue
+                ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+            else:
+                # Suffix range, i.e. the last N bytes
+                suffix_length = int(last)
+                if suffix_length < 0:
+                    return None
+                if suffix_length == 0 or size == 0:
+                    continue
+                ranges.append((max(size - suffix_length, 0), size - 1))
+        except ValueError:
+            return None
+
+    return ranges
+
+
+def if_range_matches(if_range, etag, last_modified):
+    """ Evaluate an If-Range header against the current validators of an object.
+        The range is only honored if the validator matches, otherwise the 
+        whole object must be sent. ETags use the strong comparison function, 
+        and dates must match exactly.
+    """
+    if not if_range:
+        return True
+
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return bool(etag) and not if_range.startswith('W/') \
+            and not etag.startswith('W/') and if_range == etag
+
+    if last_modified is None:
+        return False
+    if_range_date = parse_http_date(if_range)
+    if if_range_date is None:
+        return False
+    return int(if_range_date.timestamp()) == int(last_modified)
+
+
+def get_conditions(headers):
+    """ Returns the conditional request headers (If-Match, If-None-Match,
+        If-Modified-Since and If-Unmodified-Since) found in the given request
+        headers, as a dict keyed by lowercase header name, or None if there are none.
+    """
+    conditions = {name: headers.get(name) for name in CONDITIONAL_HEADERS if headers.get(name)}
+    return conditions or None
+
+
+def etag_list_matches(etag_list, etag, weak):
+    """ Returns true if the given ETag matches any ETag in the comma separated
+        list from an If-Match or If-None-Match header. The strong comparison
+        function is used unless weak is true.
+    """
+    if not etag:
+        return False
+    if etag_list.strip() == '*':
+        return True
+    if weak:
+        etag = etag.removeprefix('W/')
+    elif etag.startswith('W/'):
+        return False
+    for candidate in etag_list.split(','):
+        candidate = candidate.strip()
+        if weak:
+            candidate = candidate.removeprefix('W/')
+        if candidate == etag:
+            return True
+    return False
+
+
+def evaluate_conditions(conditions, etag, last_modified):
+    """ Evaluate the preconditions of a GET or HEAD request against the
+        current validators of an object, in the order given by RFC 7232 section 6.
+        Returns 412 if a precondition failed, 304 if the object was not
+        modified, or 200 if the request should proceed.
+    """
+    if not conditions:
+        return 200
+
+    if_match = conditions.get('if-match')
+    if_unmodified_since = parse_http_date(conditions.get('if-unmodified-since'))
+    if if_match:
+        if not etag_list_matches(if_match, etag, weak=False):
+            return 412
+    elif if_unmodified_since and last_modified is not None:
+        if int(last_modified) > int(if_unmodified_since.timestamp()):
+            return 412
+
+    if_none_match = conditions.get('if-none-match')
+    if_modified_since = parse_http_date(conditions.get('if-modified-since'))
+    if if_none_match:
+        if etag_list_matches(if_none_match, etag, weak=True):
+            return 304
+    elif if_modified_since and last_modified is not None:
+        if int(last_modified) <= int(if_modified_since.timestamp()):
+            return 304
+
+    return 200
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """ Returns true if the given Accept-Encoding header accepts the given 
+        content coding, i.e. it is listed (or matched by *) with a q-value
+        above zero.
+    """
+    wildcard = None
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            param_name, _, value = param.partition('=')
+            if param_name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == encoding:
+            return q > 0
+        if name == '*':
+            wildcard = q > 0
+    return bool(wildcard)
+
+
+def format_content_range(start, end, size):
+    """ Format a Content-Range header value for the given byte range.
+    """
+    return f"bytes {start}-{end}/{size}"
+
+
+def get_multipart_boundary():
+    """ Generate a boundary string for a multipart/byteranges response.
+    """
+    return secrets.token_hex(16)
+
+
+def get_multipart_part_header(boundary, content_type, start, end, size):
+    """ Returns the delimiter and headers which precede a single part of a 
+        multipart/byteranges response body.
+    """
+    return (f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: {format_content_range(start, end, size)}\r\n"
+            f"\r\n").encode('latin-1')
+
+
+def get_multipart_footer(boundary):
+    """ Returns the closing delimiter of a multipart/byteranges response body.
+    """
+    return f"--{boundary}--\r\n".encode('latin-1')
+
+
+def get_multipart_length(boundary, content_type, ranges, size):
+    """ Compute the total Content-Length of a multipart/byteranges response.
+    """
+    length = len(get_multipart_footer(boundary))
+    for start, end in ranges:
+        header = get_multipart_part_header(boundary, content_type, start, end, size)
+        # Each part is followed by a CRLF
+        length += len(header) + (end - start + 1) + 2
+    return length
+
+
 def get_nosuchkey_response(key):
     return Response(content=inspect.cleandoc(f"""
         <?xml version="1.0" encoding="UTF-8"?>
@@ -173,6 +561,80 @@ def get_nosuchbucket_response(bucket_name):
     """), status_code=404, media_type="application/xml")
 
 
+def get_invalidtoken_response():
+    return Response(content=inspect.cleandoc("""
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Error>
+        <Code>InvalidArgument</Code>
+        <Message>The continuation token provided is incorrect</Message>
+        <ArgumentName>continuation-token</ArgumentName>
+    </Error>
+    """), status_code=400, media_type="application/xml")
+
+
+def get_invalidrange_response(size):
+    headers = {}
+    if size is not None:
+        headers['Content-Range'] = f"bytes */{size}"
+    return Response(content=inspect.cleandoc("""
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Error>
+        <Code>InvalidRange</Code>
+        <Message>The requested range is not satisfiable</Message>
+    </Error>
+    """), status_code=416, headers=headers, media_type="application/xml")
+
+
+def get_notmodified_response(headers):
+    """ Returns a 304 Not Modified response, which carries the validators
+        and caching headers from the given response headers, but no body.
+    """
+    headers = {k: v for k, v in headers.items() if v is not None and k.lower() in NOT_MODIFIED_HEADERS}
+    return Response(status_code=304, headers=headers)
+
+
+def get_preconditionfailed_response():
+    return Response(content=inspect.cleandoc("""
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Error>
+        <Code>PreconditionFailed</Code>
+        <Message>At least one of the pre-conditions you specified did not hold</Message>
+    </Error>
+    """), status_code=412, media_type="application/xml")
+
+
+def get_conditional_response(conditions, headers, etag, last_modified):
+    """ Returns a 304 or 412 response if the given conditions mean that
+        the object should not be sent, or None if it should be.
+    """
+    status = evaluate_conditions(conditions, etag, last_modified)
+    if status == 304:
+        return get_notmodified_response(headers)
+    if status == 412:
+        return get_preconditionfailed_response()
+    return None
+
+
+def get_serviceunavailable_response(retry_after=None):
+    headers = {}
+    if retry_after is not None:
+        headers['Retry-After'] = str(int(retry_after))
+    return Response(content=inspect.cleandoc("""
+    <?xml version="1.0" encoding="UTF-8"?>
+    <Error>
+        <Code>ServiceUnavailable</Code>
+        <Message>The upstream endpoint is unavailable. Please try again later.</Message>
+    </Error>
+    """), status_code=503, headers=headers, media_type="application/xml")
+
+
+def is_upstream_error(status_code):
+    """ Returns true if the given response status means that the upstream 
+        endpoint failed or timed out, rather than answering the request.
+    """
+    return status_code >= 500 or status_code == 408
+
+
 def get_accessdenied_response():
     return Response(content=inspect.cleandoc("""
     <?xml version="1.0" encoding="UTF-8"?>